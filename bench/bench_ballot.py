@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks ballot parsing (src/ballot.py) against the previous five-regex implementation
+on the ballot corpus in bench/corpus/ballots.txt. Also checks that every ballot parses as expected.
+
+Usage: python bench/bench_ballot.py [number of comments]
+'''
+
+import io
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from ballot import parse_ballot
+
+CORPUS = os.path.join(os.path.dirname(__file__), 'corpus', 'ballots.txt')
+
+def parse_ballot_legacy(text):
+  '''The five separate searches count_votes_comments used to do.'''
+  m = re.search(u'[#№]\\s*(?P<number>\\d+)', text, re.UNICODE|re.DOTALL|re.IGNORECASE)
+  if not m:
+    m = re.search(u'уч(астни)?-?ка?\\s*#?№?\\s*(?P<number>\\d+)', text, re.UNICODE|re.DOTALL|re.IGNORECASE)
+  if not m:
+    m = re.search(u'(?P<number>\\d+)\\s*-?[уоы]?й?\\s*уч(астни)?-?ка?', text, re.UNICODE|re.DOTALL|re.IGNORECASE)
+  if not m:
+    m = re.search(u'номер(ом)?\\s*#?№?\\s*(?P<number>\\d+)', text, re.UNICODE|re.DOTALL|re.IGNORECASE)
+  if not m:
+    m = re.search(u'(?P<number>\\d+)\\s*-?[уоы]?й?\\s*номер(ом)?', text, re.UNICODE|re.DOTALL|re.IGNORECASE)
+  return int(m.group('number')) if m else None
+
+def load_corpus():
+  ballots = []
+  with io.open(CORPUS, encoding='utf-8') as f:
+    for line in f:
+      line = line.rstrip(u'\n')
+      if not line or line.startswith(u'#') and u'\t' not in line:
+        continue
+      expected, comment = line.split(u'\t', 1)
+      ballots.append((None if expected == u'-' else int(expected), comment))
+  return ballots
+
+def measure(func, comments):
+  start = time.time()
+  for comment in comments:
+    func(comment)
+  return time.time() - start
+
+def main():
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+  ballots = load_corpus()
+  failed = 0
+  for expected, comment in ballots:
+    got = parse_ballot(comment)
+    legacy = parse_ballot_legacy(comment)
+    if got != expected:
+      failed += 1
+      print((u'MISMATCH: expected %s, got %s: %s' % (expected, got, comment)).encode('utf-8'))
+    elif legacy != got:
+      print((u'CHANGED: legacy parser got %s, now %s: %s' % (legacy, got, comment)).encode('utf-8'))
+  comments = [comment for expected, comment in ballots]
+  comments = (comments * (count // len(comments) + 1))[:count]
+  legacy = measure(parse_ballot_legacy, comments)
+  combined = measure(parse_ballot, comments)
+  print('%d corpus ballots, %d mismatches' % (len(ballots), failed))
+  print('%d comments: legacy %.1f ms, combined %.1f ms (%.1fx)' % (count, legacy * 1000, combined * 1000, legacy / combined))
+  return 1 if failed else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Measures how much resident memory a large comment crawl holds: parses a post page with
+tabun_api's get_comments over and over, keeps every Comment, and reports RSS growth per comment.
+
+Modes:
+  raw   keep comments as parsed (only raw_body for escaped pages)
+  tree  touch comment.body on each comment, so its lxml tree is built and kept
+  drop  touch comment.body, then call comment.drop_body() to go back to raw_body only
+
+Usage: python bench/bench_memory.py [raw|tree|drop] [number of comments] [--lib path/to/libs]
+--lib runs the same crawl against another checkout of src/libs (e.g. an older revision),
+where drop_body may not exist. Run each mode in a fresh process, as RSS only grows.
+'''
+
+from __future__ import print_function
+
+import os
+import resource
+import sys
+
+def main():
+  args = sys.argv[1:]
+  lib = os.path.join(os.path.dirname(__file__), '..', 'src', 'libs')
+  if '--lib' in args:
+    i = args.index('--lib')
+    lib = args[i + 1]
+    del args[i:i + 2]
+  mode = args[0] if args else 'raw'
+  count = int(args[1]) if len(args) > 1 else 100000
+
+  sys.path.insert(0, lib)
+  import tabun_api
+  from bench_preprocess import make_post_page
+
+  page = make_post_page(1000)
+  # Parsing does not touch the network, so the constructor (which logs in) is skipped
+  user = tabun_api.User.__new__(tabun_api.User)
+  user.get_comments('/blog/news/1.html', raw_data=page)
+
+  base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  kept = []
+  while len(kept) < count:
+    for comment in user.get_comments('/blog/news/1.html', raw_data=page).values():
+      if mode in ('tree', 'drop'):
+        comment.body
+      if mode == 'drop':
+        comment.drop_body()
+      kept.append(comment)
+  grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base
+  if sys.platform == 'darwin':
+    grown //= 1024  # bytes there, kilobytes on Linux
+
+  print('%s: %d comments held, RSS grew by %d MB, %d bytes per comment' % (
+    mode, len(kept), grown // 1024, grown * 1024 // len(kept)
+  ))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
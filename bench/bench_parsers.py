@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Runs every tabun_api parser over the page corpus in bench/corpus/ (see make_corpus.py) through
+the raw_data= parameters, without network, and reports pages/s, MB/s of HTML and the peak
+resident memory each parser needed on top of the loaded pages. Every parser runs in a fresh
+process, so one parser's garbage does not count against the next.
+
+Usage:
+  python bench/bench_parsers.py [--parser NAME]... [--time SECONDS] [--rounds N] [--lib path/to/libs] [--save results.json]
+  python bench/bench_parsers.py --compare old.json [new.json] [--threshold PERCENT]
+
+Each parser is timed for --rounds rounds (3 by default) of at least --time seconds (1 by default)
+and the fastest round is reported, which filters out most of the noise of a busy machine.
+--save writes the results as JSON. --compare checks a saved run against another one (or against
+a fresh run) and flags parsers that got slower or need more memory by more than --threshold
+percent (10 by default); the exit code is 1 if anything regressed. Use --lib to run against
+another checkout of src/libs, e.g. the revision before a change.
+'''
+
+from __future__ import print_function
+
+import gzip
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS_DIR = os.path.join(BENCH_DIR, 'corpus')
+DEFAULT_LIB = os.path.join(BENCH_DIR, '..', 'src', 'libs')
+
+# RSS is counted in pages, so growth below this is noise rather than a regression
+MEMORY_SLACK_KB = 1024
+
+def load_manifest():
+  with open(os.path.join(CORPUS_DIR, 'manifest.json')) as f:
+    return json.load(f)
+
+def load_page(name):
+  with gzip.open(os.path.join(CORPUS_DIR, name), 'rb') as f:
+    return f.read()
+
+def max_rss_kb():
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss // 1024 if sys.platform == 'darwin' else rss
+
+def run_worker(parser, lib, min_time, rounds):
+  '''Benchmarks one parser in this process and prints its results as JSON.'''
+  sys.path.insert(0, lib)
+  import tabun_api
+
+  entries = [x for x in load_manifest()['pages'] if x['parser'] == parser]
+  pages = [(load_page(x['file']), dict((str(k), v) for k, v in x['kwargs'].items())) for x in entries]
+  # Parsing does not touch the network, so the constructor (which logs in) is skipped
+  user = tabun_api.User.__new__(tabun_api.User)
+  user.phpsessid = 'bench'
+  user.security_ls_key = 'bench'
+  func = getattr(user, parser)
+
+  base_rss = max_rss_kb()
+  best = None
+  for _ in range(rounds):
+    count = 0
+    size = 0
+    start = time.time()
+    while True:
+      for data, kwargs in pages:
+        if not func(raw_data=data, **kwargs):
+          raise ValueError('%s returned nothing' % parser)
+        count += 1
+        size += len(data)
+      elapsed = time.time() - start
+      if elapsed >= min_time:
+        break
+    if best is None or count / elapsed > best[0] / best[2]:
+      best = (count, size, elapsed)
+
+  count, size, elapsed = best
+  print(json.dumps({
+    'pages': count,
+    'seconds': elapsed,
+    'pages_per_sec': count / elapsed,
+    'mb_per_sec': size / elapsed / 1024.0 / 1024.0,
+    'peak_kb': max_rss_kb() - base_rss,
+  }))
+
+def run_all(parsers, lib, min_time, rounds):
+  manifest = load_manifest()
+  if not parsers:
+    parsers = []
+    for entry in manifest['pages']:
+      if entry['parser'] not in parsers:
+        parsers.append(entry['parser'])
+
+  import lxml.etree
+  results = {
+    'corpus_version': manifest['version'],
+    'python': platform.python_version(),
+    'lxml': '.'.join(str(x) for x in lxml.etree.LXML_VERSION),
+    'libxml2': '.'.join(str(x) for x in lxml.etree.LIBXML_VERSION),
+    'lib': os.path.abspath(lib),
+    'parsers': {},
+  }
+  for parser in parsers:
+    try:
+      output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), '--worker', parser, '--lib', lib, '--time', str(min_time), '--rounds', str(rounds)
+      ])
+    except subprocess.CalledProcessError:
+      # e.g. an older revision of the library whose parser has no raw_data parameter yet
+      print('%s failed, skipped' % parser)
+      continue
+    # the library may print warnings before the result
+    results['parsers'][parser] = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+  return results
+
+def print_results(results):
+  print('Python %s, lxml %s, libxml2 %s, corpus v%d' % (results['python'], results['lxml'], results['libxml2'], results['corpus_version']))
+  print('%-16s %10s %10s %10s' % ('parser', 'pages/s', 'MB/s', 'peak MB'))
+  for parser, r in sorted(results['parsers'].items()):
+    print('%-16s %10.1f %10.2f %10.1f' % (parser, r['pages_per_sec'], r['mb_per_sec'], r['peak_kb'] / 1024.0))
+
+def compare(old, new, threshold):
+  '''Prints the change of every parser from old to new and returns the number of regressions.'''
+  for key in ('corpus_version', 'python', 'lxml'):
+    if old.get(key) != new.get(key):
+      print('Warning: %s differs (%s vs %s), the runs are not directly comparable' % (key, old.get(key), new.get(key)))
+
+  print('%-16s %12s %12s %14s' % ('parser', 'pages/s', 'change', 'peak MB'))
+  regressions = 0
+  for parser in sorted(set(old['parsers']) | set(new['parsers'])):
+    if parser not in old['parsers'] or parser not in new['parsers']:
+      print('%-16s only in the %s run' % (parser, 'old' if parser in old['parsers'] else 'new'))
+      continue
+    a, b = old['parsers'][parser], new['parsers'][parser]
+    speed = (b['pages_per_sec'] / a['pages_per_sec'] - 1) * 100
+    notes = []
+    if speed < -threshold:
+      notes.append('SLOWER')
+    if b['peak_kb'] > a['peak_kb'] * (1 + threshold / 100.0) + MEMORY_SLACK_KB:
+      notes.append('MORE MEMORY')
+    regressions += bool(notes)
+    print('%-16s %5.0f->%-6.0f %+11.1f%% %6.1f->%-6.1f %s' % (
+      parser, a['pages_per_sec'], b['pages_per_sec'], speed, a['peak_kb'] / 1024.0, b['peak_kb'] / 1024.0, ' '.join(notes)
+    ))
+  print('%d regression(s) over %g%%' % (regressions, threshold))
+  return regressions
+
+def main():
+  args = sys.argv[1:]
+  parsers = []
+  lib = DEFAULT_LIB
+  min_time = 1.0
+  rounds = 3
+  save = None
+  compare_with = []
+  threshold = 10.0
+  worker = None
+
+  while args:
+    arg = args.pop(0)
+    if arg == '--parser':
+      parsers.append(args.pop(0))
+    elif arg == '--lib':
+      lib = args.pop(0)
+    elif arg == '--time':
+      min_time = float(args.pop(0))
+    elif arg == '--rounds':
+      rounds = int(args.pop(0))
+    elif arg == '--save':
+      save = args.pop(0)
+    elif arg == '--threshold':
+      threshold = float(args.pop(0))
+    elif arg == '--compare':
+      while args and not args[0].startswith('--'):
+        compare_with.append(args.pop(0))
+    elif arg == '--worker':
+      worker = args.pop(0)
+    else:
+      print(__doc__)
+      return 2
+
+  if worker:
+    run_worker(worker, lib, min_time, rounds)
+    return 0
+
+  if len(compare_with) == 2:
+    with open(compare_with[0]) as f:
+      old = json.load(f)
+    with open(compare_with[1]) as f:
+      new = json.load(f)
+    return 1 if compare(old, new, threshold) else 0
+
+  results = run_all(parsers, lib, min_time, rounds)
+  print_results(results)
+  if save:
+    with open(save, 'w') as f:
+      json.dump(results, f, indent=2, sort_keys=True)
+  if compare_with:
+    with open(compare_with[0]) as f:
+      old = json.load(f)
+    print()
+    return 1 if compare(old, results, threshold) else 0
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
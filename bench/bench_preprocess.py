@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks page preprocessing in tabun_api (utils.preprocess_html) against the previous chain of
+find_substring, replace_cloudflare_emails, escape_topic_contents and escape_comment_contents,
+on synthetic post pages. Checks that both produce the same bytes, then reports time per page and,
+on Python 3, how much memory each pipeline holds at its peak, in page sizes (decoding is left out:
+it costs the same for both).
+
+Usage: python bench/bench_preprocess.py [number of comments per page] [number of pages]
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'libs'))
+from tabun_api import utils
+
+CF_EMAIL = (
+  b'<a class="__cf_email__" href="/cdn-cgi/l/email-protection" data-cfemail="3b5a5b7b5e435a564b575e15585456">'
+  b'[email&#160;protected]</a><script data-cfhash="f9e31" type="text/javascript">/* <![CDATA[ */'
+  b'!function(t,e,r,n,c,a,p){try{t=document.currentScript}catch(u){}}()/* ]]> */</script>'
+)
+
+def make_post_page(comments):
+  '''Builds a post page shaped like the ones Tabun serves, with a topic, comments and encoded emails.'''
+  buf = [
+    b'<!doctype html><html><head><title>Post</title></head><body><div id="content">',
+    b'<article class="topic topic-type-topic js-topic"><header class="topic-header">',
+    b'<h1 class="topic-title word-wrap"><a href="/blog/news/1.html">Title</a></h1>',
+    b'<div class="topic-info"><a href="/blog/news/" class="topic-blog">News</a>',
+    b'<a href="/profile/author/" rel="author">author</a></div></header>',
+    b'<div class="topic-content text"><header>head</header>',
+    u'Текст поста, <b>жирный</b> & "кавычки" '.encode('utf-8') * 40,
+    CF_EMAIL,
+    b' <a href="/blog/1.html#cut" title="', u'Читать дальше">Дальше</a>'.encode('utf-8'),
+    b'</div><footer class="topic-footer"><ul class="topic-info">',
+    b'<li class="topic-info-date"><time datetime="2026-01-01T10:00:00+03:00">1 January</time></li>',
+    b'<li class="topic-info-favourite"><i class="favourite"></i><span class="favourite-count">3</span></li>',
+    b'</ul></footer></article> <!-- /.topic -->',
+    b'<div class="comments" id="comments"><div class="comments-header"><h3>',
+    b'<span id="count-comments">', str(comments).encode('utf-8'), b'</span></h3></div>',
+  ]
+  buf.extend(make_comments(comments))
+  buf.append(b'</div><!-- /content --></body></html>')
+  return b''.join(buf)
+
+def make_comments(count, first_id=1000):
+  '''Returns the markup of count comment wrappers, as a list of byte strings.'''
+  buf = []
+  for i in range(count):
+    comment_id = str(first_id + i).encode('utf-8')
+    buf.extend([
+      b'<div class="comment-wrapper" id="comment_wrapper_id_', comment_id, b'">',
+      b'<section id="comment_id_', comment_id, b'" class="comment">',
+      b'<div id="comment_content_id_', comment_id, b'" class="comment-content">',
+      b'<div class=" text">',
+      u'Коммент <i>номер</i> '.encode('utf-8'), comment_id, b' &amp; <br/>' * 10,
+      CF_EMAIL if i % 7 == 0 else b'',
+      b'</div></div><ul class="comment-info">',
+      b'<li class="comment-author"><a href="/profile/user/">user</a></li>',
+      b'<li class="comment-date"><time datetime="2026-01-01T11:00:00+03:00">1 January</time></li>',
+      b'<li class="comment-link"><a href="#comment', comment_id, b'">#</a></li>',
+      b'</ul></section></div>',
+    ])
+  return buf
+
+def preprocess_legacy(raw_data):
+  '''The chain get_comments used to run: four full copies before the page even gets decoded.'''
+  raw_data = utils.find_substring(raw_data, b'<div class="comments', b'<!-- /content -->', extend=True, with_end=False)
+  raw_data = utils.replace_cloudflare_emails(raw_data)
+  return escape_comment_contents_legacy(escape_topic_contents_legacy(raw_data, True))
+
+def preprocess_single_pass(raw_data):
+  region = utils.find_region(raw_data, b'<div class="comments', b'<!-- /content -->', extend=True, with_end=False)
+  return utils.preprocess_html(raw_data, region[0], region[1], escape_topics=True, may_be_short=True, escape_comments=True)
+
+def escape_body_legacy(body):
+  return body.replace(b'&', b'&amp;').replace(b'<', b'&lt;').replace(b'>', b'&gt;').replace(b'"', b'&quot;')
+
+def escape_topic_contents_legacy(data, may_be_short=False):
+  '''Copy of utils.escape_topic_contents before it moved to preprocess_html.'''
+  last_end = 0
+  buf = []
+  while True:
+    f1 = data.find(b'<div class="topic-content text">', last_end)
+    if f1 < 0:
+      break
+    f2 = data.find(b'<footer', f1)
+    if f2 < 0:
+      break
+    f2 = data.rfind(b'</div>', f1, f2)
+    if f2 < 0:
+      break
+    if data.rfind(b'<div class="topic-url"', f1, f2) > 0:
+      f2 = data.rfind(b'</div>', f1, data.rfind(b'<div class="topic-url"', f1, f2))
+      if f2 < 0:
+        break
+    if data.rfind(b'<div class="download"', f1, f2) > 0:
+      f2 = data.rfind(b'</div>', f1, data.rfind(b'<div class="download"', f1, f2))
+      if f2 < 0:
+        break
+    body = data[data.find(b'>', f1) + 1:f2].strip()
+    short = None
+    if may_be_short:
+      fa = body.rfind(utils.read_more_link)
+      if fa > 0:
+        fa2 = body.find(b'</a>', fa)
+        if fa2 > 0 and fa2 == len(body) - 4:
+          short = body[body.find(b">", fa) + 1:fa2].strip()
+          body = body[:body.rfind(b'<', 0, fa)].rstrip()
+    if body.startswith(b'<header'):
+      body = body[body.find(b'</header>') + 9:].lstrip()
+    buf.extend((
+      data[last_end:f1],
+      (u'<div class="topic-content text" data-escaped="1" data-short="%s" data-short-text="%s">' % (
+        1 if short is not None else 0, short.decode('utf-8') if short is not None else u''
+      )).encode('utf-8'),
+      escape_body_legacy(body),
+      b'</div>'
+    ))
+    last_end = f2 + 6
+  buf.append(data[last_end:])
+  return b''.join(buf)
+
+def escape_comment_contents_legacy(data):
+  '''Copy of utils.escape_comment_contents before it moved to preprocess_html.'''
+  last_end = 0
+  buf = []
+  while True:
+    f1 = data.find(b'class="comment-content">', last_end)
+    if f1 >= 0:
+      f = data.find(b'<div class=" text">', f1, f1 + 150)
+      if f < 0:
+        f1 = data.find(b'<div class="text">', f1, f1 + 150)
+      else:
+        f1 = f
+    if f1 < 0:
+      break
+    f2 = data.find(b'<div id="info_edit_', f1)
+    if f2 < 0:
+      f2 = data.find(b'<div class="comment-path', f1)
+    if f2 < 0:
+      f2 = data.find(b'<ul class="comment-info', f1)
+    if f2 < 0:
+      break
+    f2 = data.rfind(b'</div>', f1, f2)
+    if f2 >= 0:
+      f2 = data.rfind(b'</div>', f1, f2)
+    if f2 < 0:
+      break
+    body = escape_body_legacy(data[data.find(b'>', f1) + 1:f2].strip())
+    buf.extend((data[last_end:f1], b'<div class="text" data-escaped="1">', body, b'</div>'))
+    last_end = f2 + 6
+  buf.append(data[last_end:])
+  return b''.join(buf)
+
+def measure(func, pages):
+  start = time.time()
+  for page in pages:
+    func(page).decode('utf-8', 'replace')
+  return time.time() - start
+
+def peak_copies(func, page):
+  '''Peak memory allocated while preprocessing the page, in page sizes.'''
+  tracemalloc.start()
+  func(page)
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return float(peak) / len(page)
+
+def main():
+  comments = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+  count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+  page = make_post_page(comments)
+  legacy_result = preprocess_legacy(page)
+  single_pass_result = preprocess_single_pass(page)
+  if bytes(single_pass_result) != legacy_result:
+    print('MISMATCH: preprocess_html output differs from the legacy chain')
+    return 1
+  pages = [page] * count
+  legacy = measure(preprocess_legacy, pages)
+  single_pass = measure(preprocess_single_pass, pages)
+  print('page of %d comments, %d KB; %d pages' % (comments, len(page) // 1024, count))
+  print('legacy      %.2f ms/page' % (legacy * 1000 / count))
+  print('single pass %.2f ms/page (%.1fx)' % (single_pass * 1000 / count, legacy / single_pass))
+  if tracemalloc is not None:
+    print('peak allocations, in page sizes: legacy %.1f, single pass %.1f' % (
+      peak_copies(preprocess_legacy, page), peak_copies(preprocess_single_pass, page)
+    ))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
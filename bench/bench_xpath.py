@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks comment parsing in tabun_api with the precompiled XPath registry (utils.xpath)
+against calling node.xpath with the expression string, which recompiles it for every element.
+Both variants must produce the same comments.
+
+Usage: python bench/bench_xpath.py [saved page.html] [number of runs]
+Without a saved page, a 1000-comment post page from bench_preprocess.make_post_page is used.
+'''
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src', 'libs'))
+import tabun_api
+from tabun_api import utils
+from bench_preprocess import make_post_page
+
+def uncompiled_xpath(node, expr):
+  return node.xpath(expr)
+
+def comment_fields(comments):
+  return sorted(
+    (c.comment_id, c.author, c.time, c.vote, c.parent_id, c.raw_body, c.favourite)
+    for c in comments.values()
+  )
+
+def measure(user, page, runs):
+  start = time.time()
+  for _ in range(runs):
+    comments = user.get_comments('/blog/news/1.html', raw_data=page)
+  return (time.time() - start) / runs, comments
+
+def main():
+  if len(sys.argv) > 1 and not sys.argv[1].isdigit():
+    with open(sys.argv[1], 'rb') as f:
+      page = f.read()
+    args = sys.argv[2:]
+  else:
+    page = make_post_page(1000)
+    args = sys.argv[1:]
+  runs = int(args[0]) if args else 10
+
+  # Parsing does not touch the network, so the constructor (which logs in) is skipped
+  user = tabun_api.User.__new__(tabun_api.User)
+  compiled_xpath = utils.xpath
+  try:
+    utils.xpath = uncompiled_xpath
+    uncompiled, uncompiled_comments = measure(user, page, runs)
+  finally:
+    utils.xpath = compiled_xpath
+  compiled, compiled_comments = measure(user, page, runs)
+
+  if comment_fields(compiled_comments) != comment_fields(uncompiled_comments):
+    print('MISMATCH: comments differ between compiled and uncompiled XPath')
+    return 1
+  count = len(compiled_comments)
+  print('%d comments, %d KB page, %d runs' % (count, len(page) // 1024, runs))
+  print('node.xpath  %.1f ms/page, %d comments/s' % (uncompiled * 1000, count / uncompiled))
+  print('registry    %.1f ms/page, %d comments/s (%.2fx)' % (compiled * 1000, count / compiled, uncompiled / compiled))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
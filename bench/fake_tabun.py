@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+A stand-in Tabun (LiveStreet) server for end-to-end and load testing, with no real site involved.
+It keeps users, posts, polls, comments and private messages in memory and implements the endpoints
+tabun_api.User touches during an Art-Battle:
+
+  GET  /                                  front page with the security key and the user panel
+  POST /login/ajax-login                  log in (any password is accepted)
+  POST /topic/add/, /question/add/        create a post or a poll, 302 to it
+  POST /topic/edit/<id>/                  edit a post, 302 to it
+  GET  /blog/[<blog>/]<id>.html           a post with its poll and comments
+  GET  /blog/<blog>/, /index/newall/      post lists
+  GET  /profile/<user>/created/topics/    posts of a user (add_post looks there after an error)
+  GET  /topic/saved/                      drafts of the current user
+  POST /ajax/vote/question/               vote in a poll
+  POST /blog/ajaxaddcomment/              add a comment
+  POST /blog/ajaxresponsecomment/         comments newer than a given one
+  GET  /talk/inbox/[page<n>/]             private messages
+  GET  /talk/read/<id>/                   a conversation
+  GET  /_fake/stats                       request counters of this server, as JSON
+
+Latency and failures can be injected: every response is delayed by --latency seconds (+- --jitter
+of it); --fail-rate of the requests get a 503 without being applied, and --ghost-rate of the POSTs
+are applied but answered with a 502, like a timeout after the site already saved the post.
+
+Usage: python bench/fake_tabun.py [--port 0] [--latency 0.05] [--jitter 0.5] [--fail-rate 0] [--ghost-rate 0] [--seed 1]
+The server prints "Listening on http://127.0.0.1:<port>/" once it accepts requests.
+'''
+
+from __future__ import print_function, unicode_literals
+
+import json
+import random
+import re
+import sys
+import threading
+import time
+from xml.sax.saxutils import escape
+
+try:
+  from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+  from SocketServer import ThreadingMixIn
+  from urlparse import parse_qs
+except ImportError:
+  from http.server import HTTPServer, BaseHTTPRequestHandler
+  from socketserver import ThreadingMixIn
+  from urllib.parse import parse_qs
+
+BLOGS = {1: 'news', 2: 'art', 3: 'borderline'}
+MONTHS = ('января', 'февраля', 'марта', 'апреля', 'мая', 'июня', 'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря')
+
+post_url = re.compile(r'^/blog/(?:([A-Za-z0-9_.-]+)/)?([0-9]+)\.html$')
+edit_url = re.compile(r'^/topic/edit/([0-9]+)/$')
+blog_url = re.compile(r'^/blog/([A-Za-z0-9_.-]+)/$')
+inbox_url = re.compile(r'^/talk/inbox/(?:page([0-9]+)/)?$')
+talk_url = re.compile(r'^/talk/read/([0-9]+)/$')
+created_url = re.compile(r'^/profile/([A-Za-z0-9_.-]+)/created/topics/$')
+form_name = re.compile(br'name="([^"]*)"')
+
+def iso_date(t):
+  return time.strftime('%Y-%m-%dT%H:%M:%S+03:00', time.localtime(t))
+
+def ru_date(t, with_time=True):
+  tm = time.localtime(t)
+  result = '%d %s %d' % (tm.tm_mday, MONTHS[tm.tm_mon - 1], tm.tm_year)
+  return result + time.strftime(', %H:%M', tm) if with_time else result
+
+def parse_multipart(body, content_type):
+  '''Parses a multipart/form-data body into a dict of lists of text values.'''
+  boundary = content_type.split('boundary=', 1)[1].strip().strip('"').encode('utf-8')
+  fields = {}
+  for part in body.split(b'--' + boundary):
+    head, sep, value = part.partition(b'\r\n\r\n')
+    name = form_name.search(head)
+    if not sep or not name:
+      continue
+    if value.endswith(b'\r\n'):
+      value = value[:-2]
+    fields.setdefault(name.group(1).decode('utf-8'), []).append(value.decode('utf-8', 'replace'))
+  return fields
+
+
+class FakeTabun(object):
+  '''The site's state. All methods must be called with lock held.'''
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.sessions = {}  # session id -> {'username': ..., 'key': security_ls_key}
+    self.posts = {}
+    self.comments = []
+    self.talks = {}
+    self.next_id = 1000
+    self.requests = {}
+    self.started = time.time()
+    for i in range(30):
+      self.talks[500 + i] = {
+        'id': 500 + i, 'title': 'Сообщение %d' % i, 'author': 'organizer', 'date': time.time() - i * 3600,
+        'recipients': ['organizer', 'admin'], 'body': 'Текст сообщения %d' % i, 'unread': i % 3 == 0,
+      }
+
+  def new_id(self):
+    self.next_id += 1
+    return self.next_id
+
+  def new_session(self):
+    sid = '%032x' % random.getrandbits(128)
+    self.sessions[sid] = {'username': None, 'key': '%032x' % random.getrandbits(128)}
+    return sid
+
+  def add_post(self, username, fields, poll=False):
+    post_id = self.new_id()
+    blog_id = int(fields.get('blog_id', ['0'])[0] or 0)
+    self.posts[post_id] = {
+      'id': post_id, 'blog': BLOGS.get(blog_id), 'author': username, 'date': time.time(),
+      'title': fields.get('topic_title', [''])[0], 'body': fields.get('topic_text', [''])[0],
+      'tags': [x.strip() for x in fields.get('topic_tags', [''])[0].split(',') if x.strip()],
+      'draft': 'submit_topic_save' in fields,
+      'poll': [[x, 0] for x in fields.get('answer[]', [])] if poll else None,
+      'voters': {}, 'abstained': 0,
+    }
+    return self.posts[post_id]
+
+  def post_link(self, post):
+    return '/blog/%s/%d.html' % (post['blog'], post['id']) if post['blog'] else '/blog/%d.html' % post['id']
+
+  # rendering
+
+  def page(self, session, title, content):
+    user = session['username'] if session else None
+    if user:
+      panel = (
+        '<div class="dropdown-user" id="dropdown-user"><a href="/profile/%(u)s/"><img src="/ava.png" /></a>'
+        '<a href="/profile/%(u)s/" class="username">%(u)s</a>'
+        '<ul class="dropdown-user-menu"><li class="item-messages"><a href="/talk/" class="new-messages">+1</a></li>'
+        '<li class="item-stat"><span class="strength">120.50</span> <span class="rating">35.20</span></li></ul></div>' % {'u': user}
+      )
+    else:
+      panel = '<ul class="auth"><li><a href="/login/">Войти</a></li></ul>'
+    return (
+      '<!doctype html><html><head><title>%s</title><script>var LIVESTREET_SECURITY_KEY = \'%s\';</script></head>'
+      '<body><div id="header">%s<nav id="nav"></nav></div><div id="container"><div id="wrapper"><div id="content">%s'
+      '</div><!-- /content --></div></div></body></html>' % (escape(title), session['key'] if session else '', panel, content)
+    )
+
+  def render_poll(self, post):
+    total = sum(x[1] for x in post['poll'])
+    items = ''.join(
+      '<li><dl><dt><strong>%.1f%%</strong><br/><span>(%d)</span></dt><dd>%s</dd></dl></li>' % (
+        100.0 * votes / total if total else 0.0, votes, escape(choice)
+      ) for choice, votes in post['poll']
+    )
+    return '<ul class="poll-result">%s</ul><div class="poll-total">Проголосовало: %d<br/>Воздержалось: %d</div>' % (
+      items, total, post['abstained']
+    )
+
+  def render_post(self, post, short):
+    body = post['body']
+    if short and '<cut>' in body:
+      body = body.split('<cut>', 1)[0] + '<a href="%s#cut" title="Читать дальше">Читать дальше</a>' % self.post_link(post)
+    poll = ''
+    if post['poll'] is not None:
+      poll = '<div id="topic_question_area_%d" class="poll">%s</div>' % (post['id'], self.render_poll(post))
+    blog = post['blog'] or post['author']
+    return (
+      '<article class="topic topic-type-topic js-topic"><header class="topic-header">'
+      '<h1 class="topic-title word-wrap">%(draft)s<a href="%(link)s">%(title)s</a></h1>'
+      '<div class="topic-info"><a href="/blog/%(blog)s/" class="topic-blog">%(blog)s</a> '
+      '<a href="/profile/%(author)s/" rel="author">%(author)s</a></div></header>'
+      '%(poll)s<div class="topic-content text">%(body)s</div>'
+      '<footer class="topic-footer"><p class="topic-tags">%(tags)s</p><ul class="topic-info">'
+      '<li class="topic-info-date"><time datetime="%(date)s">%(date)s</time></li>'
+      '<li class="topic-info-favourite"><i class="favourite"></i><span class="favourite-count">0</span></li>'
+      '<li class="topic-info-comments"><a href="%(link)s#comments"><i class="icon-synio-comments-green-filled"></i>'
+      '<span>%(comments)d</span></a></li></ul></footer></article> <!-- /.topic -->' % {
+        'draft': '<i class="icon-synio-topic-draft"></i>' if post['draft'] else '', 'link': self.post_link(post),
+        'title': escape(post['title']), 'blog': blog, 'author': post['author'], 'body': body, 'poll': poll,
+        'tags': ', '.join('<a rel="tag" href="/tag/%s/">%s</a>' % (escape(x), escape(x)) for x in post['tags']),
+        'date': iso_date(post['date']), 'comments': len([c for c in self.comments if c['post_id'] == post['id']]),
+      }
+    )
+
+  def render_comment(self, comment):
+    return (
+      '<section id="comment_id_%(id)d" class="comment"><div id="comment_content_id_%(id)d" class="comment-content">'
+      '<div class=" text">%(body)s</div></div><ul class="comment-info">'
+      '<li class="comment-author"><a href="/profile/%(author)s/">%(author)s</a></li>'
+      '<li class="comment-date"><time datetime="%(date)s">%(date)s</time></li>'
+      '<li class="comment-link"><a href="#comment%(id)d">#</a></li></ul></section>' % {
+        'id': comment['id'], 'body': comment['body'], 'author': comment['author'], 'date': iso_date(comment['date']),
+      }
+    )
+
+  def render_comments(self, comments):
+    return '<div class="comments" id="comments"><div class="comments-header"><h3><span id="count-comments">%d</span></h3></div>%s</div>' % (
+      len(comments), ''.join('<div class="comment-wrapper" id="comment_wrapper_id_%d">%s</div>' % (
+        c['id'], self.render_comment(c)
+      ) for c in comments)
+    )
+
+  def render_inbox(self, page):
+    talks = sorted(self.talks.values(), key=lambda x: -x['id'])[(page - 1) * 20:page * 20]
+    rows = ''.join(
+      '<tr><td class="cell-checkbox"><input type="checkbox" /></td><td class="cell-recipients">%s</td>'
+      '<td class="cell-title"><a href="/talk/read/%d/">%s</a></td><td class="cell-date ta-r">%s</td></tr>' % (
+        ' '.join('<a href="/profile/%s/" class="username">%s</a>' % (x, x) for x in t['recipients']),
+        t['id'], '<strong>%s</strong>' % escape(t['title']) if t['unread'] else escape(t['title']), ru_date(t['date'], False)
+      ) for t in talks
+    )
+    return '<table class="table table-talk"><thead><tr><th></th><th></th><th></th><th></th></tr></thead><tbody>%s</tbody></table>' % rows
+
+  def render_talk(self, talk):
+    return (
+      '<article class="topic topic-type-talk"><header class="topic-header"><h1 class="topic-title">%s</h1></header>'
+      '<div class="talk-search talk-recipients"><header><a href="#" class="link-dotted">Участники</a>: %s</header></div>'
+      '<div class="topic-content text">%s</div><footer class="topic-footer"><ul class="topic-info">'
+      '<li class="topic-info-author"><a href="/profile/%s/"><img src="/ava.png" /></a><a href="/profile/%s/" class="username">%s</a></li>'
+      '<li class="topic-info-date"><time datetime="%s">%s</time></li></ul></footer></article>' % (
+        escape(talk['title']), ' '.join('<a href="/profile/%s/" class="username">%s</a>' % (x, x) for x in talk['recipients']),
+        escape(talk['body']), talk['author'], talk['author'], talk['author'], iso_date(talk['date']), iso_date(talk['date'])
+      )
+    ) + self.render_comments([])
+
+
+class Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  server_version = 'FakeTabun/1.0'
+  # headers and body in one segment, otherwise Nagle's algorithm and delayed ACKs add 40 ms to keep-alive requests
+  wbufsize = -1
+
+  def log_message(self, *args):
+    pass
+
+  def reply(self, code, body=b'', content_type='text/html; charset=utf-8', headers=()):
+    if not isinstance(body, bytes):
+      body = body.encode('utf-8')
+    self.send_response(code)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    for name, value in headers:
+      self.send_header(name, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def reply_json(self, data, headers=()):
+    self.reply(200, json.dumps(data), 'application/json', headers)
+
+  def cookies(self):
+    result = {}
+    for part in (self.headers.get('Cookie') or '').split(';'):
+      name, sep, value = part.strip().partition('=')
+      if sep:
+        result[name] = value
+    return result
+
+  def read_fields(self):
+    body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+    content_type = self.headers.get('Content-Type') or ''
+    if content_type.startswith('multipart/form-data'):
+      return parse_multipart(body, content_type)
+    return dict((k, v) for k, v in parse_qs(body.decode('utf-8')).items())
+
+  def handle_request(self, method):
+    server = self.server
+    site = server.site
+    path = self.path.split('?', 1)[0]
+    fields = self.read_fields() if method == 'POST' else {}
+    with site.lock:
+      key = '%s %s' % (method, re.sub(r'[0-9]+', 'N', path))
+      site.requests[key] = site.requests.get(key, 0) + 1
+
+    if path == '/_fake/stats':
+      with site.lock:
+        return self.reply_json({'uptime': time.time() - site.started, 'requests': site.requests, 'posts': len(site.posts)})
+
+    if server.latency > 0:
+      time.sleep(max(0, random.uniform(server.latency * (1 - server.jitter), server.latency * (1 + server.jitter))))
+    if random.random() < server.fail_rate:
+      return self.reply(503, '<h1>503 Service Temporarily Unavailable</h1>')
+    ghost = method == 'POST' and random.random() < server.ghost_rate
+
+    code, body, content_type, headers = self.dispatch(method, path, fields)
+    if ghost:
+      return self.reply(502, '<h1>502 Bad Gateway</h1>')
+    self.reply(code, body, content_type, headers)
+
+  def dispatch(self, method, path, fields):
+    '''Returns (status, body, content type, headers).'''
+    site = self.server.site
+    html = 'text/html; charset=utf-8'
+    with site.lock:
+      headers = []
+      sid = self.cookies().get('TABUNSESSIONID')
+      session = site.sessions.get(sid)
+      if session is None:
+        sid = site.new_session()
+        session = site.sessions[sid]
+        headers.append(('Set-Cookie', 'TABUNSESSIONID=%s; path=/' % sid))
+
+      if method == 'POST' and path != '/login/ajax-login' and fields.get('security_ls_key', [None])[0] != session['key']:
+        return 200, json.dumps({'bStateError': True, 'sMsg': 'Hacking attempt!'}), 'application/json', headers
+
+      if method == 'GET' and path in ('/', '/index/newall/'):
+        posts = sorted(site.posts.values(), key=lambda x: -x['id'])[:10]
+        return 200, site.page(session, 'Табун', ''.join(site.render_post(p, True) for p in posts)), html, headers
+
+      if method == 'POST' and path == '/login/ajax-login':
+        session['username'] = fields.get('login', [''])[0]
+        headers.append(('Set-Cookie', 'key=%032x; path=/' % random.getrandbits(128)))
+        return 200, json.dumps({'bStateError': False, 'sUrlRedirect': '/'}), 'application/json', headers
+
+      if session['username'] is None:
+        if method == 'POST':
+          return 200, json.dumps({'bStateError': True, 'sMsg': 'Need authorization'}), 'application/json', headers
+        if path.startswith('/talk/'):
+          return 302, '', html, headers + [('Location', '/login/')]
+
+      m = post_url.match(path)
+      if method == 'GET' and m and int(m.group(2)) in site.posts:
+        post = site.posts[int(m.group(2))]
+        comments = [c for c in site.comments if c['post_id'] == post['id']]
+        return 200, site.page(session, post['title'], site.render_post(post, False) + site.render_comments(comments)), html, headers
+
+      m = blog_url.match(path)
+      if method == 'GET' and m:
+        posts = sorted((x for x in site.posts.values() if x['blog'] == m.group(1)), key=lambda x: -x['id'])[:10]
+        return 200, site.page(session, m.group(1), ''.join(site.render_post(p, True) for p in posts)), html, headers
+
+      m = created_url.match(path)
+      if method == 'GET' and (m or path == '/topic/saved/'):
+        author = m.group(1) if m else session['username']
+        posts = sorted(
+          (x for x in site.posts.values() if x['author'] == author and x['draft'] == (not m)), key=lambda x: -x['id']
+        )[:10]
+        return 200, site.page(session, author, ''.join(site.render_post(p, True) for p in posts)), html, headers
+
+      if method == 'POST' and path in ('/topic/add/', '/question/add/'):
+        post = site.add_post(session['username'], fields, poll=path == '/question/add/')
+        return 302, '', html, headers + [('Location', 'http://%s%s' % (self.headers.get('Host'), site.post_link(post)))]
+
+      m = edit_url.match(path)
+      if method == 'POST' and m and int(m.group(1)) in site.posts:
+        post = site.posts[int(m.group(1))]
+        post.update({
+          'title': fields.get('topic_title', [post['title']])[0], 'body': fields.get('topic_text', [post['body']])[0],
+          'draft': 'submit_topic_save' in fields,
+        })
+        return 302, '', html, headers + [('Location', 'http://%s%s' % (self.headers.get('Host'), site.post_link(post)))]
+
+      if method == 'POST' and path == '/ajax/vote/question/':
+        post = site.posts.get(int(fields.get('idTopic', ['0'])[0]))
+        if post is None or post['poll'] is None:
+          return 200, json.dumps({'bStateError': True, 'sMsg': 'Опрос не найден'}), 'application/json', headers
+        if session['username'] in post['voters']:
+          return 200, json.dumps({'bStateError': True, 'sMsg': 'Вы уже голосовали!'}), 'application/json', headers
+        answer = int(fields.get('idAnswer', ['-1'])[0])
+        post['voters'][session['username']] = answer
+        if 0 <= answer < len(post['poll']):
+          post['poll'][answer][1] += 1
+        else:
+          post['abstained'] += 1
+        return 200, json.dumps({'bStateError': False, 'sText': site.render_poll(post)}), 'application/json', headers
+
+      if method == 'POST' and path == '/blog/ajaxaddcomment/':
+        comment = {
+          'id': site.new_id(), 'post_id': int(fields.get('cmt_target_id', ['0'])[0]), 'author': session['username'],
+          'body': escape(fields.get('comment_text', [''])[0]), 'parent_id': int(fields.get('reply', ['0'])[0]) or None,
+          'date': time.time(),
+        }
+        site.comments.append(comment)
+        return 200, json.dumps({'bStateError': False, 'sCommentId': comment['id']}), 'application/json', headers
+
+      if method == 'POST' and path == '/blog/ajaxresponsecomment/':
+        post_id = int(fields.get('idTarget', ['0'])[0])
+        last = int(fields.get('idCommentLast', ['0'])[0])
+        comments = [c for c in site.comments if c['post_id'] == post_id and c['id'] > last]
+        return 200, json.dumps({'bStateError': False, 'iMaxIdComment': max([last] + [c['id'] for c in comments]), 'aComments': [
+          {'id': c['id'], 'idParent': c['parent_id'], 'html': site.render_comment(c)} for c in comments
+        ]}), 'application/json', headers
+
+      m = inbox_url.match(path)
+      if method == 'GET' and m:
+        return 200, site.page(session, 'Почта', site.render_inbox(int(m.group(1) or 1))), html, headers
+
+      m = talk_url.match(path)
+      if method == 'GET' and m and int(m.group(1)) in site.talks:
+        talk = site.talks[int(m.group(1))]
+        talk['unread'] = False
+        return 200, site.page(session, talk['title'], site.render_talk(talk)), html, headers
+
+      return 404, site.page(session, '404', '<h1>Страница не найдена</h1>'), html, headers
+
+  def do_GET(self):
+    self.handle_request('GET')
+
+  def do_POST(self):
+    self.handle_request('POST')
+
+
+class FakeTabunServer(ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+  request_queue_size = 128
+
+  def __init__(self, address=('127.0.0.1', 0), latency=0.0, jitter=0.5, fail_rate=0.0, ghost_rate=0.0):
+    HTTPServer.__init__(self, address, Handler)
+    self.site = FakeTabun()
+    self.latency = latency
+    self.jitter = jitter
+    self.fail_rate = fail_rate
+    self.ghost_rate = ghost_rate
+
+  @property
+  def url(self):
+    return 'http://%s:%d' % self.server_address[:2]
+
+def main():
+  args = sys.argv[1:]
+  options = {'--port': 0, '--latency': 0.05, '--jitter': 0.5, '--fail-rate': 0.0, '--ghost-rate': 0.0, '--seed': 1}
+  while args:
+    arg = args.pop(0)
+    if arg not in options or not args:
+      print(__doc__)
+      return 2
+    options[arg] = type(options[arg])(args.pop(0))
+  random.seed(options['--seed'])
+
+  server = FakeTabunServer(
+    ('127.0.0.1', options['--port']), options['--latency'], options['--jitter'], options['--fail-rate'], options['--ghost-rate']
+  )
+  print('Listening on %s/' % server.url)
+  sys.stdout.flush()
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Runs many Art-Battles at once against a fake Tabun (see fake_tabun.py) and reports the throughput
+and the latency percentiles of every step of the battle lifecycle.
+
+main.py itself needs the App Engine runtime (ndb, webapp2, jinja2), so each battle replays the
+tabun_api calls the ArtBattle methods make, with the same arguments and error handling:
+post_announcement, post_battle, set_theme, parse_tabun_messages (inbox and messages), post_poll,
+votes of --voters users (a "#N" comment and a poll vote each), count_votes, count_votes_comments
+and post_results. Like ArtBattleState.get_admin, every battle makes a fresh User from the saved
+session of one logged in admin.
+
+Usage:
+  python bench/load_battles.py [--battles 20] [--concurrency 5] [--voters 10] [--participants 6]
+    [--latency 0.05] [--jitter 0.5] [--fail-rate 0] [--ghost-rate 0] [--url http://host:port] [--lib path/to/libs]
+
+Unless --url is given, a fake Tabun is started on a free port with the --latency, --jitter,
+--fail-rate and --ghost-rate options (see fake_tabun.py) and stopped at the end.
+'''
+
+from __future__ import print_function, unicode_literals
+
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+try:
+  from urllib2 import urlopen
+except ImportError:
+  from urllib.request import urlopen
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_LIB = os.path.join(BENCH_DIR, '..', 'src', 'libs')
+BLOG_ID = 2
+
+clock = getattr(time, 'monotonic', time.time)
+
+def percentile(samples, p):
+  '''Nearest-rank percentile of a sorted list.'''
+  if not samples:
+    return None
+  return samples[min(len(samples) - 1, max(0, int(round(p / 100.0 * len(samples))) - 1))]
+
+
+class Recorder(object):
+  '''Collects (step, seconds) samples and errors from all battle threads.'''
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.samples = {}
+    self.errors = {}
+
+  def step(self, name, func, *args, **kwargs):
+    start = clock()
+    try:
+      return func(*args, **kwargs)
+    except Exception as e:
+      with self.lock:
+        self.errors.setdefault(name, []).append('%s: %s' % (type(e).__name__, e))
+      raise
+    finally:
+      elapsed = clock() - start
+      with self.lock:
+        self.samples.setdefault(name, []).append(elapsed)
+
+
+def start_server(options):
+  '''Starts fake_tabun.py in a subprocess and returns (process, url).'''
+  args = [sys.executable, os.path.join(BENCH_DIR, 'fake_tabun.py')]
+  for name in ('--latency', '--jitter', '--fail-rate', '--ghost-rate'):
+    args += [name, str(options[name])]
+  process = subprocess.Popen(args, stdout=subprocess.PIPE)
+  line = process.stdout.readline().decode('utf-8').strip()
+  if not line.startswith('Listening on '):
+    process.kill()
+    raise RuntimeError('fake_tabun.py did not start: %r' % line)
+  return process, line.split(' ', 2)[2].rstrip('/')
+
+def server_requests(url):
+  data = json.loads(urlopen(url + '/_fake/stats').read().decode('utf-8'))
+  return sum(data['requests'].values())
+
+def login(tabun_api, url, username, retry, attempts=5):
+  '''Logs in, retrying injected failures: the login POST is not retried by tabun_api itself.'''
+  for attempt in range(attempts):
+    try:
+      return tabun_api.User(login=username, passwd='password', http_host=url, retry=retry)
+    except tabun_api.TabunError:
+      if attempt == attempts - 1:
+        raise
+
+def run_battle(tabun_api, n, admin, voters, participants, retry, rec):
+  '''The tabun_api calls of one Art-Battle, from the announcement to the results.'''
+  date = '2026-%02d-%02d #%d' % (n % 12 + 1, n % 28 + 1, n)
+  user = tabun_api.User(
+    login=admin.username, phpsessid=admin.phpsessid, security_ls_key=admin.security_ls_key, key=admin.key, http_host=admin.http_host,
+    retry=retry,
+  )
+
+  def add_post(title, draft):
+    ret = user.add_post(BLOG_ID, title, '<p>%s</p>' % title, 'Арт-Баттл, %s' % date, draft, check_if_error=True)
+    if not ret[1]:
+      raise tabun_api.TabunError(msg='Post %s was not created' % title)
+    return ret[1]
+
+  rec.step('post_announcement', add_post, 'Объявление Арт-Баттла %s' % date, False)
+  battle_post_id = rec.step('post_battle', add_post, 'Арт-Баттл %s' % date, True)
+  rec.step('set_theme', user.edit_post, battle_post_id, BLOG_ID, 'Арт-Баттл %s' % date, '<p>Тема: %d</p>' % n, 'Арт-Баттл', False)
+
+  def parse_messages():
+    talks = list(itertools.islice(user.iter_talk_list(), participants))
+    return [user.get_talk(x.talk_id) for x in talks]
+  rec.step('parse_tabun_messages', parse_messages)
+
+  def post_poll():
+    choices = ['Участник %d' % (i + 1) for i in range(participants)]
+    title = 'Голосование за Арт-Баттл %s' % date
+    ret = user.add_poll(BLOG_ID, title, choices, '<p>%s</p>' % title, 'Арт-Баттл, голосование', False, check_if_error=True)
+    if not ret[1]:
+      raise tabun_api.TabunError(msg='Poll post for Art-Battle %s was not created' % date)
+    user.poll_answer(ret[1], -1)
+    return ret[1]
+  poll_post_id = rec.step('post_poll', post_poll)
+
+  for voter in voters:
+    choice = random.randrange(participants)
+    rec.step('vote', voter.comment, poll_post_id, '#%d' % (choice + 1))
+    rec.step('vote', voter.poll_answer, poll_post_id, choice)
+
+  def count_votes():
+    try:
+      poll = user.poll_answer(poll_post_id, -1)
+    except tabun_api.TabunResultError:
+      poll = user.get_post(poll_post_id).poll
+    if poll.total != len(voters):
+      raise ValueError('%d votes instead of %d' % (poll.total, len(voters)))
+  rec.step('count_votes', count_votes)
+  rec.step('count_votes_comments', user.get_comments_from, poll_post_id, 0)
+  rec.step('post_results', add_post, 'Итоги голосования за Арт-Баттл %s' % date, False)
+
+def run(tabun_api, url, options):
+  rec = Recorder()
+  # shared by all users, so that retried counts the retries of the whole run
+  retry = tabun_api.ratelimit.RetryPolicy()
+  admin = login(tabun_api, url, 'organizer', retry)
+  voters = [login(tabun_api, url, 'voter%d' % i, retry) for i in range(options['--voters'])]
+  battles = iter(range(options['--battles']))
+  battles_lock = threading.Lock()
+  failed = []
+
+  def worker():
+    while True:
+      with battles_lock:
+        n = next(battles, None)
+      if n is None:
+        return
+      try:
+        rec.step('battle', run_battle, tabun_api, n, admin, voters, options['--participants'], retry, rec)
+      except Exception:
+        failed.append(n)
+        if options['--verbose']:
+          traceback.print_exc()
+
+  requests_before = server_requests(url)
+  start = clock()
+  threads = [threading.Thread(target=worker) for _ in range(options['--concurrency'])]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  elapsed = clock() - start
+  requests = server_requests(url) - requests_before
+
+  done = options['--battles'] - len(failed)
+  print('%d battles (%d failed) in %.2f s with %d at once: %.2f battles/s, %d requests, %.1f requests/s' % (
+    options['--battles'], len(failed), elapsed, options['--concurrency'], done / elapsed, requests, requests / elapsed
+  ))
+  if retry.retried:
+    print('Retried requests: %d' % retry.retried)
+  print()
+  print('%-22s %6s %6s %9s %9s %9s %9s' % ('step', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms'))
+  steps = [
+    'post_announcement', 'post_battle', 'set_theme', 'parse_tabun_messages', 'post_poll', 'vote',
+    'count_votes', 'count_votes_comments', 'post_results', 'battle',
+  ]
+  for name in steps:
+    samples = sorted(rec.samples.get(name, ()))
+    if not samples:
+      continue
+    print('%-22s %6d %6d %9.1f %9.1f %9.1f %9.1f' % (
+      name, len(samples), len(rec.errors.get(name, ())),
+      percentile(samples, 50) * 1000, percentile(samples, 95) * 1000, percentile(samples, 99) * 1000, samples[-1] * 1000
+    ))
+  for name in steps:
+    for error in sorted(set(rec.errors.get(name, ())))[:3]:
+      print('%s: %s' % (name, error))
+  return 1 if failed else 0
+
+def main():
+  args = sys.argv[1:]
+  options = {
+    '--battles': 20, '--concurrency': 5, '--voters': 10, '--participants': 6,
+    '--latency': 0.05, '--jitter': 0.5, '--fail-rate': 0.0, '--ghost-rate': 0.0,
+    '--url': '', '--lib': DEFAULT_LIB, '--verbose': False,
+  }
+  while args:
+    arg = args.pop(0)
+    if arg == '--verbose':
+      options[arg] = True
+    elif arg in options and args:
+      options[arg] = type(options[arg])(args.pop(0))
+    else:
+      print(__doc__)
+      return 2
+
+  sys.path.insert(0, options['--lib'])
+  import tabun_api
+
+  process = None
+  url = options['--url'].rstrip('/')
+  if not url:
+    process, url = start_server(options)
+  try:
+    return run(tabun_api, url, options)
+  finally:
+    if process is not None:
+      process.terminate()
+      process.wait()
+
+if __name__ == '__main__':
+  sys.exit(main())
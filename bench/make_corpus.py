@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Writes the page corpus for bench_parsers.py into bench/corpus/: gzipped pages shaped like the
+ones Tabun serves (one or more per parser) and manifest.json, which says which parser reads
+each page and with which arguments. The pages are generated with a fixed seed, so rerunning this
+script with Python 3 reproduces the committed corpus byte for byte.
+
+Captured pages can be added next to the generated ones: save the page as bench/corpus/<name>.html.gz
+and add an entry for it to manifest.json. Bump CORPUS_VERSION whenever the corpus changes,
+so bench_parsers.py --compare does not compare runs over different pages.
+
+Usage: python bench/make_corpus.py
+'''
+
+from __future__ import print_function, unicode_literals
+
+import gzip
+import io
+import json
+import os
+import random
+import sys
+
+from bench_preprocess import CF_EMAIL, make_comments, make_post_page
+
+CORPUS_VERSION = 1
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corpus')
+
+MONTHS = ('января', 'февраля', 'марта', 'апреля', 'мая', 'июня', 'июля', 'августа', 'сентября', 'октября', 'ноября', 'декабря')
+WORDS = ('пони', 'арт', 'баттл', 'рисунок', 'конкурс', 'тема', 'голос', 'участник', 'фанфик', 'понификация', 'Эквестрия', 'облако')
+
+def page(title, content):
+  return (
+    '<!doctype html><html><head><title>%s</title></head><body><div id="container"><div id="wrapper">'
+    '<div id="content">%s</div><!-- /content --></div></div></body></html>' % (title, content)
+  ).encode('utf-8')
+
+def words(rnd, count):
+  return ' '.join(rnd.choice(WORDS) for _ in range(count))
+
+def ru_date(rnd, with_time=True):
+  result = '%d %s %d' % (rnd.randint(1, 28), rnd.choice(MONTHS), rnd.randint(2012, 2026))
+  if with_time:
+    result += ', %02d:%02d' % (rnd.randint(0, 23), rnd.randint(0, 59))
+  return result
+
+def avatar(rnd, size=48):
+  return 'https://cdn.everypony.ru/storage/00/%02d/%02d/2014/03/%02d/avatar_%dx%d.png' % (
+    rnd.randint(0, 99), rnd.randint(0, 99), rnd.randint(1, 28), size, size
+  )
+
+def make_posts_page(rnd, count):
+  '''A post list (/index/newall/): short posts with tags, ratings, comment counters and a read-more link.'''
+  buf = []
+  for i in range(count):
+    post_id = 100000 + i
+    blog = rnd.choice(('news', 'art', 'fanfiction', 'borderline'))
+    paragraphs = ''.join('<p>%s, <b>%s</b> &amp; <a href="https://example.com/%d">ссылка</a></p>' % (
+      words(rnd, 30), words(rnd, 3), j
+    ) for j in range(rnd.randint(2, 6)))
+    buf.append(
+      '<article class="topic topic-type-topic js-topic">'
+      '<header class="topic-header"><h1 class="topic-title word-wrap"><a href="/blog/%(blog)s/%(id)d.html">%(title)s</a></h1>'
+      '<div class="topic-info"><a href="/blog/%(blog)s/" class="topic-blog">%(blog)s</a> '
+      '<a href="/profile/user%(author)d/" rel="author">user%(author)d</a>'
+      '<div class="topic-info-vote"><div id="vote_area_topic_%(id)d" class="vote-topic">'
+      '<div class="vote-item vote-count" title="всего проголосовало: %(votes)d"><span id="vote_total_topic_%(id)d">+%(rating)d</span></div>'
+      '</div></div></div></header>'
+      '<div class="topic-content text">%(body)s %(email)s'
+      '<a href="/blog/%(blog)s/%(id)d.html#cut" title="Читать дальше">Читать дальше</a></div>'
+      '<footer class="topic-footer"><p class="topic-tags">%(tags)s</p><ul class="topic-info">'
+      '<li class="topic-info-date"><time datetime="2026-01-%(day)02dT10:00:00+03:00">%(day)d января 2026</time></li>'
+      '<li class="topic-info-favourite"><i class="favourite"></i><span class="favourite-count">%(fav)d</span></li>'
+      '<li class="topic-info-comments"><a href="/blog/%(blog)s/%(id)d.html#comments">'
+      '<i class="icon-synio-comments-green-filled"></i><span>%(comments)d</span><span>+%(new)d</span></a></li>'
+      '</ul></footer></article> <!-- /.topic -->' % {
+        'id': post_id, 'blog': blog, 'title': words(rnd, 4), 'author': rnd.randint(1, 500),
+        'votes': rnd.randint(0, 80), 'rating': rnd.randint(0, 60), 'body': paragraphs,
+        'email': CF_EMAIL.decode('utf-8') if i % 5 == 0 else '',
+        'tags': ', '.join('<a rel="tag" href="/tag/%s/">%s</a>' % (w, w) for w in rnd.sample(WORDS, 4)),
+        'day': rnd.randint(1, 28), 'fav': rnd.randint(0, 20), 'comments': rnd.randint(0, 300), 'new': rnd.randint(0, 10),
+      }
+    )
+  return page('Новые', ''.join(buf))
+
+def make_talk_list_page(rnd, count):
+  '''The inbox (/talk/inbox/): a table of conversations, the first row being the header.'''
+  rows = []
+  for i in range(count):
+    title = words(rnd, 4)
+    if i % 4 == 0:
+      title = '<strong>%s</strong>' % title
+    rows.append(
+      '<tr><td class="cell-checkbox"><input type="checkbox" name="talk_select[%(id)d]" /></td>'
+      '<td class="cell-recipients">%(recipients)s</td>'
+      '<td class="cell-title"><a href="/talk/read/%(id)d/" class="js-title-talk">%(title)s</a></td>'
+      '<td class="cell-date ta-r">%(date)s</td></tr>' % {
+        'id': 50000 - i, 'title': title, 'date': ru_date(rnd, False),
+        'recipients': ' '.join('<a href="/profile/user%d/" class="username">user%d</a>' % (x, x) for x in rnd.sample(range(500), 3)),
+      }
+    )
+  return page('Почта', (
+    '<form action="/talk/" method="post"><table class="table table-talk">'
+    '<thead><tr><th></th><th>Участники</th><th>Заголовок</th><th>Дата</th></tr></thead>'
+    '<tbody>%s</tbody></table></form>' % ''.join(rows)
+  ))
+
+def make_talk_page(rnd, comments):
+  '''A conversation (/talk/read/<id>/): the message and its comments.'''
+  article = (
+    '<article class="topic topic-type-talk"><header class="topic-header"><h1 class="topic-title">%(title)s</h1></header>'
+    '<div class="talk-search talk-recipients"><header><a href="#" class="link-dotted">Участники разговора</a>: %(recipients)s</header></div>'
+    '<div class="topic-content text">%(body)s</div>'
+    '<footer class="topic-footer"><ul class="topic-info">'
+    '<li class="topic-info-author"><a href="/profile/user1/"><img src="%(avatar)s" class="avatar" /></a>'
+    '<a href="/profile/user1/" class="username">user1</a></li>'
+    '<li class="topic-info-date"><time datetime="2026-01-02T12:30:00+03:00">2 января 2026</time></li>'
+    '</ul></footer></article>' % {
+      'title': words(rnd, 5), 'body': '<br/>'.join(words(rnd, 25) for _ in range(8)), 'avatar': avatar(rnd),
+      'recipients': ' '.join('<a href="/profile/user%d/" class="username">user%d</a>' % (x, x) for x in rnd.sample(range(500), 4)),
+    }
+  )
+  comments_html = b''.join(make_comments(comments, 2000)).decode('utf-8')
+  return page('Разговор', article + (
+    '<div class="comments comment-list" id="comments"><header class="comments-header"><h3>'
+    '<span id="count-comments">%d</span></h3></header>%s</div>' % (comments, comments_html)
+  ))
+
+ACTIVITY_TYPES = ('add_topic', 'add_comment', 'add_blog', 'vote_topic', 'vote_comment', 'vote_blog', 'vote_user', 'add_friend', 'join_blog')
+
+def make_activity_page(rnd, count):
+  '''The activity stream (/stream/all/): events of every type.'''
+  items = []
+  for i in range(count):
+    typ = ACTIVITY_TYPES[i % len(ACTIVITY_TYPES)]
+    post_id = rnd.randint(1000, 200000)
+    if typ in ('add_topic', 'vote_topic'):
+      target = '<a href="/blog/news/%d.html">%s</a>' % (post_id, words(rnd, 4))
+    elif typ in ('add_comment', 'vote_comment'):
+      target = '<a href="/blog/news/%d.html#comment%d">%s</a>' % (post_id, rnd.randint(1, 9000000), words(rnd, 4))
+      if typ == 'add_comment':
+        target += '<div class="stream-comment-preview">%s</div>' % words(rnd, 12)
+    elif typ in ('add_blog', 'vote_blog', 'join_blog'):
+      target = '<a href="/blog/blog%d/">%s</a>' % (rnd.randint(1, 300), words(rnd, 2))
+    else:
+      target = '<span><a href="/profile/user%d/"><img src="%s" /></a><a href="/profile/user%d/">user%d</a></span>' % (
+        i, avatar(rnd, 24), i, i
+      )
+    items.append(
+      '<li class="stream-item stream-item-type-%(type)s">'
+      '<a href="/profile/user%(user)d/"><img src="%(avatar)s" alt="avatar" class="avatar" /></a>'
+      '<p class="info"><a href="/profile/user%(user)d/"><strong>user%(user)d</strong></a> · '
+      '<span class="date" title="%(date)s">%(date)s</span></p> %(target)s</li>' % {
+        'type': typ, 'user': rnd.randint(1, 500), 'avatar': avatar(rnd, 48), 'date': ru_date(rnd), 'target': target,
+      }
+    )
+  return page('Активность', (
+    '<ul class="stream-list" id="stream-list">%s</ul>'
+    '<input type="hidden" id="stream_last_id" value="%d" />' % (''.join(items), 7000000 + count)
+  ))
+
+def make_blogs_page(rnd, count):
+  '''The blog list (/blogs/): a table of blogs with readers and ratings.'''
+  rows = []
+  for i in range(count):
+    rows.append(
+      '<tr><td class="cell-name"><a href="/blog/blog%(i)d/"><img src="%(avatar)s" class="avatar" /></a>'
+      '<p><a href="/blog/blog%(i)d/" class="blog-name">%(name)s</a>%(closed)s</p>'
+      '<span class="user-avatar"><a href="/profile/user%(creator)d/"><img src="%(avatar)s" /></a>'
+      '<a href="/profile/user%(creator)d/">user%(creator)d</a></span></td>'
+      '<td class="cell-readers" id="blog_user_count_%(id)d">%(readers)d</td>'
+      '<td class="cell-rating align-center">%(rating).2f</td></tr>' % {
+        'i': i, 'id': 100 + i, 'name': words(rnd, 3), 'avatar': avatar(rnd, 48), 'creator': rnd.randint(1, 500),
+        'closed': ' <i class="icon-synio-topic-private"></i>' if i % 9 == 0 else '',
+        'readers': rnd.randint(0, 5000), 'rating': rnd.uniform(0, 5000),
+      }
+    )
+  return page('Блоги', (
+    '<table class="table table-blogs"><thead><tr><th class="cell-name">Название</th>'
+    '<th class="cell-readers">Читателей</th><th class="cell-rating">Рейтинг</th></tr></thead>'
+    '<tbody>%s</tbody></table>' % ''.join(rows)
+  ))
+
+def make_people_page(rnd, count):
+  '''The user list (/people/): a table of users with skill and rating.'''
+  rows = []
+  for i in range(count):
+    rating = rnd.uniform(-50, 500)
+    rows.append(
+      '<tr><td class="cell-name"><a href="/profile/user%(i)d/"><img src="%(avatar)s" alt="avatar" class="avatar" /></a>'
+      '<div class="name"><p class="username word-wrap"><a href="/profile/user%(i)d/">user%(i)d</a></p>'
+      '<p class="realname">%(realname)s</p></div></td>'
+      '<td class="cell-skill">%(skill).2f</td>'
+      '<td class="cell-rating %(negative)s"><strong>%(rating).2f</strong></td></tr>' % {
+        'i': i, 'avatar': avatar(rnd, 24), 'realname': words(rnd, 2), 'skill': rnd.uniform(0, 3000),
+        'negative': 'negative' if rating < 0 else '', 'rating': rating,
+      }
+    )
+  return page('Пользователи', (
+    '<table class="table table-users"><thead><tr><th class="cell-name">Пользователь</th>'
+    '<th>Сила</th><th>Рейтинг</th></tr></thead><tbody>%s</tbody></table>' % ''.join(rows)
+  ))
+
+def make_profile_page(rnd, blogs):
+  '''A profile (/profile/<username>/) with a description and lists of blogs.'''
+  blog_links = lambda: ', '.join('<a href="/blog/blog%d/">%s</a>' % (x, words(rnd, 2)) for x in rnd.sample(range(300), blogs))
+  return page('Профиль', (
+    '<div class="profile"><h2 itemprop="nickname" class="user-login word-wrap">user42</h2>'
+    '<p class="user-name" itemprop="name">%(realname)s</p>'
+    '<div class="strength"><div class="count" id="user_skill_42">1234.56</div></div>'
+    '<div class="vote-profile"><div id="vote_area_user_42" class="vote-topic">'
+    '<div class="vote-item vote-up"></div><div class="vote-item vote-count"><span id="vote_total_user_42">+56.78</span></div>'
+    '</div></div></div>'
+    '<div class="profile-info-about"><a href="/profile/user42/" class="avatar"><img src="%(avatar)s" alt="avatar" /></a>'
+    '<div class="text">%(about)s</div></div>'
+    '<div class="wrapper"><div class="profile-left"><ul class="profile-dotted-list">'
+    '<li><span>Пол:</span> <strong>женский</strong></li>'
+    '<li><span>Дата рождения:</span> <strong>%(birthday)s</strong></li>'
+    '<li><span>Зарегистрирован:</span> <strong>%(registered)s</strong></li>'
+    '<li><span>Последний визит:</span> <strong>%(visited)s</strong></li>'
+    '<li><span>Создал:</span> <strong>%(owner)s</strong></li>'
+    '<li><span>Администрирует:</span> <strong>%(admin)s</strong></li>'
+    '<li><span>Состоит в:</span> <strong>%(member)s</strong></li>'
+    '</ul></div></div>'
+    '<a href="/uploads/foto.jpg"><img src="/uploads/images/00/00/42/foto.jpg" alt="photo" id="foto-img" /></a>' % {
+      'realname': words(rnd, 2), 'avatar': avatar(rnd, 100),
+      'about': '<br/>'.join(words(rnd, 20) for _ in range(10)),
+      'birthday': ru_date(rnd, False), 'registered': ru_date(rnd), 'visited': ru_date(rnd),
+      'owner': blog_links(), 'admin': blog_links(), 'member': blog_links(),
+    }
+  ))
+
+def build_corpus():
+  '''Returns a list of (manifest entry, page) pairs.'''
+  rnd = random.Random(CORPUS_VERSION)
+  pages = [
+    ({'file': 'posts.html.gz', 'parser': 'get_posts', 'kwargs': {'url': '/index/newall/'}}, make_posts_page(rnd, 20)),
+    ({'file': 'post_300.html.gz', 'parser': 'get_post', 'kwargs': {'post_id': 1, 'blog': 'news'}}, make_post_page(300)),
+    ({'file': 'post_300.html.gz', 'parser': 'get_comments', 'kwargs': {'url': '/blog/news/1.html'}}, None),
+    ({'file': 'post_3000.html.gz', 'parser': 'get_comments', 'kwargs': {'url': '/blog/news/1.html'}}, make_post_page(3000)),
+    ({'file': 'talk_list.html.gz', 'parser': 'get_talk_list', 'kwargs': {}}, make_talk_list_page(rnd, 50)),
+    ({'file': 'talk.html.gz', 'parser': 'get_talk', 'kwargs': {'talk_id': 50000}}, make_talk_page(rnd, 100)),
+    ({'file': 'activity.html.gz', 'parser': 'get_activity', 'kwargs': {}}, make_activity_page(rnd, 90)),
+    ({'file': 'blogs.html.gz', 'parser': 'get_blogs_list', 'kwargs': {}}, make_blogs_page(rnd, 50)),
+    ({'file': 'people.html.gz', 'parser': 'get_people_list', 'kwargs': {}}, make_people_page(rnd, 50)),
+    ({'file': 'profile.html.gz', 'parser': 'get_profile', 'kwargs': {'username': 'user42'}}, make_profile_page(rnd, 20)),
+  ]
+  return pages
+
+def write_gzip(path, data):
+  # mtime=0 and no file name in the header keep the archive reproducible
+  buf = io.BytesIO()
+  with gzip.GzipFile(filename='', mode='wb', fileobj=buf, mtime=0) as f:
+    f.write(data)
+  with open(path, 'wb') as f:
+    f.write(buf.getvalue())
+
+def main():
+  if not os.path.isdir(CORPUS_DIR):
+    os.makedirs(CORPUS_DIR)
+  entries = []
+  for entry, data in build_corpus():
+    if data is not None:
+      write_gzip(os.path.join(CORPUS_DIR, entry['file']), data)
+    entries.append(entry)
+  with open(os.path.join(CORPUS_DIR, 'manifest.json'), 'w') as f:
+    f.write(json.dumps({'version': CORPUS_VERSION, 'pages': entries}, indent=2, sort_keys=True) + '\n')
+  print('%d pages written to %s' % (len(entries), CORPUS_DIR))
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
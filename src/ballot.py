@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Extracts the participant number from a ballot comment under an Art-Battle poll post.
+
+Recognized forms, in order of precedence (the first form found anywhere in the comment wins,
+and within one form the leftmost occurrence wins, as with the five separate searches
+count_votes_comments used to do):
+  1. FORM_HASH:          "#3", "№ 3"
+  2. FORM_MEMBER:        "участник 3", "участника #3", "уч-ка №3"
+  3. FORM_MEMBER_AFTER:  "3 участник", "3-й участник", "3уч"
+  4. FORM_NUMBER:        "номер 3", "номером #3"
+  5. FORM_NUMBER_AFTER:  "3 номер", "3-й номер"
+
+All forms are combined into one precompiled alternation, so each comment is scanned once. The
+alternation is wrapped in a lookahead: its matches are empty, so they can't overlap, and a lower-ranked
+form can't swallow the text a higher-ranked one needs ("номер #3, участник 4" is 3, not 4). At every
+position the highest-ranked form starting there wins, and of all matches the one with the best
+(rank, position) is the result.
+'''
+
+import re
+
+FORM_HASH = 'hash'
+FORM_MEMBER = 'member'
+FORM_MEMBER_AFTER = 'member_after'
+FORM_NUMBER = 'number'
+FORM_NUMBER_AFTER = 'number_after'
+
+# Forms in order of precedence
+FORMS = (FORM_HASH, FORM_MEMBER, FORM_MEMBER_AFTER, FORM_NUMBER, FORM_NUMBER_AFTER)
+FORM_RANK = dict((form, rank) for rank, form in enumerate(FORMS))
+
+# Each alternative captures the number in a group named after its form. All other groups are
+# non-capturing, so that match.lastgroup tells which form matched.
+BALLOT_REGEX = re.compile(u'(?=' + u'|'.join([
+  u'[#№]\\s*(?P<hash>\\d+)',
+  u'уч(?:астни)?-?ка?\\s*#?№?\\s*(?P<member>\\d+)',
+  u'(?P<member_after>\\d+)\\s*-?[уоы]?й?\\s*уч(?:астни)?-?ка?',
+  u'номер(?:ом)?\\s*#?№?\\s*(?P<number>\\d+)',
+  u'(?P<number_after>\\d+)\\s*-?[уоы]?й?\\s*номер(?:ом)?',
+]) + u')', re.UNICODE|re.DOTALL|re.IGNORECASE)
+
+def parse_ballot_form(text):
+  '''Returns a tuple (participant number, form) or (None, None) if the comment is not a ballot.'''
+  best_rank = None
+  best_number = None
+  for m in BALLOT_REGEX.finditer(text):
+    rank = FORM_RANK[m.lastgroup]
+    # matches come in order of position, so only a better rank can win
+    if best_rank is None or rank < best_rank:
+      best_rank = rank
+      best_number = int(m.group(m.lastgroup))
+      if rank == 0:
+        break
+  if best_rank is None:
+    return None, None
+  return best_number, FORMS[best_rank]
+
+def parse_ballot(text):
+  '''Returns the participant number voted for in the comment, or None.'''
+  return parse_ballot_form(text)[0]
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Image processing stage of imgurify: decodes, down-sizes and re-encodes artworks.
+JPEGs are decoded in draft mode, so a 4000px photo is never fully decoded just to be shrunk to 800px.
+'''
+
+import time
+from contextlib import contextmanager
+
+try:
+  from PIL import Image
+except ImportError:
+  import Image
+from StringIO import StringIO
+
+# Images at most this much wider than max_width are left as is (5% too wide)
+RESIZE_THRESHOLD = 1.05
+JPEG_QUALITY = 95
+PREVIEW_JPEG_QUALITY = 85
+
+class StageTimer(object):
+  '''Measures how long each stage of image processing takes.'''
+  def __init__(self):
+    self.stages = []
+
+  @contextmanager
+  def stage(self, name):
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.stages.append((name, time.time() - start))
+
+  def __str__(self):
+    return ', '.join('%s %d ms' % (name, seconds * 1000) for (name, seconds) in self.stages)
+
+def target_size(size, max_width):
+  '''Returns the size the image should be down-sized to, or None if it is narrow enough.'''
+  (width, height) = size
+  if max_width > 0 and float(width) / float(max_width) > RESIZE_THRESHOLD:
+    return (max_width, max(1, max_width * height / width))
+  return None
+
+def decode(data, max_width):
+  '''Decodes the image. JPEGs are decoded at the smallest scale that is still not smaller than needed.'''
+  im = Image.open(StringIO(data))
+  size = target_size(im.size, max_width)
+  if size and im.format == 'JPEG':
+    # The JPEG decoder can scale down by 1/2, 1/4 or 1/8 while decoding
+    im.draft('RGB', size)
+  im.load()
+  return im
+
+def shrink(im, max_width):
+  '''Down-sizes the image to max_width (if needed), keeping the aspect ratio.'''
+  size = target_size(im.size, max_width)
+  if not size:
+    return im
+  if im.mode not in ('RGB', 'RGBA', 'L'):
+    im = im.convert('RGBA' if 'transparency' in im.info else 'RGB')
+  # Halve with a cheap filter while the image is much larger than needed,
+  # then do the final high-quality pass on the small image:
+  while im.size[0] / 2 >= size[0] * 2:
+    im = im.resize((im.size[0] / 2, max(1, im.size[1] / 2)), Image.BILINEAR)
+  return im.resize(size, Image.ANTIALIAS)
+
+def make_preview(im, preview_size):
+  '''Returns a copy of the image down-sized to fit into a preview_size x preview_size square.'''
+  preview = im.copy()
+  if preview.mode not in ('RGB', 'RGBA', 'L'):
+    preview = preview.convert('RGBA' if 'transparency' in preview.info else 'RGB')
+  preview.thumbnail((preview_size, preview_size), Image.ANTIALIAS)
+  return preview
+
+def encode(im, source_format=None, quality=JPEG_QUALITY):
+  '''
+  Encodes the image as JPEG, or as PNG if the source was a PNG and the PNG turns out smaller.
+  Returns a tuple (data, format).
+  '''
+  jpeg = StringIO()
+  (im if im.mode == 'RGB' else im.convert('RGB')).save(jpeg, format='JPEG', quality=quality)
+  result = (jpeg.getvalue(), 'JPEG')
+  jpeg.close()
+  if source_format == 'PNG':
+    png = StringIO()
+    im.save(png, format='PNG')
+    if png.tell() < len(result[0]):
+      result = (png.getvalue(), 'PNG')
+    png.close()
+  return result
+
+def process_image(data, max_width, preview_size=None, timer=None):
+  '''
+  Decodes, down-sizes and encodes the image for uploading, and makes a preview from the same decoded image.
+  Returns a tuple (image, preview), each being a tuple (data, format). Preview is None if preview_size is not given.
+  Stage timings are recorded in the given StageTimer.
+  '''
+  timer = timer or StageTimer()
+  with timer.stage('decode'):
+    im = decode(data, max_width)
+    source_format = im.format
+  with timer.stage('resize'):
+    im = shrink(im, max_width)
+  with timer.stage('encode'):
+    image = encode(im, source_format)
+  preview = None
+  if preview_size:
+    with timer.stage('preview'):
+      preview = encode(make_preview(im, preview_size), source_format, PREVIEW_JPEG_QUALITY)
+  return image, preview
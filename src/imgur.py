@@ -9,11 +9,12 @@ except ImportError:
   import Image
 
 from StringIO import StringIO
-from urllib import urlencode
 
-import base64
 import json
 
+import fix_libs
+from tabun_api.utils import MultipartBody
+
 class ImgurError(Exception):
   pass
 
@@ -32,20 +33,26 @@ class ImgurUploader(object):
   def upload(self, image):
     temp_str = StringIO()
     image.save(temp_str, format='JPEG', quality=95)
-    b64 = base64.b64encode(temp_str.getvalue())
+    data = temp_str.getvalue()
     temp_str.close()
-    data = {
-      'image': b64,
-      'type': 'base64',
-    }
-    payload = urlencode(data)
+    return self.upload_data(data)
+  
+  def upload_data(self, image_data):
+    '''
+    Uploads an already encoded image (JPEG, PNG...) and returns its URL at Imgur.
+    The image is sent as raw bytes in a multipart form rather than base64-encoded and urlencoded,
+    so the request is a third smaller and the image is not copied several times on the way.
+    '''
+    body = MultipartBody({'type': 'file'}, [('image', 'image', image_data)])
     headers = {
       'Authorization': 'Client-ID %s' % self.client_id,
+      'Content-Type': body.content_type,
     }
+    # urlfetch only accepts the payload as a string, so the body is joined here once
     result = urlfetch.fetch(url='https://api.imgur.com/3/upload',
                    method=urlfetch.POST,
                    headers = headers,
-                   payload = payload)
+                   payload = body.getvalue())
     if result.status_code != 200:
       raise ImgurError('Failed to upload image to Imgur: %s' % result.content)
     j = json.loads(result.content)
@@ -9,10 +9,16 @@ import time
 from socket import timeout as socket_timeout
 from json import JSONDecoder
 from threading import RLock
+from collections import deque
 
-from . import utils, compat
+from . import utils, compat, keepalive, httpcache, ratelimit, instrument
 from .compat import PY2, BaseCookie, urequest, text_types, text, binary
 
+if PY2:
+    # в py2 time.strptime импортирует _strptime при первом вызове, и если первым вызовом
+    # оказываются сразу несколько потоков (например, get_talk в parallel_map), импорт падает с AttributeError
+    import _strptime  # noqa
+
 
 __version__ = '0.6.3'
 
@@ -24,13 +30,16 @@ halfclosed = ("borderline", "shipping", "erpg", "gak", "RPG", "roliplay", "tears
 
 #: Заголовки для HTTP-запросов. Возможно, стоит менять user-agent.
 http_headers = {
-    "connection": "close",
+    "connection": "keep-alive",
     "user-agent": "tabun_api/%s; Linux/2.6" % __version__
 }
 
 #: Регулярка для парсинга ссылки на пост.
 post_url_regex = re.compile(r"/blog/(([A-z0-9_\-\.]{1,})/)?([0-9]{1,}).html")
 
+#: Регулярка для номера страницы в ссылках пагинации.
+page_link_regex = re.compile(br"/page([0-9]+)/")
+
 #: Регулярка для парсинга прикреплённых файлов.
 post_file_regex = re.compile(r'^Скачать \"(.+)" \(([0-9]*(\.[0-9]*)?) (Кб|Мб)\)$')
 
@@ -65,8 +74,88 @@ class TabunResultError(TabunError):
     pass
 
 
-class Post(object):
+class Compact(object):
+    """Основа для объектов с данными Табуна. Атрибуты хранятся в __slots__, а не в словаре __dict__
+    у каждого экземпляра, что заметно экономит память, когда их сотни тысяч (архиваторы, обходы комментов).
+    Умеет pickle и copy, в том числе на Python 2 и со старыми протоколами pickle.
+    """
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+class LazyBody(Compact):
+    """Тело поста, коммента или письма, которое хранится в том виде, в каком его дал парсер:
+    экранированным исходником raw_body или lxml-элементом body. Второе представление вычисляется
+    через utils.normalize_body только при первом обращении, так что тем, кому тело не нужно
+    (или нужен только исходник), не приходится платить за лишний парсинг и сериализацию.
+    """
+
+    __slots__ = ('_body', '_raw_body')
+
+    #: Класс div-обёртки, в которую заворачивается исходник при построении элемента.
+    body_cls = 'text'
+
+    def set_body(self, body=None, raw_body=None):
+        self._body = body
+        self._raw_body = text(raw_body) if raw_body is not None else None
+
+    @property
+    def body(self):
+        if self._body is None and self._raw_body is not None:
+            self._body = utils.normalize_body(raw_body=self._raw_body, cls=self.body_cls)[0]
+        return self._body
+
+    @body.setter
+    def body(self, body):
+        self.set_body(body=body)
+
+    @property
+    def raw_body(self):
+        if self._raw_body is None and self._body is not None:
+            self._raw_body = utils.normalize_body(body=self._body)[1]
+        return self._raw_body
+
+    @raw_body.setter
+    def raw_body(self, raw_body):
+        self.set_body(raw_body=raw_body)
+
+    def drop_body(self):
+        """Оставляет только исходник raw_body и выбрасывает lxml-элемент body, а вместе с ним и дерево
+        страницы, на которое он ссылается. Если body понадобится снова, он будет построен из исходника.
+        Полезно, когда нужно долго держать в памяти много постов или комментов.
+        """
+        if self._body is not None:
+            self._raw_body = self.raw_body
+            self._body = None
+
+    def __getstate__(self):
+        # lxml-элементы не сериализуются, поэтому сохраняется только исходник
+        state = Compact.__getstate__(self)
+        state['_raw_body'] = self.raw_body
+        state['_body'] = None
+        return state
+
+
+class Post(LazyBody):
     """Пост."""
+    __slots__ = (
+        'time', 'blog', 'post_id', 'author', 'title', 'draft', 'vote_count', 'vote_total', 'tags',
+        'comments_count', 'comments_new_count', 'short', 'private', 'blog_name', 'poll', 'favourite', 'favourited',
+        'download',
+    )
+    body_cls = 'topic-content text'
+
     def __init__(self, time, blog, post_id, author, title, draft,
                  vote_count, vote_total, body, tags, comments_count=None, comments_new_count=None,
                  short=False, private=False, blog_name=None, poll=None, favourite=0, favourited=False,
@@ -92,7 +181,7 @@ class Post(object):
             raise ValueError
         self.download = download
 
-        self.body, self.raw_body = utils.normalize_body(body, raw_body, cls='topic-content text')
+        self.set_body(body, raw_body)
 
     def __repr__(self):
         o = "<post " + ((self.blog + "/") if self.blog else "personal ") + text(self.post_id) + ">"
@@ -109,8 +198,11 @@ class Post(object):
         return http_host + '/blog/' + ((self.blog + '/') if self.blog else '') + text(self.post_id) + '.html'
 
 
-class Download(object):
+class Download(Compact):
     """Прикрепленный к посту файл (в новом Табуне) или ссылка (в старом Табуне)."""
+    __slots__ = (
+        'type', 'post_id', 'filename', 'filesize', 'count',
+    )
     def __init__(self, type, post_id, filename, count, filesize=None):
         self.type = text(type)
         if self.type not in ("file", "link"):
@@ -121,8 +213,12 @@ class Download(object):
         self.count = int(count)
 
 
-class Comment(object):
+class Comment(LazyBody):
     """Коммент. Возможно, удалённый, поэтому следите, чтобы значения не были None!"""
+    __slots__ = (
+        'time', 'blog', 'post_id', 'comment_id', 'author', 'vote', 'unread', 'parent_id', 'post_title',
+        'deleted', 'favourite', 'favourited',
+    )
     def __init__(self, time, blog, post_id, comment_id, author, body, vote, parent_id=None,
                  post_title=None, unread=False, deleted=False, favourite=None, favourited=False,
                  raw_body=None):
@@ -145,7 +241,7 @@ class Comment(object):
         self.favourite = int(favourite) if favourite is not None else None
         self.favourited = bool(favourited)
 
-        self.body, self.raw_body = utils.normalize_body(body, raw_body)
+        self.set_body(body, raw_body)
 
     def __repr__(self):
         o = (
@@ -162,8 +258,12 @@ class Comment(object):
         return self.__repr__().decode('utf-8', 'replace')
 
 
-class Blog(object):
+class Blog(Compact):
     """Блог."""
+    __slots__ = (
+        'blog_id', 'blog', 'name', 'creator', 'readers', 'rating', 'closed', 'admins', 'moderators',
+        'vote_count', 'posts_count', 'created', 'description', 'raw_description',
+    )
     def __init__(self, blog_id, blog, name, creator, readers=0, rating=0.0, closed=False,
                  description=None, admins=None, moderators=None, vote_count=-1, posts_count=-1,
                  created=None, raw_description=None):
@@ -197,8 +297,11 @@ class Blog(object):
         return http_host + '/blog/' + self.blog + '/'
 
 
-class StreamItem(object):
+class StreamItem(Compact):
     """Элемент «Прямого эфира»."""
+    __slots__ = (
+        'blog', 'blog_title', 'title', 'author', 'comment_id', 'comments_count',
+    )
     def __init__(self, blog, blog_title, title, author, comment_id, comments_count):
         self.blog = text(blog) if blog else None
         self.blog_title = text(blog_title)
@@ -218,8 +321,12 @@ class StreamItem(object):
         return self.__repr__().decode('utf-8')
 
 
-class UserInfo(object):
+class UserInfo(Compact):
     """Информация о броняше."""
+    __slots__ = (
+        'user_id', 'username', 'realname', 'skill', 'rating', 'userpic', 'foto', 'gender', 'birthday',
+        'registered', 'last_activity', 'blogs', 'description', 'raw_description',
+    )
     def __init__(self, user_id, username, realname, skill, rating, userpic=None, foto=None,
                  gender=None, birthday=None, registered=None, last_activity=None,
                  description=None, blogs=None, raw_description=None):
@@ -253,8 +360,11 @@ class UserInfo(object):
         return self.__repr__().decode('utf-8', 'replace')
 
 
-class Poll(object):
+class Poll(Compact):
     """Опрос. Список items содержит кортежи (название ответа, процент проголосовавших, число проголосовавших)."""
+    __slots__ = (
+        'total', 'notvoted', 'items',
+    )
     def __init__(self, total, notvoted, items):
         self.total = int(total)
         self.notvoted = int(notvoted)
@@ -263,8 +373,11 @@ class Poll(object):
             self.items.append((text(x[0]), float(x[1]), int(x[2])))
 
 
-class TalkItem(object):
+class TalkItem(LazyBody):
     """Личное сообщение."""
+    __slots__ = (
+        'talk_id', 'recipients', 'unread', 'title', 'date', 'author', 'comments',
+    )
     def __init__(self, talk_id, recipients, unread, title, date, body=None, author=None, comments=None, raw_body=None):
         self.talk_id = int(talk_id)
         self.recipients = [text(x) for x in recipients]
@@ -274,7 +387,7 @@ class TalkItem(object):
         self.author = text(author) if author else None
         self.comments = comments if comments else []
 
-        self.body, self.raw_body = utils.normalize_body(body, raw_body)
+        self.set_body(body, raw_body)
 
     def __repr__(self):
         o = "<talk " + text(self.talk_id) + ">"
@@ -287,8 +400,11 @@ class TalkItem(object):
         return self.__repr__().decode('utf-8', 'replace')
 
 
-class ActivityItem(object):
+class ActivityItem(Compact):
     """Событие со страницы /stream/."""
+    __slots__ = (
+        'type', 'date', 'post_id', 'comment_id', 'blog', 'username', 'title', 'data', 'id',
+    )
     WALL_ADD = 0  # Просто чтобы было :)
     POST_ADD = 1
     COMMENT_ADD = 2
@@ -376,8 +492,25 @@ class User(object):
     * skill — силушка (после update_userinfo)
     * rating — кармушка (после update_userinfo)
     * timeout — таймаут ожидания ответа от сервера (для функции urlopen, по умолчанию 20)
+    * query_interval — минимальный средний интервал между запросами в секундах (по умолчанию 0, без ограничений)
+    * query_burst — сколько запросов после простоя можно отправить сразу, не дожидаясь query_interval (по умолчанию 1)
+    * limiter — ограничитель частоты запросов (ratelimit.TokenBucket), которым управляют query_interval и query_burst;
+      его можно передать в конструктор, чтобы несколько объектов User делили один лимит
+    * retry — политика повторов (ratelimit.RetryPolicy) или None. По умолчанию GET-запросы после временных ошибок
+      (таймаут, обрыв соединения, 5xx) повторяются пару раз с задержкой; retry=None в конструкторе отключает повторы.
+      Остальные запросы не повторяются, кроме add_post и add_poll с check_if_error=True, и то только если
+      форма точно не ушла на сервер (см. submit_topic)
+    * observers — список наблюдателей за запросами и парсингом (см. модуль instrument, add_observer и notify)
+    * collector — instrument.StatsCollector, если в конструктор передано collect_stats=True, иначе None;
+      сводку по нему вместе со счётчиками пула, кэша и ограничителя возвращает stats()
     * phpsessid, security_ls_key, key — ну вы поняли
     * session_cookie_name — название печеньки, в которую положить phpsessid (для табуна TABUNSESSIONID, для других лайвстритов PHPSESSID)
+    * pool — пул постоянных соединений (keepalive.ConnectionPool), общий для urlopen, send_form и ajax;
+      счётчики переиспользования можно посмотреть через pool.stats(). При keep_alive=False равен None,
+      и каждый запрос, как в старые добрые времена, открывает новое соединение
+    * cache — кэш ответов на GET-запросы (httpcache.HTTPCache) или None (по умолчанию, без кэша).
+      Задаётся параметром конструктора cache: True создаёт кэш в памяти, также можно передать свой HTTPCache,
+      например общий для нескольких объектов User или с DiskStore. Счётчики попаданий — cache.stats()
     """
 
     phpsessid = None
@@ -388,18 +521,40 @@ class User(object):
     talk_unread = 0
     skill = None
     rating = None
-    query_interval = 0
     proxy = None
     http_host = None
-
-    def __init__(self, login=None, passwd=None, phpsessid=None, security_ls_key=None, key=None, proxy=None, http_host=None, session_cookie_name='TABUNSESSIONID'):
+    pool = None
+    cache = None
+    retry = None
+    observers = ()
+    collector = None
+
+    def __init__(self, login=None, passwd=None, phpsessid=None, security_ls_key=None, key=None, proxy=None, http_host=None, session_cookie_name='TABUNSESSIONID',
+                 keep_alive=True, cache=None, limiter=None, retry=True, collect_stats=False):
         self.http_host = text(http_host).rstrip('/') if http_host else None
         self.session_cookie_name = text(session_cookie_name)
 
         self.jd = JSONDecoder()
         self.lock = RLock()
-
-        handlers = []
+        self.limiter = limiter if limiter is not None else ratelimit.TokenBucket()
+        self.last_query_time = 0
+        if retry is True:
+            self.retry = ratelimit.RetryPolicy()
+        elif retry:
+            self.retry = retry
+        self.observers = []
+        if collect_stats:
+            self.collector = instrument.StatsCollector()
+            self.observers.append(self.collector)
+
+        if keep_alive:
+            self.pool = keepalive.ConnectionPool()
+        if cache is True:
+            self.cache = httpcache.HTTPCache()
+        elif cache:
+            self.cache = cache
+
+        proxy_args = None
 
         if proxy is None and os.getenv('TABUN_API_PROXY') and os.getenv('TABUN_API_PROXY').count(',') == 2:
             proxy = os.getenv('TABUN_API_PROXY').split(',')[:3]
@@ -413,16 +568,15 @@ class User(object):
                 raise NotImplementedError('I can use only socks proxies now')
             proxy[2] = int(proxy[2])
             import socks
-            from socksipyhandler import SocksiPyHandler
             if proxy[0] == 'socks5':
-                handlers.append(SocksiPyHandler(socks.PROXY_TYPE_SOCKS5, proxy[1], proxy[2]))
+                proxy_args = (socks.PROXY_TYPE_SOCKS5, proxy[1], proxy[2])
             elif proxy[0] == 'socks4':
-                handlers.append(SocksiPyHandler(socks.PROXY_TYPE_SOCKS4, proxy[1], proxy[2]))
+                proxy_args = (socks.PROXY_TYPE_SOCKS4, proxy[1], proxy[2])
             self.proxy = proxy
 
         # for thread safety
-        self.opener = urequest.build_opener(*handlers)
-        self.noredir = urequest.build_opener(*(handlers + [NoRedirect]))
+        self.opener = urequest.build_opener(*self.build_handlers(proxy_args))
+        self.noredir = urequest.build_opener(*(self.build_handlers(proxy_args) + [NoRedirect]))
 
         if phpsessid:
             self.phpsessid = text(phpsessid).split(";", 1)[0]
@@ -462,9 +616,70 @@ class User(object):
         if login and passwd:
             self.login(login, passwd)
 
-        self.last_query_time = 0
         self.talk_count = 0
 
+    @property
+    def query_interval(self):
+        return self.limiter.interval
+
+    @query_interval.setter
+    def query_interval(self, value):
+        self.limiter.interval = value
+
+    @property
+    def query_burst(self):
+        return self.limiter.burst
+
+    @query_burst.setter
+    def query_burst(self, value):
+        self.limiter.burst = value
+
+    def add_observer(self, observer):
+        """Добавляет наблюдателя (см. модуль instrument)."""
+        self.observers.append(observer)
+
+    def remove_observer(self, observer):
+        """Убирает наблюдателя, добавленного через add_observer."""
+        self.observers.remove(observer)
+
+    def notify(self, event, *args):
+        """Вызывает метод event(self, *args) у всех наблюдателей, у которых он есть."""
+        for observer in self.observers:
+            method = getattr(observer, event, None)
+            if method is not None:
+                method(self, *args)
+
+    def stats(self):
+        """Возвращает словарь со счётчиками: сводку collector (ключи requests и parse, если сбор включён)
+        и статистику пула соединений, кэша, ограничителя частоты и повторов (если они есть).
+        """
+        result = self.collector.summary() if self.collector is not None else {}
+        if self.pool is not None:
+            result['pool'] = self.pool.stats()
+        if self.cache is not None:
+            result['cache'] = self.cache.stats()
+        result['limiter'] = self.limiter.stats()
+        if self.retry is not None:
+            result['retried'] = self.retry.retried
+        return result
+
+    def build_handlers(self, proxy_args=None):
+        """Возвращает список обработчиков для urllib-опенера: прокси и/или постоянные соединения из self.pool."""
+        if self.pool is None:
+            if not proxy_args:
+                return []
+            from socksipyhandler import SocksiPyHandler
+            return [SocksiPyHandler(*proxy_args)]
+
+        http_class = None
+        if proxy_args:
+            from socksipyhandler import SocksiPyConnection
+            http_class = lambda **kwargs: SocksiPyConnection(*proxy_args, **kwargs)
+        return [
+            keepalive.KeepAliveHTTPHandler(self.pool, http_class),
+            keepalive.KeepAliveHTTPSHandler(self.pool),
+        ]
+
     def update_security_ls_key(self, raw_data):
         """Выдирает security_ls_key из страницы. Вызывается из update_userinfo."""
         pos = raw_data.find(b"var LIVESTREET_SECURITY_KEY =")
@@ -493,7 +708,7 @@ class User(object):
             return
 
         node = utils.parse_html_fragment(userinfo)[0]
-        dd_user = node.xpath('//*[@id="dropdown-user"]')
+        dd_user = utils.xpath(node, '//*[@id="dropdown-user"]')
         if not dd_user:
             self.username = None
             self.talk_count = 0
@@ -502,7 +717,7 @@ class User(object):
             return
         dd_user = dd_user[0]
 
-        username = dd_user.xpath('a[2]/text()[1]')
+        username = utils.xpath(dd_user, 'a[2]/text()[1]')
         if username and username[0]:
             self.username = username[0]
         else:
@@ -512,13 +727,13 @@ class User(object):
             self.rating = None
             return
 
-        talk_count = dd_user.xpath('ul/li[@class="item-messages"]/a[@class="new-messages"]/text()')
+        talk_count = utils.xpath(dd_user, 'ul/li[@class="item-messages"]/a[@class="new-messages"]/text()')
         if not talk_count:
             self.talk_unread = 0
         else:
             self.talk_unread = int(talk_count[0][1:])
 
-        strength = dd_user.xpath('ul[@class="dropdown-user-menu"]/li/span/text()')
+        strength = utils.xpath(dd_user, 'ul[@class="dropdown-user-menu"]/li/span/text()')
         if not strength:
             self.skill = 0.0
         else:
@@ -595,46 +810,74 @@ class User(object):
         """Отправляет запрос (строку со ссылкой или объект Request).
         Возвращает результат вызова urlopen (объект urllib.addinfourl).
         Используется в методе urlopen.
+        Очередь по query_interval занимается через limiter, а сам запрос идёт без блокировок,
+        так что один объект User можно использовать из нескольких потоков параллельно.
+        GET-запросы после временных ошибок повторяются согласно retry; каждый повтор снова встаёт в очередь limiter.
         """
 
-        # FIXME: ну чего так некрасиво-то получилось?
-        self.lock.acquire()
-        try:
-            while not nowait and self.query_interval > 0 and time.time() - self.last_query_time < self.query_interval:
-                sleeptime = self.query_interval - time.time() + self.last_query_time
-                if sleeptime > 0:
-                    self.lock.release()
-                    try:
-                        time.sleep(sleeptime)
-                    finally:
-                        self.lock.acquire()
-
+        idempotent = request.get_method() in ('GET', 'HEAD')
+        attempt = 0
+        while True:
+            if not nowait:
+                # ожидание очереди, как и сам запрос, не считается временем парсинга (см. instrument.parser)
+                start = instrument.clock()
+                self.limiter.acquire()
+                instrument.add_request_time(instrument.clock() - start)
             self.last_query_time = time.time()
+            try:
+                return self.do_request(request, redir, timeout)
+            except TabunError as exc:
+                if not idempotent or self.retry is None or not self.retry.should_retry(exc, attempt):
+                    raise
+            delay = self.retry.delay(attempt)
+            time.sleep(delay)
+            instrument.add_request_time(delay)
+            attempt += 1
+
+    def do_request(self, request, redir=True, timeout=None):
+        """Отправляет запрос сразу, без соблюдения query_interval и без блокировки,
+        и переделывает ошибки urllib в TabunError. Используется в методе send_request и в AsyncUser.
+        Сообщает наблюдателям before_request и after_response.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if not self.observers:
+            return self.open_request(request, redir, timeout)
 
-            if timeout is None:
-                timeout = self.timeout
+        self.notify('before_request', request)
+        start = instrument.clock()
+        try:
+            resp = self.open_request(request, redir, timeout)
+        except TabunError as exc:
+            elapsed = instrument.clock() - start
+            instrument.add_request_time(elapsed)
+            self.notify('after_response', request, exc.code, None, elapsed, exc)
+            raise
+        elapsed = instrument.clock() - start
+        instrument.add_request_time(elapsed)
+        self.notify('after_response', request, resp.getcode(), instrument.response_size(resp), elapsed, None)
+        return resp
 
-            try:
-                return (self.opener.open if redir else self.noredir.open)(request, timeout=timeout)
-            except KeyboardInterrupt:
-                raise
-            except urequest.HTTPError as exc:
-                if exc.getcode() == 404:
-                    data = exc.read(8192)
-                    if b'//projects.everypony.ru/error/main.css' in data:
-                        raise TabunError('Static 404', -404)
-                raise TabunError(code=exc.getcode())
-            except urequest.URLError as exc:
-                raise TabunError(exc.reason, -exc.reason.errno if exc.reason.errno else 0)
-            except compat.HTTPException as exc:
-                raise TabunError("HTTP error", -4)
-            except socket_timeout:
-                raise TabunError("Timeout", -2)
-            except IOError as exc:
-                raise TabunError(text(exc), -3)
-
-        finally:
-            self.lock.release()
+    def open_request(self, request, redir, timeout):
+        """Отправляет запрос через urllib-опенер и переделывает его ошибки в TabunError. Используется в методе do_request."""
+        try:
+            return (self.opener.open if redir else self.noredir.open)(request, timeout=timeout)
+        except KeyboardInterrupt:
+            raise
+        except urequest.HTTPError as exc:
+            if exc.getcode() == 404:
+                data = exc.read(8192)
+                if b'//projects.everypony.ru/error/main.css' in data:
+                    raise TabunError('Static 404', -404)
+            raise TabunError(code=exc.getcode())
+        except urequest.URLError as exc:
+            raise TabunError(exc.reason, -exc.reason.errno if exc.reason.errno else 0)
+        except compat.HTTPException as exc:
+            raise TabunError("HTTP error", -4)
+        except socket_timeout:
+            raise TabunError("Timeout", -2)
+        except IOError as exc:
+            raise TabunError(text(exc), -3)
 
     def urlopen(self, url, data=None, headers=None, redir=True, nowait=False, with_cookies=True, timeout=None):
         """Отправляет HTTP-запрос и возвращает результат вызова urlopen (объект addinfourl).
@@ -642,19 +885,34 @@ class User(object):
         В качестве URL может быть путь с доменом (http://tabun.everypony.ru/), без домена (/index/newall/) или объект Request.
         Если redir установлен в False, то не будет осуществляться переход по перенаправлению (HTTP-коды 3xx).
         К запросу добавлется печенька TABUNSESSIONID (из атрибута phpsessid); with_cookies=False отключает это.
-        По умолчанию соблюдает между запросами временной интервал query_interval (который по умолчанию 0);
+        По умолчанию соблюдает между запросами временной интервал query_interval (который по умолчанию 0, см. также query_burst);
         при nowait=True запрос всегда отправляется немедленно.
+        Если задан кэш (атрибут cache), GET-запросы проходят через него.
         Может кидаться исключением TabunError.
         """
 
         req = self.build_request(url, data, headers, with_cookies)
-        return self.send_request(req, redir, nowait, timeout)
+        if self.cache is None or not redir or req.get_method() != 'GET':
+            return self.send_request(req, redir, nowait, timeout)
+
+        def send(req):
+            try:
+                return self.send_request(req, redir, nowait, timeout)
+            except TabunError as exc:
+                if exc.code == 304 and (req.has_header('If-none-match') or req.has_header('If-modified-since')):
+                    return None
+                raise
+
+        return self.cache.open(req, send)
 
     def send_form(self, url, fields=(), files=(), headers=None, redir=True):
-        """Формирует multipart/form-data запрос и отправляет его через функцию urlopen."""
-        content_type, data = utils.encode_multipart_formdata(fields, files)
+        """Формирует multipart/form-data запрос и отправляет его через функцию urlopen.
+        Тело запроса не склеивается в памяти, а читается по кусочкам (см. utils.MultipartBody).
+        """
+        data = utils.MultipartBody(fields, files)
         headers = dict(headers or ())
-        headers['content-type'] = content_type
+        headers['content-type'] = data.content_type
+        headers['content-length'] = text(len(data))
         return self.urlopen(url, data, headers, redir)
 
     def ajax(self, url, fields=None, files=(), headers=None, throw_if_error=True):
@@ -664,7 +922,10 @@ class User(object):
         headers['x-requested-with'] = 'XMLHttpRequest'
         fields['security_ls_key'] = self.security_ls_key
         data = self.send_form(url, fields or {}, files, headers=headers).read()
+        return self.decode_ajax(data, throw_if_error)
 
+    def decode_ajax(self, data, throw_if_error=True):
+        """Декодирует json-ответ на ajax-запрос. Используется в методе ajax."""
         try:
             data = self.jd.decode(data.decode('utf-8'))
         except:
@@ -697,34 +958,7 @@ class User(object):
         else:
             fields['submit_topic_publish'] = "Опубликовать"
 
-        try:
-            result = self.send_form('/topic/add/', fields, redir=False)
-            data = result.read()
-            error = utils.find_substring(data, b'<ul class="system-message-error">', b'</ul>', with_start=False, with_end=False)
-            if error and b':' in error:
-                error = utils.find_substring(error.decode('utf-8', 'replace'), ':', '</li>', extend=True, with_start=False, with_end=False).strip()
-                raise TabunResultError(error)
-            link = result.headers.get('location')
-        except TabunResultError:
-            raise
-        except TabunError:
-            if not check_if_error or not self.username:
-                raise
-            url = '/topic/saved/' if draft else '/profile/' + urequest.quote(self.username.encode('utf-8')) + '/created/topics/'
-
-            try:
-                posts = self.get_posts(url)
-            except:
-                posts = []
-            posts.reverse()
-
-            for post in posts[:2]:
-                if posts and post.title == text(title) and post.author == self.username:
-                    return post.blog, post.post_id
-
-            raise
-        else:
-            return parse_post_url(link)
+        return self.submit_topic('/topic/add/', fields, title, draft, check_if_error)
 
     def add_poll(self, blog_id, title, choices, body, tags, draft=False, check_if_error=False):
         """Создает опрос и возвращает имя блога с номером поста в случае удачи или
@@ -757,33 +991,66 @@ class User(object):
             fields.append(('submit_topic_publish', "Опубликовать"))
 
         try:
-            result = self.send_form('/question/add/', fields, redir=False)
-            data = result.read()
-            error = utils.find_substring(data, b'<ul class="system-message-error">', b'</ul>', with_start=False, with_end=False)
-            if error and b':' in error:
-                error = utils.find_substring(error.decode('utf-8', 'replace'), ':', '</li>', extend=True, with_start=False, with_end=False).strip()
-                raise TabunResultError(error)
-            link = result.headers.get('location')
+            return self.submit_topic('/question/add/', fields, title, draft, check_if_error)
         except TabunResultError:
             raise
         except TabunError:
             if not check_if_error or not self.username:
                 raise
-            url = '/topic/saved/' if draft else '/profile/' + urequest.quote(self.username.encode('utf-8')) + '/created/topics/'
+            return None, None
 
+    def submit_topic(self, url, fields, title, draft=False, check_if_error=False):
+        """Отправляет форму создания поста и возвращает имя блога с номером поста. Используется в add_post и add_poll.
+        При check_if_error=True форма отправляется повторно согласно retry, только если она точно не ушла
+        на сервер (см. RetryPolicy.is_unsent). После остальных ошибок (таймаут, обрыв, 5xx) пост мог добавиться,
+        а медленный сервер может добавлять его до сих пор, поэтому форма больше не отправляется: пост несколько раз
+        ищется по заголовку (см. find_created_post) с паузами retry.check_delays, и если не нашёлся — кидается ошибка.
+        """
+        attempt = 0
+        while True:
             try:
-                posts = self.get_posts(url)
-            except:
-                posts = []
-            posts.reverse()
+                result = self.send_form(url, fields, redir=False)
+                data = result.read()
+                error = utils.find_substring(data, b'<ul class="system-message-error">', b'</ul>', with_start=False, with_end=False)
+                if error and b':' in error:
+                    error = utils.find_substring(error.decode('utf-8', 'replace'), ':', '</li>', extend=True, with_start=False, with_end=False).strip()
+                    raise TabunResultError(error)
+                return parse_post_url(result.headers.get('location'))
+            except TabunResultError:
+                raise
+            except TabunError as exc:
+                if not check_if_error or not self.username:
+                    raise
+                if self.retry is not None and self.retry.is_unsent(exc):
+                    if not self.retry.should_retry(exc, attempt):
+                        raise
+                    time.sleep(self.retry.delay(attempt))
+                    attempt += 1
+                    continue
+                for delay in (self.retry.check_delays if self.retry is not None else (0,)):
+                    time.sleep(delay)
+                    post = self.find_created_post(title, draft)
+                    if post:
+                        return post
+                raise
+
+    def find_created_post(self, title, draft=False):
+        """Ищет среди двух последних постов (или черновиков) пользователя пост с заголовком title
+        и возвращает кортеж (имя блога, номер поста) или None.
+        """
+        url = '/topic/saved/' if draft else '/profile/' + urequest.quote(self.username.encode('utf-8')) + '/created/topics/'
+
+        try:
+            posts = self.get_posts(url)
+        except:
+            posts = []
+        posts.reverse()
 
-            for post in posts[:2]:
-                if posts and post.title == text(title) and post.author == self.username:
-                    return post.blog, post.post_id
+        for post in posts[:2]:
+            if post.title == text(title) and post.author == self.username:
+                return post.blog, post.post_id
 
-            return None, None
-        else:
-            return parse_post_url(link)
+        return None
 
     def create_blog(self, title, url, description, rating_limit=0, closed=False):
         """Создаёт блог и возвращает его url-имя или None в случае неудачи."""
@@ -904,24 +1171,24 @@ class User(object):
         section = section[0]
 
         posts = []
-        for li in section.xpath('div[@class="block-content"]/ul/li'):
+        for li in utils.xpath(section, 'div[@class="block-content"]/ul/li'):
             posts.append(parse_discord(li))
 
         return posts
 
+    @instrument.parser
     def get_posts(self, url="/index/newall/", raw_data=None):
         """Возвращает список постов со страницы или RSS. Если постов нет - кидает исключение TabunError("No post")."""
         if not raw_data:
             req = self.urlopen(url)
             url = req.url
             raw_data = req.read()
-        raw_data = utils.replace_cloudflare_emails(raw_data)
 
         posts = []
 
         f = raw_data.find(b"<rss")
         if f < 250 and f >= 0:
-            node = utils.lxml.etree.fromstring(raw_data)  # pylint: disable=no-member
+            node = utils.lxml.etree.fromstring(utils.replace_cloudflare_emails(raw_data))  # pylint: disable=no-member
             channel = node.find("channel")
             if channel is None:
                 raise TabunError("No RSS channel")
@@ -936,12 +1203,15 @@ class User(object):
 
             return posts
 
-        data = utils.find_substring(raw_data, b"<article ", b"</article> <!-- /.topic -->", extend=True)
-        if not data:
+        region = utils.find_region(raw_data, b"<article ", b"</article> <!-- /.topic -->", extend=True)
+        if not region:
             raise TabunError("No post")
 
         can_be_short = not url.split('?', 1)[0].endswith('.html')
-        escaped_data = utils.escape_comment_contents(utils.escape_topic_contents(data, can_be_short))
+        escaped_data = utils.preprocess_html(
+            raw_data, region[0], region[1],
+            escape_topics=True, may_be_short=can_be_short, escape_comments=True
+        )
         # items = filter(lambda x: not isinstance(x, text_types) and x.tag == "article", utils.parse_html_fragment(escaped_data))
         items = [x for x in utils.parse_html_fragment(escaped_data) if not isinstance(x, text_types) and x.tag == "article"]
         items.reverse()
@@ -953,6 +1223,7 @@ class User(object):
 
         return posts
 
+    @instrument.parser
     def get_post(self, post_id, blog=None, raw_data=None):
         """Возвращает пост по номеру. Рекомендуется указать url-имя блога, чтобы избежать перенаправления и лишнего запроса.
         Если поста нет - кидается исключением TabunError("No post"). В случае проблем с парсингом может вернуть None.
@@ -966,7 +1237,6 @@ class User(object):
             req = self.urlopen(url)
             url = req.url
             raw_data = req.read()
-        raw_data = utils.replace_cloudflare_emails(raw_data)
 
         posts = self.get_posts(url, raw_data=raw_data)
         if not posts:
@@ -981,6 +1251,7 @@ class User(object):
             post.comments_new_count = 0
         return post
 
+    @instrument.parser
     def get_comments(self, url="/comments/", raw_data=None):
         """Возвращает словарь id-комментарий."""
         if not raw_data:
@@ -990,11 +1261,13 @@ class User(object):
             del req
         blog, post_id = parse_post_url(url)
 
-        raw_data = utils.find_substring(raw_data, b'<div class="comments', b'<!-- /content -->', extend=True, with_end=False)
-        if not raw_data:
+        region = utils.find_region(raw_data, b'<div class="comments', b'<!-- /content -->', extend=True, with_end=False)
+        if not region:
             return {}
-        raw_data = utils.replace_cloudflare_emails(raw_data)
-        escaped_data = utils.escape_comment_contents(utils.escape_topic_contents(raw_data, True))
+        escaped_data = utils.preprocess_html(
+            raw_data, region[0], region[1],
+            escape_topics=True, may_be_short=True, escape_comments=True
+        )
         div = utils.parse_html_fragment(escaped_data)
         if not div:
             return {}
@@ -1014,30 +1287,57 @@ class User(object):
         comms = {}
 
         for sect in raw_comms:
-            c = parse_comment(sect, post_id, blog)
+            c = parse_comment_section(sect, post_id, blog)
             if c:
                 comms[c.comment_id] = c
-            else:
-                if sect.get("id", "").find("comment_id_") == 0:
-                    c = parse_deleted_comment(sect, post_id, blog)
-                    if c:
-                        comms[c.comment_id] = c
-                    else:
-                        print("Warning: cannot parse deleted comment %s" % sect.get("id"))
-                else:
-                    print("Warning: unknown comment format %s" % sect.get("id"))
 
         return comms
 
-    def get_blogs_list(self, page=1, order_by="blog_rating", order_way="desc", url=None):
+    def iter_comments(self, url="/comments/", raw_data=None):
+        """Как get_comments, но вместо словаря генерирует комментарии по мере парсинга страницы.
+        Страница разбирается не одним деревом, а по веткам комментов верхнего уровня: каждая ветка
+        парсится отдельно и выбрасывается, как только её комменты отданы, так что в памяти не держится
+        ни дерево всей страницы, ни все объекты Comment сразу — это полезно для постов с тысячами комментов.
+        """
+        if not raw_data:
+            req = self.urlopen(url)
+            url = req.url
+            raw_data = req.read()
+            del req
+        blog, post_id = parse_post_url(url)
+
+        region = utils.find_region(raw_data, b'<div class="comments', b'<!-- /content -->', extend=True, with_end=False)
+        if not region:
+            return
+        escaped_data = utils.preprocess_html(
+            raw_data, region[0], region[1],
+            escape_topics=True, may_be_short=True, escape_comments=True
+        )
+        del raw_data
+
+        for start, end in utils.iter_child_regions(escaped_data):
+            for node in utils.parse_html_fragment(escaped_data[start:end]):
+                if isinstance(node, text_types):
+                    continue
+                if node.tag == 'div' and node.get('class') == 'comment-wrapper':
+                    raw_comms = parse_wrapper(node)
+                elif node.tag == 'section' and "comment" in node.get('class', ''):
+                    # for /comments/ page
+                    raw_comms = [node]
+                else:
+                    continue
+                for sect in raw_comms:
+                    c = parse_comment_section(sect, post_id, blog)
+                    if c:
+                        yield c
+
+    @instrument.parser
+    def get_blogs_list(self, page=1, order_by="blog_rating", order_way="desc", url=None, raw_data=None):
         """Возвращает список объектов Blog."""
-        if not url:
-            url = "/blogs/" + (("page" + text(page) + "/") if page > 1 else "")
-            url += "?order=" + text(order_by)
-            url += "&order_way=" + text(order_way)
+        if not raw_data:
+            raw_data = self.urlopen(url or blogs_list_url(page, order_by, order_way)).read()
 
-        data = self.urlopen(url).read()
-        data = utils.find_substring(data, b'<table class="table table-blogs', b'</table>')
+        data = utils.find_substring(raw_data, b'<table class="table table-blogs', b'</table>')
         node = utils.parse_html_fragment(data)
         if not node:
             return []
@@ -1048,7 +1348,7 @@ class User(object):
         blogs = []
 
         for tr in node.findall("tr"):
-            p = tr.xpath('td[@class="cell-name"]/p')
+            p = utils.xpath(tr, 'td[@class="cell-name"]/p')
             if len(p) == 0:
                 continue
             p = p[0]
@@ -1062,19 +1362,54 @@ class User(object):
             blog = blog[blog.rfind('/') + 1:]
 
             name = text(a.text)
-            closed = bool(p.xpath('i[@class="icon-synio-topic-private"]'))
+            closed = bool(utils.xpath(p, 'i[@class="icon-synio-topic-private"]'))
 
-            cell_readers = tr.xpath('td[@class="cell-readers"]')[0]
+            cell_readers = utils.xpath(tr, 'td[@class="cell-readers"]')[0]
             readers = int(cell_readers.text)
             blog_id = int(cell_readers.get('id').rsplit("_", 1)[-1])
             rating = float(tr.findall("td")[-1].text)
 
-            creator = tr.xpath('td[@class="cell-name"]/span[@class="user-avatar"]/a')[-1].text
+            creator = utils.xpath(tr, 'td[@class="cell-name"]/span[@class="user-avatar"]/a')[-1].text
 
             blogs.append(Blog(blog_id, blog, name, creator, readers, rating, closed))
 
         return blogs
 
+    def iter_pages(self, load, parse, workers=4, start_page=1, last_page=None):
+        """Генератор, выдающий по порядку объекты со всех страниц списка, разбитого на страницы.
+        load(page) загружает и возвращает код страницы, parse(raw_data) — список объектов с неё.
+
+        Номер последней страницы, если не указан last_page, берётся из пагинации первой страницы.
+        Остальные страницы загружаются и парсятся в фоновых потоках, не больше workers одновременно
+        (запросы из них всё равно проходят через limiter), а объекты выдаются в порядке страниц
+        по мере готовности.
+        """
+        raw_data = load(start_page)
+        if last_page is None:
+            last_page = parse_last_page(raw_data, start_page)
+        for item in parse(raw_data):
+            yield item
+        del raw_data
+
+        work = lambda page: parse(load(page))
+        pending = deque()
+        page = start_page + 1
+        while pending or page <= last_page:
+            while page <= last_page and len(pending) < max(1, workers):
+                pending.append(utils.Prefetch(work, page))
+                page += 1
+            for item in pending.popleft().result():
+                yield item
+
+    def iter_blogs_list(self, order_by="blog_rating", order_way="desc", workers=4, start_page=1, last_page=None):
+        """Генератор, выдающий объекты Blog со всех страниц списка блогов (см. iter_pages)."""
+        return self.iter_pages(
+            lambda page: self.urlopen(blogs_list_url(page, order_by, order_way)).read(),
+            lambda raw_data: self.get_blogs_list(raw_data=raw_data),
+            workers, start_page, last_page,
+        )
+
+    @instrument.parser
     def get_blog(self, blog, raw_data=None):
         """Возвращает информацию о блоге. Функция не доделана."""
         blog = text(blog)
@@ -1089,14 +1424,14 @@ class User(object):
         if not node:
             return
 
-        blog_top = node[0].xpath('div[@class="blog-top"]')[0]
-        blog_inner = node[0].xpath('div[@id="blog"]/div[@class="blog-inner"]')[0]
-        blog_footer = node[0].xpath('div[@id="blog"]/footer[@class="blog-footer"]')[0]
+        blog_top = utils.xpath(node[0], 'div[@class="blog-top"]')[0]
+        blog_inner = utils.xpath(node[0], 'div[@id="blog"]/div[@class="blog-inner"]')[0]
+        blog_footer = utils.xpath(node[0], 'div[@id="blog"]/footer[@class="blog-footer"]')[0]
 
-        name = blog_top.xpath('h2/text()[1]')[0].rstrip()
-        closed = len(blog_top.xpath('h2/i[@class="icon-synio-topic-private"]')) > 0
+        name = utils.xpath(blog_top, 'h2/text()[1]')[0].rstrip()
+        closed = len(utils.xpath(blog_top, 'h2/i[@class="icon-synio-topic-private"]')) > 0
 
-        vote_item = blog_top.xpath('div/div[@class="vote-item vote-count"]')[0]
+        vote_item = utils.xpath(blog_top, 'div/div[@class="vote-item vote-count"]')[0]
         vote_count = int(vote_item.get("title", "0").rsplit(" ", 1)[-1])
         blog_id = int(vote_item.find("span").get("id").rsplit("_", 1)[-1])
         vote_total = vote_item.find("span").text
@@ -1105,26 +1440,26 @@ class User(object):
         else:
             vote_total = float(vote_total)
 
-        avatar = blog_inner.xpath("header/img")[0].get("src")
+        avatar = utils.xpath(blog_inner, "header/img")[0].get("src")
 
         content = blog_inner.find("div")
         info = content.find("ul")
 
         description = content.find("div")
-        created = time.strptime(utils.mon2num(info.xpath('li[1]/strong/text()')[0]), "%d %m %Y")
-        posts_count = int(info.xpath('li[2]/strong/text()')[0])
-        readers = int(info.xpath('li[3]/strong/text()')[0])
+        created = time.strptime(utils.mon2num(utils.xpath(info, 'li[1]/strong/text()')[0]), "%d %m %Y")
+        posts_count = int(utils.xpath(info, 'li[2]/strong/text()')[0])
+        readers = int(utils.xpath(info, 'li[3]/strong/text()')[0])
         admins = []
         moderators = []
 
         arr = admins
-        for user in content.xpath('span[@class="user-avatar"]'):
+        for user in utils.xpath(content, 'span[@class="user-avatar"]'):
             t = user.getprevious().getprevious().text
             if t and "Модераторы" in t:
                 arr = moderators
             arr.append(user.text_content().strip())
 
-        creator = blog_footer.xpath("div/a[2]/text()[1]")[0]
+        creator = utils.xpath(blog_footer, "div/a[2]/text()[1]")[0]
 
         return Blog(blog_id, blog, name, creator, readers, vote_total, closed, description, admins, moderators, vote_count, posts_count, created)
 
@@ -1142,6 +1477,7 @@ class User(object):
 
         return (post[0] if post else None), comments
 
+    @instrument.parser
     def get_comments_from(self, post_id, comment_id=0, typ="blog"):
         """Возвращает комментарии к посту, начиная с определённого номера комментария. На сайте используется для подгрузки новых комментариев.
         Тип - blog (пост) или talk (личные сообщения).
@@ -1174,6 +1510,7 @@ class User(object):
 
         return comms
 
+    @instrument.parser
     def get_stream_comments(self):
         """Возвращает «Прямой эфир» - объекты StreamItem."""
         self.check_login()
@@ -1214,6 +1551,7 @@ class User(object):
 
         return items
 
+    @instrument.parser
     def get_stream_topics(self):
         """Возвращает список последних постов (без самого содержимого постов, только автор, дата, заголовки и число комментариев)."""
         data = self.ajax('/ajax/stream/topic/')
@@ -1246,15 +1584,13 @@ class User(object):
         """
         return []
 
-    def get_people_list(self, page=1, order_by="user_rating", order_way="desc", url=None):
+    @instrument.parser
+    def get_people_list(self, page=1, order_by="user_rating", order_way="desc", url=None, raw_data=None):
         """Возвращает список броняш - объекты UserInfo."""
-        if not url:
-            url = "/people/" + ("index/page" + text(page) + "/" if page > 1 else "")
-            url += "?order=" + text(order_by)
-            url += "&order_way=" + text(order_way)
+        if not raw_data:
+            raw_data = self.urlopen(url or people_list_url(page, order_by, order_way)).read()
 
-        data = self.urlopen(url).read()
-        data = utils.find_substring(data, b'<table class="table table-users', b'</table>')
+        data = utils.find_substring(raw_data, b'<table class="table table-users', b'</table>')
         if not data:
             return []
         node = utils.parse_html_fragment(data)
@@ -1267,27 +1603,27 @@ class User(object):
         peoples = []
 
         for tr in node.findall("tr"):
-            username = tr.xpath('td[@class="cell-name"]/div/p[1]/a/text()[1]')
+            username = utils.xpath(tr, 'td[@class="cell-name"]/div/p[1]/a/text()[1]')
             if not username:
                 continue
 
-            realname = tr.xpath('td[@class="cell-name"]/div/p[2]/text()[1]')
+            realname = utils.xpath(tr, 'td[@class="cell-name"]/div/p[2]/text()[1]')
             if not realname:
                 realname = None
             else:
                 realname = text(realname[0])
 
-            skill = tr.xpath('td[@class="cell-skill"]/text()[1]')
+            skill = utils.xpath(tr, 'td[@class="cell-skill"]/text()[1]')
             if not skill:
                 continue
 
-            rating = tr.xpath('td[@class="cell-rating "]/strong/text()[1]')
+            rating = utils.xpath(tr, 'td[@class="cell-rating "]/strong/text()[1]')
             if not rating:
-                rating = tr.xpath('td[@class="cell-rating negative"]/strong/text()[1]')
+                rating = utils.xpath(tr, 'td[@class="cell-rating negative"]/strong/text()[1]')
             if not rating:
                 continue
 
-            userpic = tr.xpath('td[@class="cell-name"]/a/img/@src')
+            userpic = utils.xpath(tr, 'td[@class="cell-name"]/a/img/@src')
             if not userpic:
                 continue
 
@@ -1295,37 +1631,45 @@ class User(object):
 
         return peoples
 
+    def iter_people_list(self, order_by="user_rating", order_way="desc", workers=4, start_page=1, last_page=None):
+        """Генератор, выдающий объекты UserInfo со всех страниц списка пользователей (см. iter_pages)."""
+        return self.iter_pages(
+            lambda page: self.urlopen(people_list_url(page, order_by, order_way)).read(),
+            lambda raw_data: self.get_people_list(raw_data=raw_data),
+            workers, start_page, last_page,
+        )
+
+    @instrument.parser
     def get_profile(self, username=None, raw_data=None):
         if not raw_data:
             raw_data = self.urlopen("/profile/" + urequest.quote(text(username).encode('utf-8'))).read()
 
-        data = utils.find_substring(raw_data, b'<div id="content"', b'<!-- /content ', extend=True, with_end=False)
-        if not data:
+        region = utils.find_region(raw_data, b'<div id="content"', b'<!-- /content ', extend=True, with_end=False)
+        if not region:
             return
-        data = utils.replace_cloudflare_emails(data)
-        node = utils.parse_html_fragment(data)
+        node = utils.parse_html_fragment(utils.preprocess_html(raw_data, region[0], region[1]))
         if not node:
             return
         node = node[0]
 
-        profile = node.xpath('div[@class="profile"]')[0]
+        profile = utils.xpath(node, 'div[@class="profile"]')[0]
 
-        username = profile.xpath('h2[@itemprop="nickname"]/text()')[0]
-        realname = profile.xpath('p[@class="user-name"]/text()')
+        username = utils.xpath(profile, 'h2[@itemprop="nickname"]/text()')[0]
+        realname = utils.xpath(profile, 'p[@class="user-name"]/text()')
 
-        skill = float(profile.xpath('div[@class="strength"]/div[1]/text()')[0])
-        rating = profile.xpath('div[@class="vote-profile"]/div[1]')[0]
+        skill = float(utils.xpath(profile, 'div[@class="strength"]/div[1]/text()')[0])
+        rating = utils.xpath(profile, 'div[@class="vote-profile"]/div[1]')[0]
         user_id = int(rating.get("id").rsplit("_")[-1])
         rating = float(rating.findall('div')[1].find('span').text.strip().replace('+', ''))
 
-        userpic = node.xpath('div[@class="profile-info-about"]/a[1]/img')[0].get('src')
+        userpic = utils.xpath(node, 'div[@class="profile-info-about"]/a[1]/img')[0].get('src')
 
         birthday = None
         registered = None
         last_activity = None
         gender = None
 
-        uls = node.xpath('div[@class="wrapper"]/div[@class="profile-left"]/ul[@class="profile-dotted-list"]/li')
+        uls = utils.xpath(node, 'div[@class="wrapper"]/div[@class="profile-left"]/ul[@class="profile-dotted-list"]/li')
 
         blogs = {
             'owner': [],
@@ -1366,7 +1710,7 @@ class User(object):
                 elif name == 'Состоит в:':
                     blogs['member'] = blist
 
-        description = node.xpath('div[@class="profile-info-about"]/div[@class="text"]')
+        description = utils.xpath(node, 'div[@class="profile-info-about"]/div[@class="text"]')
 
         if registered is None:
             # забагованная учётка Tailsik208 со смайликом >_< (была когда-то)
@@ -1388,6 +1732,7 @@ class User(object):
 
         return UserInfo(user_id, username, realname[0] if realname else None, skill, rating, userpic, foto, gender, birthday, registered, last_activity, description[0] if description else None, blogs)
 
+    @instrument.parser
     def poll_answer(self, post_id, answer=-1):
         """Проголосовать в опросе. -1 - воздержаться. Возвращает новый объект Poll."""
         if answer < -1:
@@ -1469,6 +1814,7 @@ class User(object):
         # TODO: raw_body
         return utils.parse_html_fragment('<div class="text">' + data['sText'] + '</div>')[0]
 
+    @instrument.parser
     def get_editable_post(self, post_id, raw_data=None):
         """Возвращает blog_id, заголовок, исходный код поста, список тегов и галочку закрытия комментариев (True/False)."""
         if not raw_data:
@@ -1489,7 +1835,7 @@ class User(object):
             return None
         form = form[0]
 
-        blog_id = form.xpath('p/select[@id="blog_id"]')[0]
+        blog_id = utils.xpath(form, 'p/select[@id="blog_id"]')[0]
         ok = False
         for x in blog_id.findall("option"):
             if x.get("selected") is not None:
@@ -1499,12 +1845,13 @@ class User(object):
         if not ok:
             blog_id = 0
 
-        title = form.xpath('p/input[@id="topic_title"]')[0].get("value", "")
-        body = form.xpath("textarea")[0].text
-        tags = form.xpath('p/input[@id="topic_tags"]')[0].get("value", "").split(",")
-        forbid_comment = bool(form.xpath('p/label/input[@id="topic_forbid_comment"]')[0].get("checked"))
+        title = utils.xpath(form, 'p/input[@id="topic_title"]')[0].get("value", "")
+        body = utils.xpath(form, "textarea")[0].text
+        tags = utils.xpath(form, 'p/input[@id="topic_tags"]')[0].get("value", "").split(",")
+        forbid_comment = bool(utils.xpath(form, 'p/label/input[@id="topic_forbid_comment"]')[0].get("checked"))
         return blog_id, title, body, tags, forbid_comment
 
+    @instrument.parser
     def get_editable_blog(self, blog_id, raw_data=None):
         """Возвращает заголовок блога, URL, тип (True - закрытый, False - открытый), описание и ограничение рейтинга."""
         if not raw_data:
@@ -1512,25 +1859,24 @@ class User(object):
             raw_data = req.read()
             del req
 
-        raw_data = utils.find_substring(
+        region = utils.find_region(
             raw_data,
             b'<form method="post" enctype="multipart/form-data" class="wrapper-content">',
             b'</form>'
         )
 
-        if not raw_data:
+        if not region:
             return
-        raw_data = utils.replace_cloudflare_emails(raw_data)
-        form = utils.parse_html_fragment(raw_data)
+        form = utils.parse_html_fragment(utils.preprocess_html(raw_data, region[0], region[1]))
         if not form:
             return
         form = form[0]
 
-        blog_title = form.xpath('p/input[@id="blog_title"]')[0].get('value')
-        blog_url = form.xpath('p/input[@id="blog_url"]')[0].get('value')
-        blog_type = form.xpath('p/select[@id="blog_type"]/option[@selected]')[0].get('value')
-        blog_description = form.xpath('p/textarea[@id="blog_description"]/text()[1]')[0].replace('\r\n', '\n')
-        blog_limit_rating_topic = float(form.xpath('p/input[@id="blog_limit_rating_topic"]')[0].get('value'))
+        blog_title = utils.xpath(form, 'p/input[@id="blog_title"]')[0].get('value')
+        blog_url = utils.xpath(form, 'p/input[@id="blog_url"]')[0].get('value')
+        blog_type = utils.xpath(form, 'p/select[@id="blog_type"]/option[@selected]')[0].get('value')
+        blog_description = utils.xpath(form, 'p/textarea[@id="blog_description"]/text()[1]')[0].replace('\r\n', '\n')
+        blog_limit_rating_topic = float(utils.xpath(form, 'p/input[@id="blog_limit_rating_topic"]')[0].get('value'))
 
         return blog_title, blog_url, blog_type == "close", blog_description, blog_limit_rating_topic
 
@@ -1607,6 +1953,7 @@ class User(object):
         if '/talk/read/' in link:
             return int(link.rstrip('/').rsplit('/', 1)[-1])
 
+    @instrument.parser
     def get_talk_list(self, page=1, raw_data=None):
         """Возвращает список объектов Talk с личными сообщениями."""
         self.check_login()
@@ -1615,22 +1962,60 @@ class User(object):
             raw_data = req.read()
             del req
 
-        raw_data = utils.find_substring(raw_data, b'<table ', b'</table>')
-        if not raw_data:
+        region = utils.find_region(raw_data, b'<table ', b'</table>')
+        if not region:
             return []
 
-        raw_data = utils.replace_cloudflare_emails(raw_data)
-        node = utils.parse_html_fragment(raw_data)[0]
+        node = utils.parse_html_fragment(utils.preprocess_html(raw_data, region[0], region[1]))[0]
 
         elems = []
 
-        for elem in node.xpath('//tr')[1:]:
+        for elem in utils.xpath(node, '//tr')[1:]:
             elem = parse_talk_item(elem)
             if elem:
                 elems.append(elem)
 
         return elems
 
+    def iter_talk_list(self, since_id=None, since_date=None, start_page=1):
+        """Генератор, лениво листающий страницы личных сообщений начиная с самых новых.
+        Пропускает беседы с номером не больше since_id и беседы старее даты since_date
+        (struct_time, как в TalkItem.date, или datetime.date). Беседы отсортированы по последней
+        активности, а TalkItem.date — дата создания беседы, так что старая беседа с новым ответом
+        может оказаться где угодно среди новых. Поэтому листание останавливается только на последней
+        странице или на странице, где все беседы старее since_date.
+        """
+        if since_date is not None and not isinstance(since_date, time.struct_time):
+            since_date = since_date.timetuple()
+
+        page = start_page
+        prev_ids = None
+        while True:
+            try:
+                talks = self.get_talk_list(page)
+            except TabunError as exc:
+                if exc.code == 404:
+                    return
+                raise
+            ids = [x.talk_id for x in talks]
+            # на несуществующей странице движок может снова показать последнюю
+            if not talks or ids == prev_ids:
+                return
+            prev_ids = ids
+
+            all_old = since_date is not None
+            for talk in talks:
+                if since_date is not None and talk.date[:3] < since_date[:3]:
+                    continue
+                all_old = False
+                if since_id is not None and talk.talk_id <= since_id:
+                    continue
+                yield talk
+            if all_old:
+                return
+            page += 1
+
+    @instrument.parser
     def get_talk(self, talk_id, raw_data=None):
         """Возвращает объект Talk беседы с переданным номером."""
         self.check_login()
@@ -1639,67 +2024,54 @@ class User(object):
             raw_data = req.read()
             del req
 
-        data = utils.find_substring(raw_data, b"<article ", b"</article>", extend=True)
-        if not data:
+        region = utils.find_region(raw_data, b"<article ", b"</article>", extend=True)
+        if not region:
             return
 
-        data = utils.replace_cloudflare_emails(data)
-        item = utils.parse_html_fragment(data)[0]
+        item = utils.parse_html_fragment(utils.preprocess_html(raw_data, region[0], region[1]))[0]
         title = item.find("header").find("h1").text
-        body = item.xpath('div[@class="topic-content text"]')
+        body = utils.xpath(item, 'div[@class="topic-content text"]')
         if len(body) == 0:
             return
         body = body[0]
 
-        recipients = map(lambda x: x.text.strip(), item.xpath('div[@class="talk-search talk-recipients"]/header/a[@class!="link-dotted"]'))
+        recipients = map(lambda x: x.text.strip(), utils.xpath(item, 'div[@class="talk-search talk-recipients"]/header/a[@class!="link-dotted"]'))
 
         footer = item.find("footer")
-        author = footer.xpath('ul/li[@class="topic-info-author"]/a[2]/text()')[0].strip()
-        date = footer.xpath('ul/li[@class="topic-info-date"]/time')[0]
+        author = utils.xpath(footer, 'ul/li[@class="topic-info-author"]/a[2]/text()')[0].strip()
+        date = utils.xpath(footer, 'ul/li[@class="topic-info-date"]/time')[0]
         date = time.strptime(date.get("datetime")[:-6], "%Y-%m-%dT%H:%M:%S")
 
         comments = self.get_comments(raw_data=raw_data)
 
         return TalkItem(talk_id, recipients, False, title, date, body, author, comments)
 
-    def get_activity(self, url='/stream/all/', raw_data=None):
-        """Возвращает список последних событий."""
+    @instrument.parser
+    def get_activity(self, url='/stream/all/', raw_data=None, types=None):
+        """Возвращает список последних событий. Если указан types (типы ActivityItem), события других типов пропускаются."""
         if not raw_data:
             req = self.urlopen(url)
             raw_data = req.read()
             del req
 
-        raw_data = utils.find_substring(raw_data, b'<ul class="stream-list', b'<!-- /content', with_end=False)
-        if not raw_data:
-            return []
-        raw_data = utils.replace_cloudflare_emails(raw_data)
-        node = utils.parse_html_fragment(raw_data[:raw_data.rfind(b'</ul>')])
-        if not node:
+        found = find_activity_nodes(raw_data)
+        if found is None:
             return []
-        node = node[0]
+        last_id, nodes = found
+        return last_id, parse_activity_list(nodes, last_id, types)
 
-        inp = b'<input type="hidden" id="stream_last_id" value="'
-        if raw_data.rfind(inp) > 0:
-            last_id = raw_data[raw_data.rfind(inp) + len(inp):]
-            last_id = int(last_id[:last_id.find(b'"')])
-        else:
-            last_id = -1
-
-        items = []
-
-        for li in node.findall('li'):
-            if not li.get('class', '').startswith('stream-item'):
-                continue
-            item = parse_activity(li)
-            if item:
-                items.append(item)
-
-        if item:
-            item.id = last_id
-        return last_id, items
+    @instrument.parser
+    def get_more_activity(self, last_id=0x7fffffff, types=None, raw_data=None):
+        """Возвращает список событий старее данного id. Если указан types (типы ActivityItem), события других типов пропускаются.
+        raw_data — уже полученный ответ fetch_more_activity(last_id).
+        """
+        if not raw_data:
+            raw_data = self.fetch_more_activity(last_id)
+        last_id, nodes = find_more_activity_nodes(self.decode_ajax(raw_data))
+        return last_id, parse_activity_list(nodes, last_id, types)
 
-    def get_more_activity(self, last_id=0x7fffffff):
-        """Возвращает список событий старее данного id."""
+    def fetch_more_activity(self, last_id=0x7fffffff):
+        """Загружает и возвращает без разбора json-ответ с событиями старее данного id (см. get_more_activity)."""
         self.check_login()
 
         fields = {
@@ -1707,29 +2079,146 @@ class User(object):
             'security_ls_key': self.security_ls_key,
         }
 
-        data = self.send_form("/stream/get_more_all/", fields).read()
-        result = self.jd.decode(data.decode('utf-8'))
-        if result['bStateError']:
-            raise TabunResultError(result['sMsg'])
+        return self.send_form("/stream/get_more_all/", fields).read()
 
-        items = []
+    def iter_activity(self, until_date=None, until_id=None, types=None, last_id=None, prefetch=True):
+        """Генератор, листающий ленту активности от новых событий к старым. Выдаёт кортежи (last_id, items),
+        как get_activity и get_more_activity: last_id — номер самого старого события порции.
+
+        * until_date — дата (struct_time, datetime или date), события старее которой не нужны: на них обход заканчивается
+        * until_id — номер события, дальше которого не листать: порция, дошедшая до него, будет последней
+        * types — типы ActivityItem; события других типов пропускаются ещё до разбора
+        * last_id — продолжить прерванный обход: last_id последней обработанной порции
+          (без него обход начинается со страницы /stream/all/)
+        * prefetch — загружать и парсить следующую порцию в фоновом потоке, пока текущая разбирается на события
+          и обрабатывается вызывающим кодом
+
+        Обход заканчивается и тогда, когда лента кончилась.
+        """
+        if until_date is not None and not isinstance(until_date, time.struct_time):
+            until_date = until_date.timetuple()
+        if types is not None:
+            types = frozenset(types)
+
+        def load(last_id):
+            if last_id is None:
+                return find_activity_nodes(self.urlopen('/stream/all/').read())
+            return find_more_activity_nodes(self.decode_ajax(self.fetch_more_activity(last_id)))
+
+        def is_older(li):
+            date = parse_activity_date(li)
+            return date is not None and date[:6] < until_date[:6]
+
+        def start(last_id):
+            if prefetch:
+                return utils.Prefetch(load, last_id).result
+            return lambda: load(last_id)
+
+        pending = start(last_id)
+        while True:
+            found = pending()
+            if not found or not found[1]:
+                return
+            chunk_id, nodes = found
+            more = chunk_id > 0 and chunk_id != last_id and (until_id is None or chunk_id > until_id)
+
+            if until_date is not None and is_older(nodes[-1]):
+                # события идут от новых к старым, так что границу можно найти делением пополам
+                lo, hi = 0, len(nodes) - 1
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if is_older(nodes[mid]):
+                        hi = mid
+                    else:
+                        lo = mid + 1
+                nodes = nodes[:lo]
+                more = False
+
+            if more:
+                pending = start(chunk_id)
+            yield chunk_id, parse_activity_list(nodes, chunk_id, types)
+            if not more:
+                return
+            last_id = chunk_id
+
+
+def find_activity_nodes(raw_data):
+    """Находит ленту на странице активности. Возвращает кортеж (last_id, список элементов li с событиями)
+    или None, если ленты на странице нет.
+    """
+    region = utils.find_region(raw_data, b'<ul class="stream-list', b'<!-- /content', with_end=False)
+    if not region:
+        return
+    end = raw_data.rfind(b'</ul>', region[0], region[1])
+    node = utils.parse_html_fragment(utils.preprocess_html(raw_data, region[0], end if end >= 0 else region[1]))
+    if not node:
+        return
+
+    inp = b'<input type="hidden" id="stream_last_id" value="'
+    f = raw_data.rfind(inp, region[0], region[1])
+    if f > region[0]:
+        f += len(inp)
+        last_id = int(raw_data[f:raw_data.find(b'"', f)])
+    else:
+        last_id = -1
+
+    return last_id, [li for li in node[0].findall('li') if li.get('class', '').startswith('stream-item')]
 
-        last_id = int(result.get('iStreamLastId', 0))
-        item = None
-        for li in utils.parse_html_fragment(result['result']):
-            if li.tag != 'li' or not li.get('class', '').startswith('stream-item'):
-                continue
-            item = parse_activity(li)
-            if item:
-                items.append(item)
 
+def find_more_activity_nodes(result):
+    """То же, что find_activity_nodes, но для декодированного json-ответа fetch_more_activity."""
+    nodes = [
+        li for li in utils.parse_html_fragment(result['result'])
+        if li.tag == 'li' and li.get('class', '').startswith('stream-item')
+    ]
+    return int(result.get('iStreamLastId', 0)), nodes
+
+
+def parse_activity_list(nodes, last_id, types=None):
+    """Разбирает элементы li ленты активности в список ActivityItem; последнему из них проставляется id = last_id."""
+    items = []
+    item = None
+    for li in nodes:
+        item = parse_activity(li, types)
         if item:
-            item.id = last_id
-        return last_id, items
+            items.append(item)
+
+    if item:
+        item.id = last_id
+    return items
+
+
+#: Классы элементов ленты активности и соответствующие им типы событий.
+activity_classes = {
+    'stream-item-type-add_topic': ActivityItem.POST_ADD,
+    'stream-item-type-add_comment': ActivityItem.COMMENT_ADD,
+    'stream-item-type-add_blog': ActivityItem.BLOG_ADD,
+    'stream-item-type-vote_topic': ActivityItem.POST_VOTE,
+    'stream-item-type-vote_comment': ActivityItem.COMMENT_VOTE,
+    'stream-item-type-vote_blog': ActivityItem.BLOG_VOTE,
+    'stream-item-type-vote_user': ActivityItem.USER_VOTE,
+    'stream-item-type-add_friend': ActivityItem.FRIEND_ADD,
+    'stream-item-type-join_blog': ActivityItem.JOIN_BLOG,
+}
 
 
-def parse_activity(item):
-    classes = item.get('class').split()
+def parse_activity_date(item):
+    """Возвращает дату события ленты активности (struct_time) или None."""
+    date = utils.xpath(item, 'p[@class="info"]/span[@class="date"]')[0].get('title')
+    if not date:
+        return
+    return time.strptime(utils.mon2num(date), "%d %m %Y, %H:%M")
+
+
+def parse_activity(item, types=None):
+    # Парсинг события. Не надо юзать эту функцию. Типы не из types (если он указан) отбрасываются до разбора.
+    typ = None
+    for cls in item.get('class').split():
+        typ = activity_classes.get(cls)
+        if typ is not None:
+            break
+    if typ is None or (types is not None and typ not in types):
+        return
 
     post_id = None
     comment_id = None
@@ -1738,68 +2227,55 @@ def parse_activity(item):
     data = None
     date = None
 
-    if 'stream-item-type-add_topic' in classes:
-        typ = ActivityItem.POST_ADD
-        href = item.xpath('a[2]')[0].get('href')
+    if typ == ActivityItem.POST_ADD:
+        href = utils.xpath(item, 'a[2]')[0].get('href')
         blog, post_id = parse_post_url(href)
-        title = item.xpath('a[2]/text()[1]')[0]
+        title = utils.xpath(item, 'a[2]/text()[1]')[0]
 
-    elif 'stream-item-type-add_comment' in classes:
-        typ = ActivityItem.COMMENT_ADD
-        href = item.xpath('a[2]')[0].get('href')
+    elif typ == ActivityItem.COMMENT_ADD:
+        href = utils.xpath(item, 'a[2]')[0].get('href')
         blog, post_id = parse_post_url(href)
         comment_id = int(href[href.rfind("#comment") + 8:])
-        data = item.xpath('div/text()')
+        data = utils.xpath(item, 'div/text()')
         data = data[0] if data else None
-        title = item.xpath('a[2]/text()[1]')[0]
+        title = utils.xpath(item, 'a[2]/text()[1]')[0]
 
-    elif 'stream-item-type-add_blog' in classes:
-        typ = ActivityItem.BLOG_ADD
-        href = item.xpath('a[2]')[0].get('href')[:-1]
+    elif typ == ActivityItem.BLOG_ADD:
+        href = utils.xpath(item, 'a[2]')[0].get('href')[:-1]
         blog = href[href.rfind('/') + 1:]
-        title = item.xpath('a[2]/text()[1]')[0]
+        title = utils.xpath(item, 'a[2]/text()[1]')[0]
 
-    elif 'stream-item-type-vote_topic' in classes:
-        typ = ActivityItem.POST_VOTE
-        href = item.xpath('a[2]')[0].get('href')
+    elif typ == ActivityItem.POST_VOTE:
+        href = utils.xpath(item, 'a[2]')[0].get('href')
         blog, post_id = parse_post_url(href)
-        title = item.xpath('a[2]/text()[1]')[0]
+        title = utils.xpath(item, 'a[2]/text()[1]')[0]
 
-    elif 'stream-item-type-vote_comment' in classes:
-        typ = ActivityItem.COMMENT_VOTE
-        href = item.xpath('a[2]')[0].get('href')
+    elif typ == ActivityItem.COMMENT_VOTE:
+        href = utils.xpath(item, 'a[2]')[0].get('href')
         blog, post_id = parse_post_url(href)
         comment_id = int(href[href.rfind("#comment") + 8:])
-        title = item.xpath('a[2]/text()[1]')[0]
+        title = utils.xpath(item, 'a[2]/text()[1]')[0]
 
-    elif 'stream-item-type-vote_blog' in classes:
-        typ = ActivityItem.BLOG_VOTE
-        href = item.xpath('a[2]')[0].get('href')[:-1]
+    elif typ == ActivityItem.BLOG_VOTE:
+        href = utils.xpath(item, 'a[2]')[0].get('href')[:-1]
         blog = href[href.rfind('/') + 1:]
-        title = item.xpath('a[2]/text()[1]')[0]
+        title = utils.xpath(item, 'a[2]/text()[1]')[0]
 
-    elif 'stream-item-type-vote_user' in classes:
-        typ = ActivityItem.USER_VOTE
-        data = item.xpath('span/a[2]/text()')[0]
+    elif typ == ActivityItem.USER_VOTE:
+        data = utils.xpath(item, 'span/a[2]/text()')[0]
 
-    elif 'stream-item-type-add_friend' in classes:
-        typ = ActivityItem.FRIEND_ADD
-        data = item.xpath('span/a[2]/text()')[0]
+    elif typ == ActivityItem.FRIEND_ADD:
+        data = utils.xpath(item, 'span/a[2]/text()')[0]
 
-    elif 'stream-item-type-join_blog' in classes:
-        typ = ActivityItem.JOIN_BLOG
-        href = item.xpath('a[2]')[0].get('href')[:-1]
+    elif typ == ActivityItem.JOIN_BLOG:
+        href = utils.xpath(item, 'a[2]')[0].get('href')[:-1]
         blog = href[href.rfind('/') + 1:]
-        title = item.xpath('a[2]/text()[1]')[0]
+        title = utils.xpath(item, 'a[2]/text()[1]')[0]
 
-    else:
-        return
-
-    username = item.xpath('p[@class="info"]/a/strong/text()[1]')[0]
-    date = item.xpath('p[@class="info"]/span[@class="date"]')[0].get('title')
+    username = utils.xpath(item, 'p[@class="info"]/a/strong/text()[1]')[0]
+    date = parse_activity_date(item)
     if not date:
         return
-    date = time.strptime(utils.mon2num(date), "%d %m %Y, %H:%M")
     return ActivityItem(typ, date, post_id, comment_id, blog, username, title, data)
 
 
@@ -1817,9 +2293,9 @@ def parse_post(item):
     else:
         # если ссылки нет, то костыляем: достаём блог из ссылки на него
         blog = None
-        link = header.xpath('div/a[@class="topic-blog"]')
+        link = utils.xpath(header, 'div/a[@class="topic-blog"]')
         if not link:
-            link = header.xpath('div/a[@class="topic-blog private-blog"]')
+            link = utils.xpath(header, 'div/a[@class="topic-blog private-blog"]')
         if link:
             link = link[0].get('href')
             if link and '/blog/' in link:
@@ -1829,7 +2305,7 @@ def parse_post(item):
             raise ValueError('Cannot get blog from post "%s"' % title.text_content())
 
         # достаём номер поста из блока с рейтингом
-        vote_elem = header.xpath('div/div[@class="topic-info-vote"]/div')
+        vote_elem = utils.xpath(header, 'div/div[@class="topic-info-vote"]/div')
         if vote_elem and vote_elem[0].get('id'):
             post_id = int(vote_elem[0].get('id').rsplit('_', 1)[-1])
         else:
@@ -1837,31 +2313,31 @@ def parse_post(item):
         del vote_elem
     del link
 
-    author = header.xpath('div/a[@rel="author"]/text()[1]')
+    author = utils.xpath(header, 'div/a[@rel="author"]/text()[1]')
     if len(author) == 0:
         return
     author = author[0]
 
     title = title.text_content().strip()
-    private = bool(header.xpath('div/a[@class="topic-blog private-blog"]'))
+    private = bool(utils.xpath(header, 'div/a[@class="topic-blog private-blog"]'))
 
-    blog_name = header.xpath('div/a[@class="topic-blog"]/text()[1]')
+    blog_name = utils.xpath(header, 'div/a[@class="topic-blog"]/text()[1]')
     if not blog_name:
-        blog_name = header.xpath('div/a[@class="topic-blog private-blog"]/text()[1]')
+        blog_name = utils.xpath(header, 'div/a[@class="topic-blog private-blog"]/text()[1]')
     if len(blog_name) > 0:
         blog_name = text(blog_name[0])
     else:
         blog_name = None
 
-    post_time = item.xpath('footer/ul/li[1]/time')
+    post_time = utils.xpath(item, 'footer/ul/li[1]/time')
     if not post_time:
-        post_time = item.xpath('header/div[@class="topic-info"]/time')  # mylittlebrony.ru
+        post_time = utils.xpath(item, 'header/div[@class="topic-info"]/time')  # mylittlebrony.ru
     if post_time:
         post_time = time.strptime(post_time[0].get("datetime")[:-6], "%Y-%m-%dT%H:%M:%S")
     else:
         post_time = time.localtime()
 
-    body = item.xpath('div[@class="topic-content text"]')
+    body = utils.xpath(item, 'div[@class="topic-content text"]')
     if len(body) == 0:
         return
     body = body[0]
@@ -1876,7 +2352,7 @@ def parse_post(item):
         raw_body = None
 
         # чистим от topic-actions, а также сносим мусорные отступы
-        post_header = body.xpath('header[@class="topic-header"]')
+        post_header = utils.xpath(body, 'header[@class="topic-header"]')
         if post_header:
             post_header = post_header[0]
             body.remove(post_header)
@@ -1889,7 +2365,7 @@ def parse_post(item):
                 body.text = body.text.lstrip()
         body.tail = ""
 
-        nextbtn = body.xpath('a[@title="Читать дальше"][1]')
+        nextbtn = utils.xpath(body, 'a[@title="Читать дальше"][1]')
         is_short = len(nextbtn) > 0
         if is_short:
             body.remove(nextbtn[-1])
@@ -1908,9 +2384,9 @@ def parse_post(item):
                 continue
             tags.append(text(ntag.text))
 
-    draft = bool(header.xpath('h1/i[@class="icon-synio-topic-draft"]'))
+    draft = bool(utils.xpath(header, 'h1/i[@class="icon-synio-topic-draft"]'))
 
-    rateelem = header.xpath('div[@class="topic-info"]/div[@class="topic-info-vote"]/div/div[@class="vote-item vote-count"]')
+    rateelem = utils.xpath(header, 'div[@class="topic-info"]/div[@class="topic-info-vote"]/div/div[@class="vote-item vote-count"]')
     if rateelem:
         rateelem = rateelem[0]
 
@@ -1924,16 +2400,16 @@ def parse_post(item):
         vote_count = -1
         vote_total = 0
 
-    poll = item.xpath('div[@class="poll"]')
+    poll = utils.xpath(item, 'div[@class="poll"]')
     if poll:
         poll = parse_poll(poll[0])
 
-    fav = footer.xpath('ul[@class="topic-info"]/li[starts-with(@class, "topic-info-favourite")]')[0]
+    fav = utils.xpath(footer, 'ul[@class="topic-info"]/li[starts-with(@class, "topic-info-favourite")]')[0]
     favourited = fav.get('class').endswith(' active')
     if not favourited:
         i = fav.find('i')
         favourited = i is not None and i.get('class', '').endswith(' active')
-    favourite = fav.xpath('span[@class="favourite-count"]/text()')
+    favourite = utils.xpath(fav, 'span[@class="favourite-count"]/text()')
     try:
         favourite = int(favourite[0]) if favourite and favourite[0] else 0
     except ValueError:
@@ -1942,7 +2418,7 @@ def parse_post(item):
     comments_count = None
     comments_new_count = None
     download_count = None
-    for li in footer.xpath('ul[@class="topic-info"]/li[@class="topic-info-comments"]'):
+    for li in utils.xpath(footer, 'ul[@class="topic-info"]/li[@class="topic-info-comments"]'):
         a = li.find('a')
         if a is None:
             continue
@@ -1964,7 +2440,7 @@ def parse_post(item):
         dname = None
         dsize = None
 
-        dlink = item.xpath('div[@class="download"]')
+        dlink = utils.xpath(item, 'div[@class="download"]')
         if dlink:
             dlink = dlink[0].find('a')
         else:
@@ -1986,7 +2462,7 @@ def parse_post(item):
         del dlink
 
     if not download:
-        post_link = item.xpath('div[@class="topic-url"]/a')
+        post_link = utils.xpath(item, 'div[@class="topic-url"]/a')
         if post_link:
             link_count = int(post_link[0].get("title", "0").rsplit(" ", 1)[-1])
             post_link = post_link[0].text.strip()
@@ -2006,11 +2482,11 @@ def parse_poll(poll):
         items = []
         for li in ul.findall('li'):
             item = [None, 0.0, 0]
-            item[0] = li.xpath('dl/dd/text()[1]')[0].strip()
-            item[1] = float(li.xpath('dl/dt/strong/text()[1]')[0][:-1])
-            item[2] = int(li.xpath('dl/dt/span/text()[1]')[0][1:-1])
+            item[0] = utils.xpath(li, 'dl/dd/text()[1]')[0].strip()
+            item[1] = float(utils.xpath(li, 'dl/dt/strong/text()[1]')[0][:-1])
+            item[2] = int(utils.xpath(li, 'dl/dt/span/text()[1]')[0][1:-1])
             items.append(item)
-        poll_total = poll.xpath('div[@class="poll-total"]/text()')[-2:]
+        poll_total = utils.xpath(poll, 'div[@class="poll-total"]/text()')[-2:]
         total = int(poll_total[-2].rsplit(" ", 1)[-1])
         notvoted = int(poll_total[-1].rsplit(" ", 1)[-1])
         return Poll(total, notvoted, items)
@@ -2021,7 +2497,7 @@ def parse_poll(poll):
         items = []
         for li in ul.findall('li'):
             item = [None, -1.0, -1]
-            item[0] = li.xpath('label/text()[1]')[0].strip()
+            item[0] = utils.xpath(li, 'label/text()[1]')[0].strip()
             items.append(item)
         return Poll(-1, -1, items)
 
@@ -2074,7 +2550,7 @@ def parse_rss_post(item):
         return
     node = utils.parse_html_fragment("<div class='topic-content text'>" + node + '</div>')[0]
 
-    nextbtn = node.xpath('a[@title="Читать дальше"][1]')
+    nextbtn = utils.xpath(node, 'a[@title="Читать дальше"][1]')
     if len(nextbtn) > 0:
         node.remove(nextbtn[0])
 
@@ -2102,21 +2578,34 @@ def parse_wrapper(node):
         if "comment" not in sect.get('class'):
             break
         comms.append(sect)
-        nodes.extend(node.xpath('div[@class="comment-wrapper"]'))
+        nodes.extend(utils.xpath(node, 'div[@class="comment-wrapper"]'))
     return comms
 
 
+def parse_comment_section(sect, post_id, blog=None):
+    # Парсинг коммента, в том числе удалённого. Не надо юзать эту функцию.
+    c = parse_comment(sect, post_id, blog)
+    if c:
+        return c
+    if sect.get("id", "").find("comment_id_") == 0:
+        c = parse_deleted_comment(sect, post_id, blog)
+        if not c:
+            print("Warning: cannot parse deleted comment %s" % sect.get("id"))
+        return c
+    print("Warning: unknown comment format %s" % sect.get("id"))
+
+
 def parse_comment(node, post_id, blog=None, parent_id=None):
     # И это тоже парсинг коммента. Не надо юзать эту функцию.
     body = None
     try:
-        info = node.xpath('ul[@class="comment-info"]')
+        info = utils.xpath(node, 'ul[@class="comment-info"]')
         if len(info) == 0:
-            info = node.xpath('div[@class="comment-path"]/ul[@class="comment-info"]')[0]
+            info = utils.xpath(node, 'div[@class="comment-path"]/ul[@class="comment-info"]')[0]
         else:
             info = info[0]
 
-        comment_id = info.xpath('li[@class="comment-link"]/a')[0].get('href')
+        comment_id = utils.xpath(info, 'li[@class="comment-link"]/a')[0].get('href')
         if '#comment' in comment_id:
             comment_id = int(comment_id.rsplit('#comment', 1)[-1])
         else:
@@ -2129,7 +2618,7 @@ def parse_comment(node, post_id, blog=None, parent_id=None):
         is_author = "comment-author" in node.get("class", "")
         is_self = "comment-self" in node.get("class", "")
 
-        body = node.xpath('div[@class="comment-content"][1]/div')[0]
+        body = utils.xpath(node, 'div[@class="comment-content"][1]/div')[0]
         raw_body = None
         if body is not None:
             if body.get('data-escaped') == '1':
@@ -2154,9 +2643,9 @@ def parse_comment(node, post_id, blog=None, parent_id=None):
                 link = info
             else:
                 link = link[-1]
-            link1 = link.xpath('a[@class="comment-path-topic"]')[0]
+            link1 = utils.xpath(link, 'a[@class="comment-path-topic"]')[0]
             post_title = link1.text
-            link2 = link.xpath('a[@class="comment-path-comments"]')[0]
+            link2 = utils.xpath(link, 'a[@class="comment-path-comments"]')[0]
             link2 = link2.get('href')
             blog, post_id = parse_post_url(link2)
         except KeyboardInterrupt:
@@ -2165,7 +2654,7 @@ def parse_comment(node, post_id, blog=None, parent_id=None):
             pass
 
         if not parent_id:
-            parent_id = info.xpath('li[@class="goto goto-comment-parent"]')
+            parent_id = utils.xpath(info, 'li[@class="goto goto-comment-parent"]')
             if len(parent_id) > 0:
                 parent_id = parent_id[0].find("a")
                 if parent_id.get('onclick'):
@@ -2175,14 +2664,14 @@ def parse_comment(node, post_id, blog=None, parent_id=None):
             else:
                 parent_id = None
 
-        vote = info.xpath('li[starts-with(@id, "vote_area_comment")]/span[@class="vote-count"]/text()[1]')
+        vote = utils.xpath(info, 'li[starts-with(@id, "vote_area_comment")]/span[@class="vote-count"]/text()[1]')
         if vote:
             vote = int(vote[0].replace("+", ""))
         else:
             vote = 0
 
         favourited = False
-        favourite = info.xpath('li[@class="comment-favourite"]')
+        favourite = utils.xpath(info, 'li[@class="comment-favourite"]')
         if not favourite:
             favourite = None
         else:
@@ -2232,7 +2721,7 @@ def parse_talk_item(node):
     recipients = []
     for x in recs.findall("a"):
         recipients.append(x.text.strip())
-    unread = bool(title.xpath('a/strong'))
+    unread = bool(utils.xpath(title, 'a/strong'))
     talk_id = title.find("a").get('href')[:-1]
     talk_id = int(talk_id[talk_id.rfind("/") + 1:])
     title = title.find("a").text_content()
@@ -2242,6 +2731,26 @@ def parse_talk_item(node):
     return TalkItem(talk_id, recipients, unread, title, date)
 
 
+def blogs_list_url(page=1, order_by="blog_rating", order_way="desc"):
+    """Возвращает ссылку на страницу списка блогов."""
+    url = "/blogs/" + (("page" + text(page) + "/") if page > 1 else "")
+    return url + "?order=" + text(order_by) + "&order_way=" + text(order_way)
+
+
+def people_list_url(page=1, order_by="user_rating", order_way="desc"):
+    """Возвращает ссылку на страницу списка пользователей."""
+    url = "/people/" + ("index/page" + text(page) + "/" if page > 1 else "")
+    return url + "?order=" + text(order_by) + "&order_way=" + text(order_way)
+
+
+def parse_last_page(raw_data, page=1):
+    """Возвращает номер последней страницы списка по ссылкам в пагинации (page — номер переданной страницы)."""
+    pagination = utils.find_substring(raw_data, b'<div class="pagination', b'</div>')
+    if not pagination:
+        return page
+    return max([page] + [int(x) for x in page_link_regex.findall(pagination)])
+
+
 def parse_post_url(link):
     """Выдирает блог и номер поста из ссылки. Или возвращает (None, None), если выдрать не удалось."""
     if not link:
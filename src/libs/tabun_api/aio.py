@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Асинхронная обёртка над User для asyncio (только Python 3).
+
+Методы AsyncUser возвращают asyncio.Future, которые можно ждать через await (или yield from).
+Сетевые запросы выполняются в пуле потоков, а парсинг — теми же функциями,
+что и в синхронном User (через параметр raw_data), поэтому результаты у них одинаковые.
+Интервал query_interval соблюдается через тот же User.limiter, что и в синхронных запросах,
+но очереди ждёт не поток, а loop.call_later.
+
+Пример::
+
+    auser = AsyncUser(login='user', passwd='password')
+    talks = await auser.get_talk_list()
+    talks = await asyncio.gather(*[auser.get_talk(x.talk_id) for x in talks])
+"""
+
+from __future__ import unicode_literals
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from . import User, utils
+from .compat import text
+
+
+class AsyncUser(object):
+    """Асинхронный клиент. Принимает готовый объект user или параметры для конструктора User.
+
+    * max_workers — сколько запросов и парсингов могут выполняться одновременно
+    * loop — event loop, по умолчанию текущий
+
+    Обратите внимание, что конструктор User при логине делает запросы синхронно.
+    """
+
+    def __init__(self, user=None, loop=None, max_workers=8, **user_kwargs):
+        self.user = user if user is not None else User(**user_kwargs)
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        # чтобы параллельные запросы не выкидывали друг у друга соединения из пула
+        if self.user.pool is not None:
+            self.user.pool.maxsize = max(self.user.pool.maxsize, max_workers)
+
+    def close(self):
+        """Останавливает пул потоков."""
+        self.executor.shutdown(wait=False)
+
+    def run(self, func, *args):
+        """Выполняет func(*args) в пуле потоков и возвращает Future с результатом."""
+        return self.loop.run_in_executor(self.executor, func, *args)
+
+    def then(self, future, func, *args):
+        """Возвращает Future, в которую попадёт результат func(результат future, *args), выполненной в пуле потоков."""
+        result = self.loop.create_future()
+
+        def on_done(f):
+            if result.cancelled():
+                return
+            if f.cancelled():
+                result.cancel()
+            elif f.exception() is not None:
+                result.set_exception(f.exception())
+            else:
+                chain(self.run(func, f.result(), *args), result)
+
+        future.add_done_callback(on_done)
+        return result
+
+    def schedule(self, nowait, func, *args):
+        """Запускает func(*args) в пуле потоков, соблюдая query_interval пользователя."""
+        delay = 0 if nowait else self.user.limiter.reserve()
+        if delay <= 0:
+            return self.run(func, *args)
+
+        result = self.loop.create_future()
+        self.loop.call_later(delay, lambda: result.cancelled() or chain(self.run(func, *args), result))
+        return result
+
+    def urlopen(self, url, data=None, headers=None, redir=True, nowait=False, with_cookies=True, timeout=None):
+        """Аналог User.urlopen. Future возвращает объект ответа (addinfourl)."""
+        req = self.user.build_request(url, data, headers, with_cookies)
+        return self.schedule(nowait, self.user.do_request, req, redir, timeout)
+
+    def read(self, url, data=None, headers=None, redir=True):
+        """Future возвращает кортеж (итоговый url, тело ответа)."""
+        return self.then(self.urlopen(url, data, headers, redir), lambda resp: (resp.url, resp.read()))
+
+    def send_form(self, url, fields=(), files=(), headers=None, redir=True):
+        """Аналог User.send_form."""
+        data = utils.MultipartBody(fields, files)
+        headers = dict(headers or ())
+        headers['content-type'] = data.content_type
+        headers['content-length'] = text(len(data))
+        return self.urlopen(url, data, headers, redir)
+
+    def ajax(self, url, fields=None, files=(), headers=None, throw_if_error=True):
+        """Аналог User.ajax. Future возвращает распарсенный json-ответ."""
+        self.user.check_login()
+        headers = dict(headers or ())
+        headers['x-requested-with'] = 'XMLHttpRequest'
+        fields = dict(fields or {})
+        fields['security_ls_key'] = self.user.security_ls_key
+        return self.then(self.send_form(url, fields, files, headers), lambda resp: self.user.decode_ajax(resp.read(), throw_if_error))
+
+    def get_talk_list(self, page=1):
+        """Аналог User.get_talk_list."""
+        self.user.check_login()
+        return self.then(
+            self.read("/talk/inbox/page{}/".format(int(page))),
+            lambda x: self.user.get_talk_list(page, raw_data=x[1])
+        )
+
+    def get_talk(self, talk_id):
+        """Аналог User.get_talk."""
+        self.user.check_login()
+        return self.then(
+            self.read("/talk/read/" + text(int(talk_id)) + "/"),
+            lambda x: self.user.get_talk(talk_id, raw_data=x[1])
+        )
+
+    def get_post(self, post_id, blog=None):
+        """Аналог User.get_post."""
+        if blog:
+            url = "/blog/" + text(blog) + "/" + text(post_id) + ".html"
+        else:
+            url = "/blog/" + text(post_id) + ".html"
+        return self.then(self.read(url), lambda x: self.user.get_post(post_id, blog, raw_data=x[1]))
+
+    def get_comments(self, url="/comments/"):
+        """Аналог User.get_comments."""
+        return self.then(self.read(url), lambda x: self.user.get_comments(x[0], raw_data=x[1]))
+
+    def get_activity(self, url='/stream/all/'):
+        """Аналог User.get_activity."""
+        return self.then(self.read(url), lambda x: self.user.get_activity(url, raw_data=x[1]))
+
+
+def chain(source, target):
+    """Переносит результат (или исключение) future source в future target."""
+    def on_done(f):
+        if target.cancelled():
+            return
+        if f.cancelled():
+            target.cancel()
+        elif f.exception() is not None:
+            target.set_exception(f.exception())
+        else:
+            target.set_result(f.result())
+    source.add_done_callback(on_done)
@@ -9,12 +9,16 @@ PY2 = sys.version_info.major == 2
 
 if PY2:
     import urllib2 as urequest
+    import httplib as http_client
     from httplib import HTTPException
     from Cookie import BaseCookie
+    from urllib import addinfourl
 else:
     import urllib.request as urequest
+    import http.client as http_client
     from http.cookies import BaseCookie
     from http.client import HTTPException
+    from urllib.response import addinfourl
 
 if PY2:
     text_types = (basestring,)
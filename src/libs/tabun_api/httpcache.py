@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Кэш HTTP-ответов для User.urlopen.
+
+Кэшируются только GET-запросы. Ответ с ETag или Last-Modified сохраняется и при следующем запросе той же страницы
+проверяется условным запросом (If-None-Match/If-Modified-Since): если сервер ответил 304, страница берётся из кэша,
+а не скачивается заново. В течение fresh_for секунд после получения ответ отдаётся из кэша вообще без запроса к серверу.
+
+Ключ кэша включает печеньки запроса, поэтому разные пользователи не получат страницы друг друга.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import time
+import pickle
+import hashlib
+import tempfile
+from io import BytesIO
+from threading import Lock
+from collections import OrderedDict
+
+from .compat import PY2, addinfourl
+
+if PY2:
+    from httplib import HTTPMessage
+else:
+    from http.client import parse_headers
+
+
+class CacheEntry(object):
+    """Сохранённый ответ: итоговый url (после перенаправлений), заголовки одним куском байтов, тело
+    и время (по time.time()), когда ответ был получен или последний раз подтверждён сервером.
+    """
+
+    __slots__ = ('url', 'headers', 'body', 'etag', 'last_modified', 'stored')
+
+    def __init__(self, url, headers, body, etag=None, last_modified=None, stored=None):
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored = time.time() if stored is None else stored
+
+    def __getstate__(self):
+        return dict((x, getattr(self, x)) for x in self.__slots__)
+
+    def __setstate__(self, state):
+        for x in self.__slots__:
+            setattr(self, x, state.get(x))
+
+    def age(self, now=None):
+        return (time.time() if now is None else now) - self.stored
+
+    def response(self):
+        """Возвращает объект addinfourl с сохранённым ответом, как будто он только что пришёл от сервера."""
+        if PY2:
+            msg = HTTPMessage(BytesIO(self.headers))
+        else:
+            msg = parse_headers(BytesIO(self.headers))
+        resp = addinfourl(BytesIO(self.body), msg, self.url, 200)
+        resp.msg = 'OK'
+        return resp
+
+
+class MemoryStore(object):
+    """Хранилище в памяти: не больше maxsize записей, самые давно не использованные выкидываются первыми.
+    Записи старше ttl секунд тоже выкидываются (None — хранить сколько угодно).
+    """
+
+    def __init__(self, maxsize=256, ttl=3600):
+        self.maxsize = int(maxsize)
+        self.ttl = ttl
+        self.evicted = 0
+        self._items = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._items.pop(key, None)
+            if entry is None:
+                return None
+            if self.ttl is not None and entry.age() > self.ttl:
+                self.evicted += 1
+                return None
+            self._items[key] = entry
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = entry
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evicted += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+class DiskStore(object):
+    """Хранилище в каталоге path: по файлу на запись. Переживает перезапуск процесса.
+    Записи старше ttl секунд считаются отсутствующими и удаляются при обращении к ним.
+    """
+
+    def __init__(self, path, ttl=86400):
+        self.path = path
+        self.ttl = ttl
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.cache')
+
+    def get(self, key):
+        try:
+            with open(self.filename(key), 'rb') as fp:
+                entry = pickle.load(fp)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            return None
+        if self.ttl is not None and entry.age() > self.ttl:
+            self.delete(key)
+            return None
+        return entry
+
+    def set(self, key, entry):
+        # пишем во временный файл и переименовываем, чтобы параллельный get не прочитал половину записи;
+        # имя временного файла уникально, так что одновременные set одного ключа из разных потоков не мешают друг другу
+        fd, tmp = tempfile.mkstemp(prefix=key + '.', suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                pickle.dump(entry, fp, 2)
+        except:
+            os.remove(tmp)
+            raise
+        if os.name == 'nt' and os.path.exists(self.filename(key)):
+            os.remove(self.filename(key))
+        os.rename(tmp, self.filename(key))
+
+    def delete(self, key):
+        try:
+            os.remove(self.filename(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            if name.endswith('.cache'):
+                self.delete(name[:-6])
+
+
+class HTTPCache(object):
+    """Кэш ответов для User (параметр конструктора cache).
+
+    * memory — быстрое хранилище (по умолчанию MemoryStore())
+    * disk — медленное хранилище (например, DiskStore('/tmp/tabun_cache')) или None;
+      найденное там копируется в memory
+    * fresh_for — сколько секунд после получения ответ отдаётся без запроса к серверу;
+      при 0 (по умолчанию) каждое обращение проверяется условным запросом
+
+    Если сервер не прислал ни ETag, ни Last-Modified, ответ сохраняется только при fresh_for > 0.
+    Ответы с Set-Cookie или Cache-Control: no-store не сохраняются никогда.
+    Вместо хранилищ можно передать любые объекты с методами get(key), set(key, entry), delete(key) и clear().
+
+    Счётчики: hits — ответ отдан из кэша без запроса, revalidated — сервер ответил 304,
+    misses — страница скачана целиком, stored — сколько ответов было сохранено.
+    """
+
+    def __init__(self, memory=None, disk=None, fresh_for=0):
+        self.memory = memory if memory is not None else MemoryStore()
+        self.disk = disk
+        self.fresh_for = fresh_for
+
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self.stored = 0
+        self._lock = Lock()
+
+    def key(self, request):
+        """Ключ записи для объекта Request: хэш от url и печенек."""
+        key = request.get_full_url()
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        cookie = request.get_header('Cookie')
+        if cookie:
+            key += b'\n' + (cookie.encode('utf-8') if not isinstance(cookie, bytes) else cookie)
+        return hashlib.sha1(key).hexdigest()
+
+    def get(self, key):
+        entry = self.memory.get(key)
+        if entry is None and self.disk is not None:
+            entry = self.disk.get(key)
+            if entry is not None:
+                self.memory.set(key, entry)
+        return entry
+
+    def set(self, key, entry):
+        self.memory.set(key, entry)
+        if self.disk is not None:
+            self.disk.set(key, entry)
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def open(self, request, send):
+        """Отдаёт ответ на GET-запрос request из кэша или через функцию send(request).
+        send должна вернуть ответ (addinfourl) или None, если сервер ответил 304 Not Modified.
+        """
+        key = self.key(request)
+        entry = self.get(key)
+
+        if entry is not None and self.fresh_for > 0 and entry.age() <= self.fresh_for:
+            self.count('hits')
+            return entry.response()
+
+        if entry is not None:
+            if entry.etag:
+                request.add_header('If-none-match', entry.etag)
+            if entry.last_modified:
+                request.add_header('If-modified-since', entry.last_modified)
+
+        resp = send(request)
+        if resp is None:
+            self.count('revalidated')
+            entry.stored = time.time()
+            self.set(key, entry)
+            return entry.response()
+
+        self.count('misses')
+        if entry is not None:
+            self.memory.delete(key)
+            if self.disk is not None:
+                self.disk.delete(key)
+
+        headers = resp.info()
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+        if headers.get('Set-Cookie') or 'no-store' in (headers.get('Cache-Control') or ''):
+            return resp
+        if not etag and not last_modified and self.fresh_for <= 0:
+            return resp
+
+        body = resp.read()
+        if PY2:
+            raw_headers = b''.join(headers.headers)
+        else:
+            # http.client декодирует заголовки как latin-1, так что это обратное преобразование без потерь
+            raw_headers = ''.join('%s: %s\r\n' % (k, v) for k, v in headers.items()).encode('latin-1')
+        entry = CacheEntry(resp.geturl(), raw_headers + b'\r\n', body, etag, last_modified)
+        self.set(key, entry)
+        self.count('stored')
+        return entry.response()
+
+    def stats(self):
+        """Возвращает словарь со счётчиками и числом записей в памяти."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'revalidated': self.revalidated,
+                'misses': self.misses,
+                'stored': self.stored,
+                'evicted': getattr(self.memory, 'evicted', 0),
+                'size': len(self.memory) if hasattr(self.memory, '__len__') else None,
+            }
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Наблюдатели за работой User: сколько времени уходит на запросы и на парсинг.
+
+Наблюдатель добавляется через User.add_observer и получает вызовы (любой из методов можно не определять):
+
+* before_request(user, request) — перед отправкой запроса (объект Request)
+* after_response(user, request, status, size, elapsed, error) — после ответа: HTTP-код (или code из TabunError),
+  размер тела в байтах (None, если неизвестен), время в секундах и исключение TabunError или None
+* after_parse(user, name, count, elapsed) — после метода User, который парсит страницы (get_posts, get_comments и т. п.):
+  имя метода, число полученных элементов и время в секундах без учёта времени запросов внутри метода
+  и ожидания перед ними (очередь limiter, паузы перед повторами)
+
+Наблюдатели вызываются в том потоке, который делает запрос, так что им нужно быть потокобезопасными.
+StatsCollector — готовый наблюдатель, собирающий гистограммы времени; его сводку возвращает User.stats().
+"""
+
+from __future__ import unicode_literals
+
+import functools
+from bisect import bisect_left
+from threading import Lock, local
+
+from .ratelimit import clock
+
+
+# время запросов (и ожидания перед ними), сделанных внутри текущего вызова метода с @parser, в этом потоке
+_parse_timing = local()
+
+
+class Observer(object):
+    """Наблюдатель, который ничего не делает. Удобно наследовать от него и переопределять только нужное."""
+
+    def before_request(self, user, request):
+        pass
+
+    def after_response(self, user, request, status, size, elapsed, error):
+        pass
+
+    def after_parse(self, user, name, count, elapsed):
+        pass
+
+
+def count_items(result):
+    """Число элементов в результате метода User: длина списка или словаря, для кортежа (last_id, items) — длина items."""
+    if isinstance(result, (list, dict)):
+        return len(result)
+    if isinstance(result, tuple) and result and isinstance(result[-1], list):
+        return len(result[-1])
+    return 0 if result is None else 1
+
+
+def parser(func):
+    """Декоратор для методов User, которые парсят страницы: сообщает наблюдателям after_parse.
+    Вложенные вызовы таких методов (например, get_posts внутри get_post) отдельно не сообщаются.
+    """
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if not self.observers or getattr(_parse_timing, 'request_time', None) is not None:
+            return func(self, *args, **kwargs)
+
+        _parse_timing.request_time = 0.0
+        start = clock()
+        try:
+            result = func(self, *args, **kwargs)
+            elapsed = clock() - start - _parse_timing.request_time
+        finally:
+            _parse_timing.request_time = None
+        self.notify('after_parse', func.__name__, count_items(result), elapsed)
+        return result
+
+    return wrapper
+
+
+def add_request_time(elapsed):
+    """Учитывает время запроса или ожидания перед ним, чтобы вычесть его из времени парсинга объемлющего метода с @parser."""
+    if getattr(_parse_timing, 'request_time', None) is not None:
+        _parse_timing.request_time += elapsed
+
+
+def response_size(resp):
+    """Размер тела ответа в байтах: по Content-Length или, если тело уже прочитано в BytesIO, по нему."""
+    length = resp.info().get('Content-Length')
+    if length and length.isdigit():
+        return int(length)
+    getvalue = getattr(getattr(resp, 'fp', None), 'getvalue', None)
+    return len(getvalue()) if getvalue is not None else None
+
+
+class Histogram(object):
+    """Гистограмма времени с экспоненциальными корзинами от 1 мс до примерно минуты.
+    Перцентили приблизительные: возвращается верхняя граница корзины (но не больше максимума).
+    """
+
+    bounds = tuple(0.001 * 2 ** i for i in range(17))
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+        }
+
+
+class StatsCollector(Observer):
+    """Собирает в памяти статистику запросов (по HTTP-методам) и парсинга (по методам User):
+    гистограммы времени, число байтов и элементов, коды ответов и ошибки.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = {}
+            self.parsers = {}
+
+    def after_response(self, user, request, status, size, elapsed, error):
+        with self._lock:
+            stat = self.requests.get(request.get_method())
+            if stat is None:
+                stat = self.requests[request.get_method()] = {'time': Histogram(), 'bytes': 0, 'statuses': {}, 'errors': 0}
+            stat['time'].add(elapsed)
+            stat['bytes'] += size or 0
+            stat['statuses'][status] = stat['statuses'].get(status, 0) + 1
+            if error is not None:
+                stat['errors'] += 1
+
+    def after_parse(self, user, name, count, elapsed):
+        with self._lock:
+            stat = self.parsers.get(name)
+            if stat is None:
+                stat = self.parsers[name] = {'time': Histogram(), 'items': 0}
+            stat['time'].add(elapsed)
+            stat['items'] += count
+
+    def summary(self):
+        """Возвращает словарь {'requests': {метод: ...}, 'parse': {имя: ...}} со сводками гистограмм."""
+        with self._lock:
+            requests = {}
+            for method, stat in self.requests.items():
+                requests[method] = dict(stat['time'].summary(), bytes=stat['bytes'], statuses=dict(stat['statuses']), errors=stat['errors'])
+            parse = {}
+            for name, stat in self.parsers.items():
+                parse[name] = dict(stat['time'].summary(), items=stat['items'])
+            return {'requests': requests, 'parse': parse}
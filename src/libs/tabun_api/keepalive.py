@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Постоянные (keep-alive) HTTP/1.1-соединения для urllib.
+
+Стандартный AbstractHTTPHandler.do_open принудительно закрывает соединение после каждого запроса,
+из-за чего каждая страница Табуна стоит отдельного TCP- и TLS-рукопожатия. Здесь лежат обработчики,
+которые берут соединения из общего ConnectionPool и возвращают их туда после ответа.
+"""
+
+from __future__ import unicode_literals
+
+import time
+import select
+import socket
+from io import BytesIO
+from threading import Lock
+
+from .compat import PY2, urequest, http_client, addinfourl
+
+
+class ConnectionPool(object):
+    """Ограниченный пул постоянных соединений, разбитый по ключу (схема, хост).
+
+    * maxsize — сколько простаивающих соединений хранить на один хост
+    * idle_timeout — через сколько секунд простоя соединение выкидывается (сервер всё равно его закроет)
+    * max_age — максимальное время жизни соединения в секундах
+
+    Счётчики created, reused и discarded показывают, сколько соединений было открыто, сколько раз
+    соединение было взято повторно и сколько выкинуто по таймауту или переполнению пула.
+    """
+
+    def __init__(self, maxsize=4, idle_timeout=15, max_age=300):
+        self.maxsize = int(maxsize)
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+
+        self.created = 0
+        self.reused = 0
+        self.discarded = 0
+
+        self._idle = {}
+        self._lock = Lock()
+
+    def new_connection(self, key, http_class, host, timeout, **http_conn_args):
+        """Открывает новое соединение (ещё не подключённое — подключится при первом запросе)."""
+        conn = http_class(host=host, timeout=timeout, **http_conn_args)
+        conn.pool_created = time.time()
+        with self._lock:
+            self.created += 1
+        return conn
+
+    def get(self, key):
+        """Возвращает простаивающее соединение для ключа или None, попутно выкидывая протухшие."""
+        now = time.time()
+        with self._lock:
+            conns = self._idle.get(key)
+            while conns:
+                conn, last_used = conns.pop()
+                if now - last_used > self.idle_timeout or now - conn.pool_created > self.max_age:
+                    self.discarded += 1
+                    conn.close()
+                    continue
+                self.reused += 1
+                return conn
+        return None
+
+    def put(self, key, conn):
+        """Возвращает соединение в пул. Самые старые соединения сверх maxsize закрываются."""
+        now = time.time()
+        with self._lock:
+            if now - conn.pool_created > self.max_age:
+                self.discarded += 1
+                conn.close()
+                return
+            conns = self._idle.setdefault(key, [])
+            conns.append((conn, now))
+            while len(conns) > self.maxsize:
+                self.discarded += 1
+                conns.pop(0)[0].close()
+
+    def discard(self, conn):
+        """Закрывает взятое из пула соединение, которое оказалось негодным."""
+        with self._lock:
+            self.discarded += 1
+        conn.close()
+
+    def clear(self):
+        """Закрывает все простаивающие соединения."""
+        with self._lock:
+            for conns in self._idle.values():
+                for conn, last_used in conns:
+                    conn.close()
+            self._idle.clear()
+
+    def stats(self):
+        """Возвращает словарь со счётчиками пула и числом простаивающих соединений."""
+        with self._lock:
+            return {
+                'created': self.created,
+                'reused': self.reused,
+                'discarded': self.discarded,
+                'idle': sum(len(x) for x in self._idle.values()),
+            }
+
+
+def connection_dropped(conn):
+    """Проверяет, не закрыл ли сервер простаивающее соединение: сокет такого соединения
+    становится доступным для чтения (конец потока), хотя мы ничего не запрашивали.
+    """
+    if conn.sock is None:
+        return False
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (ValueError, select.error, socket.error):
+        return True
+
+
+class KeepAliveMixin(object):
+    """Общая часть обработчиков: отправляет запрос через соединение из пула.
+
+    Тело ответа вычитывается целиком сразу, после чего соединение возвращается в пул,
+    а наружу отдаётся addinfourl поверх BytesIO — как и раньше, с методами read, info, geturl и getcode.
+
+    Если повторно используемое соединение оборвалось, запрос отправляется заново по свежему соединению,
+    только когда это безопасно: для GET и HEAD, или если запрос не успел отправиться целиком.
+    Иначе (например, POST оборвался в ожидании ответа) сервер мог его выполнить, и повтор создал бы
+    дубликат, так что ошибка отдаётся наружу. Чтобы такое случалось пореже, соединения,
+    закрытые сервером во время простоя, выкидываются ещё до отправки (см. connection_dropped).
+    """
+
+    def __init__(self, pool, http_class=None, **http_conn_args):
+        self.pool = pool
+        self.http_class = http_class
+        self.http_conn_args = http_conn_args
+
+    def do_keepalive_open(self, http_class, req, **http_conn_args):
+        if PY2:
+            host, scheme, selector, data = req.get_host(), req.get_type(), req.get_selector(), req.get_data()
+        else:
+            host, scheme, selector, data = req.host, req.type, req.selector, req.data
+        if not host:
+            raise urequest.URLError('no host given')
+        key = (scheme, host)
+        idempotent = req.get_method() in ('GET', 'HEAD')
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers['Connection'] = 'keep-alive'
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        while True:
+            conn = self.pool.get(key)
+            reused = conn is not None
+            if reused and connection_dropped(conn):
+                self.pool.discard(conn)
+                continue
+            if reused:
+                conn.timeout = req.timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(req.timeout)
+            else:
+                conn = self.pool.new_connection(key, http_class, host, req.timeout, **http_conn_args)
+            if hasattr(data, 'seek'):
+                # файлоподобное тело (например, utils.MultipartBody) могло быть частично прочитано прошлой попыткой
+                data.seek(0)
+
+            sent = False
+            try:
+                if PY2 and conn.sock is None:
+                    # httplib из py2 не выключает алгоритм Нейгла (http.client из py3 выключает), а заголовки
+                    # и потоковое тело формы уходят отдельными пакетами, и каждый POST ждал
+                    # отложенного ACK сервера (около 40 мс)
+                    conn.connect()
+                    conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                conn.request(req.get_method(), selector, data, headers)
+                sent = True
+                r = conn.getresponse()
+                body = r.read()
+            except socket.timeout:
+                conn.close()
+                raise
+            except (socket.error, http_client.HTTPException) as exc:
+                conn.close()
+                if reused and (idempotent or not sent):
+                    # сервер успел закрыть простаивавшее соединение — пробуем на свежем
+                    continue
+                if isinstance(exc, http_client.HTTPException):
+                    raise
+                raise urequest.URLError(exc)
+            break
+
+        if r.will_close:
+            conn.close()
+        else:
+            self.pool.put(key, conn)
+
+        resp = addinfourl(BytesIO(body), r.msg, req.get_full_url(), r.status)
+        resp.msg = r.reason
+        return resp
+
+
+class KeepAliveHTTPHandler(KeepAliveMixin, urequest.HTTPHandler):
+    def __init__(self, pool, http_class=None, **http_conn_args):
+        urequest.HTTPHandler.__init__(self)
+        KeepAliveMixin.__init__(self, pool, http_class, **http_conn_args)
+
+    def http_open(self, req):
+        return self.do_keepalive_open(self.http_class or http_client.HTTPConnection, req, **self.http_conn_args)
+
+
+class KeepAliveHTTPSHandler(KeepAliveMixin, urequest.HTTPSHandler):
+    def __init__(self, pool, http_class=None, **http_conn_args):
+        urequest.HTTPSHandler.__init__(self)
+        KeepAliveMixin.__init__(self, pool, http_class, **http_conn_args)
+
+    def https_open(self, req):
+        http_conn_args = dict(self.http_conn_args)
+        if getattr(self, '_context', None) is not None:
+            http_conn_args.setdefault('context', self._context)
+        return self.do_keepalive_open(self.http_class or http_client.HTTPSConnection, req, **http_conn_args)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Ограничение частоты запросов к Табуну и повторы неудавшихся запросов.
+
+TokenBucket решает только, когда можно отправить очередной запрос: под блокировкой он занимает
+место в очереди и возвращает, сколько секунд до него осталось. Ждать и отправлять запрос вызывающий
+код будет уже без блокировки, поэтому потоки с общим User не ждут чужие ответы от сервера,
+а из asyncio то же самое ожидание делается через loop.call_later вместо time.sleep.
+
+RetryPolicy решает, стоит ли повторять запрос после TabunError, и через сколько секунд.
+"""
+
+from __future__ import unicode_literals
+
+import time
+import errno
+import random
+from threading import Lock
+
+
+clock = getattr(time, 'monotonic', time.time)
+
+# Коды TabunError для ошибок, при которых запрос точно не ушёл на сервер (соединение не установилось)
+UNSENT_CODES = frozenset(-x for x in (errno.ECONNREFUSED, errno.EHOSTUNREACH, errno.ENETUNREACH))
+
+
+class TokenBucket(object):
+    """Ведро с токенами: в среднем не больше одного запроса за interval секунд,
+    но после простоя до burst запросов можно отправить сразу.
+
+    * interval — сколько секунд копится один токен; 0 — без ограничений
+    * burst — вместимость ведра (при 1 это просто минимальный интервал между запросами)
+
+    Оба параметра можно менять на лету. Счётчики: admitted — сколько запросов прошло,
+    delayed — сколько из них пришлось подождать, waited — суммарное ожидание в секундах.
+    """
+
+    def __init__(self, interval=0, burst=1):
+        self.interval = interval
+        self.burst = burst
+
+        self.admitted = 0
+        self.delayed = 0
+        self.waited = 0.0
+
+        # момент, к которому ведро снова станет полным, если больше ничего не отправлять
+        self._full_at = 0.0
+        self._lock = Lock()
+
+    def reserve(self, now=None):
+        """Занимает токен и возвращает, через сколько секунд можно отправлять запрос (0 — сразу)."""
+        if now is None:
+            now = clock()
+        with self._lock:
+            self.admitted += 1
+            interval = self.interval
+            if interval <= 0:
+                return 0
+            full_at = max(self._full_at, now)
+            delay = max(0, full_at - (max(int(self.burst), 1) - 1) * interval - now)
+            self._full_at = full_at + interval
+            if delay > 0:
+                self.delayed += 1
+                self.waited += delay
+            return delay
+
+    def acquire(self):
+        """Занимает токен и ждёт своей очереди через time.sleep."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def stats(self):
+        """Возвращает словарь со счётчиками."""
+        with self._lock:
+            return {
+                'admitted': self.admitted,
+                'delayed': self.delayed,
+                'waited': self.waited,
+            }
+
+
+class RetryPolicy(object):
+    """Повторы после временных ошибок с экспоненциальной задержкой и случайным разбросом (full jitter):
+    перед повтором номер n (с нуля) ждём случайное время от 0 до min(max_delay, base_delay * 2 ** n) секунд,
+    чтобы несколько клиентов, споткнувшихся одновременно, не ломились обратно тоже одновременно.
+
+    * retries — сколько раз повторять запрос (0 — не повторять)
+    * base_delay, max_delay — см. выше
+    * check_delays — через сколько секунд (каждая следующая пауза отсчитывается от предыдущей проверки)
+      проверять, не создался ли пост, после неоднозначной ошибки при его отправке (см. User.submit_topic)
+
+    Временными считаются ошибки 5xx и ошибки соединения (таймаут, обрыв, отказ в соединении —
+    у TabunError для них отрицательный code), кроме статической 404 (code -404).
+    Счётчик retried — сколько повторов было сделано.
+    """
+
+    def __init__(self, retries=2, base_delay=0.5, max_delay=8, check_delays=(2, 4, 8)):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.check_delays = tuple(check_delays)
+        self.retried = 0
+        self._lock = Lock()
+
+    def is_transient(self, exc):
+        """Может ли повтор запроса после ошибки exc (TabunError) закончиться успехом."""
+        code = getattr(exc, 'code', 0) or 0
+        return 500 <= code < 600 or (code < 0 and code != -404)
+
+    def is_unsent(self, exc):
+        """Случилась ли ошибка exc (TabunError) до отправки запроса, так что повтор POST не создаст дубликат.
+        Таймаут, обрыв и 5xx к таким не относятся: сервер мог получить и выполнить запрос.
+        """
+        return (getattr(exc, 'code', 0) or 0) in UNSENT_CODES
+
+    def should_retry(self, exc, attempt):
+        """Нужно ли повторять запрос после ошибки exc, если повторов уже было attempt."""
+        return attempt < self.retries and self.is_transient(exc)
+
+    def delay(self, attempt):
+        """Сколько секунд ждать перед повтором номер attempt; заодно учитывает его в счётчике retried."""
+        with self._lock:
+            self.retried += 1
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
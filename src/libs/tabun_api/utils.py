@@ -8,6 +8,7 @@ import time
 import random
 import mimetypes
 from hashlib import md5
+from threading import Thread
 
 import lxml
 import lxml.html
@@ -33,6 +34,15 @@ cf_email = re.compile(r'<[A-z]+ class="__cf_email__".*? data-cfemail="([0-9a-f]+
 
 cf_email_b = re.compile(r'<[A-z]+ class="__cf_email__".*? data-cfemail="([0-9a-f]+)".+?</script>'.encode('utf-8'), re.DOTALL)
 
+#: <br/>, за которым сразу идёт следующий тег (см. normalize_body).
+br_before_tag = re.compile(r'<br/>(?=<)')
+
+#: Открывающие и закрывающие теги div и section (см. iter_child_regions).
+div_section_tag = re.compile(r'<(/?)(?:div|section)[\s>]'.encode('utf-8'))
+
+#: Ссылка «Читать дальше» в конце укороченного поста.
+read_more_link = 'title="Читать дальше">'.encode('utf-8')
+
 
 def parse_html(data, encoding='utf-8'):
     """Парсит HTML-код и возвращает lxml.etree-элемент."""
@@ -44,11 +54,35 @@ def parse_html(data, encoding='utf-8'):
     return doc
 
 
+#: Реестр скомпилированных XPath-выражений: выражение -> lxml.etree.XPath (см. xpath).
+xpath_registry = {}
+
+
+def compile_xpath(expr):
+    """Возвращает скомпилированное выражение из реестра, компилируя его при первом обращении."""
+    try:
+        return xpath_registry[expr]
+    except KeyError:
+        compiled = xpath_registry[expr] = lxml.etree.XPath(expr)  # pylint: disable=no-member
+        return compiled
+
+
+def xpath(node, expr):
+    """То же, что node.xpath(expr), но выражение компилируется один раз на весь процесс,
+    а не заново на каждый пост, коммент или событие.
+    """
+    try:
+        compiled = xpath_registry[expr]
+    except KeyError:
+        compiled = compile_xpath(expr)
+    return compiled(node)
+
+
 def parse_html_fragment(data, encoding='utf-8'):
     """Парсит кусок HTML-кода и возвращает список lxml.etree-элементов и строк."""
     # if isinstance(data, text): encoding = None
     # doc = html5lib.parseFragment(data, treebuilder="lxml", namespaceHTMLElements=False, encoding=encoding)
-    if isinstance(data, binary):
+    if isinstance(data, (binary, bytearray)):
         data = data.decode(encoding, "replace")
     doc = lxml.html.fragments_fromstring(data)
     return doc
@@ -290,56 +324,141 @@ def find_images(body, spoiler_title=True, no_other=False):
     return links
 
 
+class MultipartBody(object):
+    """
+    Тело multipart/form-data запроса в виде файлоподобного объекта известной длины.
+    Ничего не склеивает: заголовки частей генерируются заранее, а значения полей и файлов
+    отдаются методом read по кусочкам прямо из исходных объектов, так что в памяти не появляется
+    ещё одной копии загружаемых данных. Годится в качестве data для urllib и для httplib.
+
+    * fields - список из элементов (имя, значение) или словарь полей формы
+    * files - список из элементов (имя, имя файла, значение) для данных, загружаемых в виде файлов;
+      значение может быть байтовой строкой или открытым файлом (читается с текущей позиции до конца)
+
+    Атрибут content_type содержит готовый заголовок Content-Type, len() возвращает длину тела.
+    """
+
+    def __init__(self, fields, files=(), boundary=None):
+        if isinstance(fields, dict):
+            fields = fields.items()
+        if boundary is None:
+            boundary = b'----------' + md5((text(int(time.time())) + text(random.randrange(1000))).encode('utf-8')).hexdigest().encode('utf-8')
+        elif isinstance(boundary, text):
+            boundary = boundary.encode('utf-8')
+        self.content_type = 'multipart/form-data; boundary=%s' % boundary.decode('utf-8')
+
+        parts = []
+        for (key, value) in fields:
+            key = text(key)
+            if isinstance(value, text):
+                value = value.encode('utf-8')
+            elif isinstance(value, (int, float, complex)):
+                value = text(value).encode('utf-8')
+            elif not isinstance(value, binary):
+                raise ValueError('Value should be bytes, not %s' % type(value))
+            parts.append(b'--' + boundary + ('\r\nContent-Disposition: form-data; name="%s"\r\n\r\n' % key).encode('utf-8'))
+            parts.append(value)
+            parts.append(b'\r\n')
+
+        for (key, filename, value) in files:
+            key = text(key)
+            filename = text(filename)
+            if isinstance(value, text):
+                value = value.encode('utf-8')
+            elif not isinstance(value, binary) and not hasattr(value, 'read'):
+                raise ValueError('Value should be bytes, not %s' % type(value))
+            parts.append(b'--' + boundary + (
+                '\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: %s\r\n\r\n' % (
+                    key, filename, get_content_type(filename)
+                )
+            ).encode('utf-8'))
+            parts.append(value)
+            parts.append(b'\r\n')
+
+        parts.append(b'--' + boundary + b'--\r\n')
+
+        # (часть, позиция начала чтения, длина)
+        self.parts = []
+        self.length = 0
+        for part in parts:
+            if isinstance(part, binary):
+                start, size = 0, len(part)
+            else:
+                start = part.tell()
+                part.seek(0, 2)
+                size = part.tell() - start
+                part.seek(start)
+            self.parts.append((part, start, size))
+            self.length += size
+
+        self.seek(0)
+
+    def __len__(self):
+        return self.length
+
+    def seek(self, offset, whence=0):
+        """Поддерживается только перемотка в начало, чтобы запрос можно было отправить повторно."""
+        if offset != 0 or whence != 0:
+            raise IOError('MultipartBody can only be rewound to the start')
+        self.part_index = 0
+        self.part_offset = 0
+        self.position = 0
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        """Возвращает не больше size байт (или всё оставшееся при size < 0)."""
+        chunks = []
+        left = size if size is not None and size >= 0 else self.length - self.position
+        while left > 0 and self.part_index < len(self.parts):
+            part, start, part_size = self.parts[self.part_index]
+            n = min(left, part_size - self.part_offset)
+            if isinstance(part, binary):
+                chunk = part[self.part_offset:self.part_offset + n] if n < part_size else part
+            else:
+                part.seek(start + self.part_offset)
+                chunk = part.read(n)
+                n = len(chunk)
+                if not n:
+                    raise IOError('File is shorter than expected')
+            chunks.append(chunk)
+            left -= n
+            self.position += n
+            self.part_offset += n
+            if self.part_offset >= part_size:
+                self.part_index += 1
+                self.part_offset = 0
+        return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+    def __iter__(self, chunk_size=64 * 1024):
+        self.seek(0)
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def getvalue(self):
+        """Склеивает всё тело в одну байтовую строку (для тех, кто не умеет читать из файла)."""
+        return b''.join(
+            part if isinstance(part, binary) else (part.seek(start) or part.read(size))
+            for part, start, size in self.parts
+        )
+
+
 # copypasted from http://code.activestate.com/recipes/146306-http-client-to-post-using-multipartform-data/
 # and modified by andreymal
 def encode_multipart_formdata(fields, files, boundary=None):
     """
     Возвращает кортеж (content_type, body), готовый для отправки HTTP-запроса.
+    Тело склеивается в одну байтовую строку; чтобы не держать в памяти лишнюю копию, используйте MultipartBody.
 
     * fields - список из элементов (имя, значение) или словарь полей формы
     * files - список из элементов (имя, имя файла, значение) для данных, загружаемых в виде файлов
     """
-    if isinstance(fields, dict):
-        fields = fields.items()
-    if boundary is None:
-        boundary = b'----------' + md5((text(int(time.time())) + text(random.randrange(1000))).encode('utf-8')).hexdigest().encode('utf-8')
-    elif isinstance(boundary, text):
-        boundary = boundary.encode('utf-8')
-    L = []
-
-    for (key, value) in fields:
-        key = text(key).encode('utf-8')
-        if isinstance(value, text):
-            value = value.encode('utf-8')
-        elif isinstance(value, (int, float, complex)):
-            value = text(value).encode('utf-8')
-        elif not isinstance(value, binary):
-            raise ValueError('Value should be bytes, not %s' % type(value))
-        L.append(b'--' + boundary)
-        L.append(('Content-Disposition: form-data; name="%s"' % key.decode('utf-8')).encode('utf-8'))
-        L.append(b'')
-        L.append(value)
-
-    for (key, filename, value) in files:
-        key = text(key).encode('utf-8')
-        filename = text(filename).encode('utf-8')
-        if isinstance(value, text):
-            value = value.encode('utf-8')
-        elif not isinstance(value, binary):
-            raise ValueError('Value should be bytes, not %s' % type(value))
-        L.append(b'--' + boundary)
-        L.append((
-            'Content-Disposition: form-data; name="%s"; filename="%s"' % (key.decode('utf-8'), filename.decode('utf-8'))
-        ).encode('utf-8'))
-        L.append(('Content-Type: %s' % get_content_type(filename.decode('utf-8'))).encode('utf-8'))
-        L.append(b'')
-        L.append(value)
-
-    L.append(b'--' + boundary + b'--')
-    L.append(b'')
-    body = b'\r\n'.join(L)
-    content_type = 'multipart/form-data; boundary=%s' % boundary.decode('utf-8')
-    return content_type, body
+    body = MultipartBody(fields, files, boundary)
+    return body.content_type, body.getvalue()
 
 
 def get_content_type(filename):
@@ -349,12 +468,12 @@ def get_content_type(filename):
 
 def send_form(url, fields, files, timeout=None, headers=None):
     """
-    Отправляет форму, пользуясь функцией encode_multipart_formdata(fields, files), возвращает результат вызова urlopen
+    Отправляет форму, пользуясь классом MultipartBody(fields, files), возвращает результат вызова urlopen
 
     * timeout - сколько ожидать ответа, не дождётся - кидается исключением urllib
     * headers - дополнительные HTTP-заголовки
     """
-    content_type, data = encode_multipart_formdata(fields, files)
+    data = MultipartBody(fields, files)
 
     if not isinstance(url, urequest.Request):
         if PY2 and isinstance(url, text):
@@ -370,7 +489,8 @@ def send_form(url, fields, files, timeout=None, headers=None):
             if isinstance(value, text):
                 value = value.encode('utf-8')
             url.add_header(header, value)
-    url.add_unredirected_header(str('Content-type'), content_type.encode('utf-8'))
+    url.add_unredirected_header(str('Content-type'), data.content_type.encode('utf-8'))
+    url.add_unredirected_header(str('Content-length'), str(len(data)))
     url.data = data
 
     if timeout is None:
@@ -379,9 +499,9 @@ def send_form(url, fields, files, timeout=None, headers=None):
         return urequest.urlopen(url, timeout=timeout)
 
 
-def find_substring(s, start, end, extend=False, with_start=True, with_end=True):
-    """Возвращает подстроку, находящуюся между кусками строки start и end, или None, если не нашлось.
-    При extend=True кусок строки end ищется с конца (rfind).
+def find_region(s, start, end, extend=False, with_start=True, with_end=True):
+    """То же, что find_substring, но вместо самой подстроки возвращает её границы (начало, конец),
+    чтобы не копировать кусок страницы (см. preprocess_html). None, если не нашлось.
     """
     f1 = s.find(start)
     if f1 < 0:
@@ -389,7 +509,42 @@ def find_substring(s, start, end, extend=False, with_start=True, with_end=True):
     f2 = (s.rfind if extend else s.find)(end, f1 + len(start))
     if f2 < 0:
         return
-    return s[f1 + (0 if with_start else len(start)):f2 + (len(end) if with_end else 0)]
+    return f1 + (0 if with_start else len(start)), f2 + (len(end) if with_end else 0)
+
+
+def find_substring(s, start, end, extend=False, with_start=True, with_end=True):
+    """Возвращает подстроку, находящуюся между кусками строки start и end, или None, если не нашлось.
+    При extend=True кусок строки end ищется с конца (rfind).
+    """
+    region = find_region(s, start, end, extend, with_start, with_end)
+    if region is None:
+        return
+    return s[region[0]:region[1]]
+
+
+class Prefetch(object):
+    """Вызывает func(*args) в фоновом потоке. Метод result ждёт завершения и возвращает результат
+    или кидает исключение, которым завершилась func. Если результат не понадобился, поток просто доработает сам.
+    """
+
+    def __init__(self, func, *args):
+        self._result = None
+        self._error = None
+        self._thread = Thread(target=self._run, args=(func, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, args):
+        try:
+            self._result = func(*args)
+        except Exception as exc:
+            self._error = exc
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
 
 
 def download(url, maxmem=20 * 1024 * 1024, timeout=5, waitout=15):
@@ -521,8 +676,7 @@ def normalize_body(body=None, raw_body=None, cls='text'):
 
         # Занимаемся подгонкой под оригинальный исходник
         # Табун принудительно сводит несколько br подряд в <br/>\r\n<br/>, чем и пользуемся, обходя баг lxml
-        while '<br/><' in raw_body:
-            raw_body = raw_body.replace('<br/><', '<br/>\r\n<')
+        raw_body = br_before_tag.sub('<br/>\r\n', raw_body)
 
         raw_body = raw_body.replace(' allowfullscreen=""/>', ' allowfullscreen></iframe>')
         # это типа тег <cut>
@@ -536,45 +690,151 @@ def normalize_body(body=None, raw_body=None, cls='text'):
     return body, text(raw_body) if raw_body is not None else None
 
 
-def escape_topic_contents(data, may_be_short=False):
-    """Экранирует содержимое постов для защиты от поехавшей вёрстки и багов lxml."""
-    if not isinstance(data, binary):
-        # u'\xa0'.strip() => u''
-        # '\xa0'.strip() => '\xa0' — придерживаюсь этого варианта
-        raise ValueError('data should be bytes')
-    f1 = 0
-    f2 = 0
-    last_end = 0
-    buf = []
+def _escape_body(body):
+    return body.replace(b'&', b'&amp;').replace(b'<', b'&lt;').replace(b'>', b'&gt;').replace(b'"', b'&quot;')
+
+
+def _decode_emails(data):
+    return cf_email_b.sub(lambda x: decode_cf_email(x.groups()[0]), data)
+
+
+def _copy_decoded(out, data, view, start, end, decode_emails):
+    """Дописывает data[start:end] в out через memoryview, по пути расшифровывая почты CloudFlare."""
+    if decode_emails:
+        for m in cf_email_b.finditer(data, start, end):
+            out += view[start:m.start()]
+            out += decode_cf_email(m.group(1))
+            start = m.end()
+    out += view[start:end]
+
+
+def find_topic_bodies(data, pos=0, endpos=None):
+    """Ищет тела постов в data[pos:endpos]. Генерирует пары смещений
+    (начало тега <div class="topic-content text">, начало его закрывающего </div>).
+    """
+    if endpos is None:
+        endpos = len(data)
+    last_end = pos
     while True:
         # определяем границы тела очередного поста
-        f1 = data.find(b'<div class="topic-content text">', last_end)
+        f1 = data.find(b'<div class="topic-content text">', last_end, endpos)
         if f1 < 0:
-            break
-        f2 = data.find(b'<footer', f1)
+            return
+        f2 = data.find(b'<footer', f1, endpos)
         if f2 < 0:
-            break
+            return
         f2 = data.rfind(b'</div>', f1, f2)
         if f2 < 0:
-            break
+            return
 
         # старые топики-ссылки
-        if data.rfind(b'<div class="topic-url"', f1, f2) > 0:
-            f2 = data.rfind(b'</div>', f1, data.rfind(b'<div class="topic-url"', f1, f2))
+        f = data.rfind(b'<div class="topic-url"', f1, f2)
+        if f > 0:
+            f2 = data.rfind(b'</div>', f1, f)
             if f2 < 0:
-                break
+                return
 
         # топики-файлы
-        if data.rfind(b'<div class="download"', f1, f2) > 0:
-            f2 = data.rfind(b'</div>', f1, data.rfind(b'<div class="download"', f1, f2))
+        f = data.rfind(b'<div class="download"', f1, f2)
+        if f > 0:
+            f2 = data.rfind(b'</div>', f1, f)
             if f2 < 0:
+                return
+
+        yield f1, f2
+        last_end = f2 + 6
+
+
+def find_comment_bodies(data, pos=0, endpos=None):
+    """Ищет тела комментов в data[pos:endpos]. Генерирует пары смещений
+    (начало тега <div class="text">, начало его закрывающего </div>).
+    """
+    if endpos is None:
+        endpos = len(data)
+
+    # Следующее вхождение каждой из меток конца коммента. Найденная позиция годится и для следующих
+    # комментов, пока они не начнутся дальше неё, а ненайденная метка не найдётся и потом —
+    # без этого поиск отсутствующей на странице метки пробегал бы до конца страницы на каждый коммент.
+    end_markers = (b'<div id="info_edit_', b'<div class="comment-path', b'<ul class="comment-info')
+    next_marker = [None] * len(end_markers)
+
+    last_end = pos
+    while True:
+        # определяем границы очередного коммента
+        f1 = data.find(b'class="comment-content">', last_end, endpos)
+        if f1 >= 0:
+            f = data.find(b'<div class=" text">', f1, min(f1 + 150, endpos))
+            if f < 0:
+                f1 = data.find(b'<div class="text">', f1, min(f1 + 150, endpos))
+            else:
+                f1 = f
+        if f1 < 0:
+            return
+        f2 = -1
+        for i, marker in enumerate(end_markers):
+            if next_marker[i] is None or 0 <= next_marker[i] < f1:
+                next_marker[i] = data.find(marker, f1, endpos)
+            f2 = next_marker[i]
+            if f2 >= 0:
                 break
+        if f2 < 0:
+            return
+        f2 = data.rfind(b'</div>', f1, f2)
+        if f2 >= 0:
+            f2 = data.rfind(b'</div>', f1, f2)
+        if f2 < 0:
+            return
+
+        yield f1, f2
+        last_end = f2 + 6
+
+
+def _copy_comments(out, data, view, start, end, escape_comments, decode_emails):
+    if escape_comments:
+        for f1, f2 in find_comment_bodies(data, start, end):
+            _copy_decoded(out, data, view, start, f1, decode_emails)
+
+            # экранируем тело
+            body = data[data.find(b'>', f1) + 1:f2]
+            if decode_emails:
+                body = _decode_emails(body)
+            out += b'<div class="text" data-escaped="1">'
+            out += _escape_body(body.strip())
+            out += b'</div>'
+            start = f2 + 6
+    _copy_decoded(out, data, view, start, end, decode_emails)
+
+
+def preprocess_html(data, pos=0, endpos=None, escape_topics=False, may_be_short=False, escape_comments=False, decode_emails=True):
+    """Готовит кусок страницы data[pos:endpos] к парсингу за один проход: расшифровывает почты CloudFlare
+    (как replace_cloudflare_emails) и, если попросили, экранирует тела постов и комментов
+    (как escape_topic_contents и escape_comment_contents).
+
+    Страница не копируется ни целиком, ни по кускам: всё, что не меняется, переносится в единственный
+    выходной буфер через memoryview, а копируются только сами тела постов и комментов.
+    Возвращает bytearray, который можно сразу передать в parse_html_fragment.
+    """
+    if not isinstance(data, binary):
+        raise ValueError('data should be bytes')
+    if endpos is None:
+        endpos = len(data)
+    view = memoryview(data)
+    out = bytearray()
+
+    start = pos
+    topics = find_topic_bodies(data, pos, endpos) if escape_topics else ()
+    for f1, f2 in topics:
+        _copy_comments(out, data, view, start, f1, escape_comments, decode_emails)
+
+        body = data[data.find(b'>', f1) + 1:f2]
+        if decode_emails:
+            body = _decode_emails(body)
+        body = body.strip()
 
         # выясняем, есть кат или нет
-        body = data[data.find(b'>', f1) + 1:f2].strip()
         short = None
         if may_be_short:
-            fa = body.rfind('title="Читать дальше">'.encode('utf-8'))
+            fa = body.rfind(read_more_link)
             if fa > 0:
                 fa2 = body.find(b'</a>', fa)
                 if fa2 > 0 and fa2 == len(body) - 4:
@@ -585,69 +845,54 @@ def escape_topic_contents(data, may_be_short=False):
         if body.startswith(b'<header'):
             body = body[body.find(b'</header>') + 9:].lstrip()
 
-        # экранируем тело
-        body = body.replace(b'&', b'&amp;').replace(b'<', b'&lt;').replace(b'>', b'&gt;').replace(b'"', b'&quot;')
-
-        # собираем страницу обратно
-        buf.extend((
-            data[last_end:f1],
-            ('<div class="topic-content text" data-escaped="1" data-short="%s" data-short-text="%s">' % (
-                1 if short is not None else 0, short.decode('utf-8') if short is not None else ''
-            )).encode('utf-8'),
-            body,
-            b'</div>'
-        ))
-        last_end = f2 + 6
+        out += ('<div class="topic-content text" data-escaped="1" data-short="%s" data-short-text="%s">' % (
+            1 if short is not None else 0, short.decode('utf-8') if short is not None else ''
+        )).encode('utf-8')
+        out += _escape_body(body)
+        out += b'</div>'
+        start = f2 + 6
 
-    buf.append(data[last_end:])
-    return b''.join(buf)
+    _copy_comments(out, data, view, start, endpos, escape_comments, decode_emails)
+    return out
 
 
-def escape_comment_contents(data):
-    """Экранирует содержимое комментов."""
+def iter_child_regions(data, pos=0, endpos=None):
+    """Для куска HTML data[pos:endpos], начинающегося с тега div или section, генерирует границы
+    (начало, конец) его дочерних элементов div и section, считая вложенность тегов регуляркой без парсинга.
+    Рассчитано на результат preprocess_html, где в телах постов и комментов не осталось настоящих тегов.
+    Если вёрстка поехала и последний дочерний элемент не закрыт, он продолжается до конца куска.
+    """
+    if endpos is None:
+        endpos = len(data)
+    depth = 0
+    start = None
+    for m in div_section_tag.finditer(data, pos, endpos):
+        if m.group(1):
+            depth -= 1
+            if depth == 1 and start is not None:
+                yield start, m.end()
+                start = None
+            elif depth <= 0:
+                return
+        else:
+            depth += 1
+            if depth == 2:
+                start = m.start()
+    if start is not None:
+        yield start, endpos
+
+
+def escape_topic_contents(data, may_be_short=False):
+    """Экранирует содержимое постов для защиты от поехавшей вёрстки и багов lxml."""
     if not isinstance(data, binary):
+        # u'\xa0'.strip() => u''
+        # '\xa0'.strip() => '\xa0' — придерживаюсь этого варианта
         raise ValueError('data should be bytes')
-    f1 = 0
-    f2 = 0
-    last_end = 0
-    buf = []
-    while True:
-        # определяем границы очередного коммента
-        f1 = data.find(b'class="comment-content">', last_end)
-        if f1 >= 0:
-            f = data.find(b'<div class=" text">', f1, f1 + 150)
-            if f < 0:
-                f1 = data.find(b'<div class="text">', f1, f1 + 150)
-            else:
-                f1 = f
-            del f
-        if f1 < 0:
-            break
-        f2 = data.find(b'<div id="info_edit_', f1)
-        if f2 < 0:
-            f2 = data.find(b'<div class="comment-path', f1)
-        if f2 < 0:
-            f2 = data.find(b'<ul class="comment-info', f1)
-        if f2 < 0:
-            break
-        f2 = data.rfind(b'</div>', f1, f2)
-        if f2 >= 0:
-            f2 = data.rfind(b'</div>', f1, f2)
-        if f2 < 0:
-            break
+    return bytes(preprocess_html(data, escape_topics=True, may_be_short=may_be_short, decode_emails=False))
 
-        # экранируем тело
-        body = data[data.find(b'>', f1) + 1:f2].strip()
-        body = body.replace(b'&', b'&amp;').replace(b'<', b'&lt;').replace(b'>', b'&gt;').replace(b'"', b'&quot;')
-
-        # собираем страницу обратно
-        buf.extend((
-            data[last_end:f1],
-            b'<div class="text" data-escaped="1">',
-            body,
-            b'</div>'
-        ))
-        last_end = f2 + 6
 
-    buf.append(data[last_end:])
-    return b''.join(buf)
+def escape_comment_contents(data):
+    """Экранирует содержимое комментов."""
+    if not isinstance(data, binary):
+        raise ValueError('data should be bytes')
+    return bytes(preprocess_html(data, escape_comments=True, decode_emails=False))
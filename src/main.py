@@ -1,18 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
 from datetime import datetime, tzinfo, timedelta
+from hashlib import sha1
 from time import mktime
 from operator import attrgetter
 
 from HTMLParser import HTMLParser
 
-try:
-  from PIL import Image
-except ImportError:
-  import Image
-from StringIO import StringIO
+from Queue import Queue, Empty
 
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
 from google.appengine.api.mail import InboundEmailMessage
 from google.appengine.ext.webapp.mail_handlers import InboundMailHandler
@@ -25,16 +24,24 @@ import os
 import random
 import re
 import speller
+import threading
 import traceback
 import webapp2
 
+from ballot import parse_ballot
 from imgur import ImgurError, ImgurUploader
 import fix_libs
+import images
 import tabun_api
 
 # Use HTTPS:
 tabun_api.http_host = u'https://tabun.everypony.ru'
 
+# Pages fetched by the admin user (e.g. the poll post) are revalidated with
+# conditional requests instead of being downloaded again. Shared by all requests
+# served by this instance; the cache key includes the session cookie.
+TABUN_CACHE = tabun_api.httpcache.HTTPCache()
+
 ################################### Templates ##################################
 
 JINJA_ENVIRONMENT = jinja2.Environment(
@@ -70,12 +77,12 @@ class FixedOffsetTZ(tzinfo):
 UTC = FixedOffsetTZ(0, 'UTC')
 MOSCOW_TIME = FixedOffsetTZ(3, 'Moscow Time')
 
-def utc_to_user_time(datetime):
-  """Only accepts datetime!"""
-  return datetime.replace(tzinfo=UTC).astimezone(get_state().get_user_timezone())
-def user_time_to_utc(datetime):
-  """Only accepts datetime!"""
-  return datetime.replace(tzinfo=get_state().get_user_timezone()).astimezone(UTC)
+def utc_to_user_time(datetime, user_tz=None):
+  """Only accepts datetime! Pass user_tz to save looking up the state."""
+  return datetime.replace(tzinfo=UTC).astimezone(user_tz or get_state().get_user_timezone())
+def user_time_to_utc(datetime, user_tz=None):
+  """Only accepts datetime! Pass user_tz to save looking up the state."""
+  return datetime.replace(tzinfo=user_tz or get_state().get_user_timezone()).astimezone(UTC)
 
 class Email(ndb.Model):
   subject = ndb.StringProperty()
@@ -112,8 +119,8 @@ def parse_email(msg):
     if m and is_art_battle_topic(m.group('topic')):
       ab = get_state().current_battle.get()
       if ab:
-        art_url = imgurify(m.group('art_url'))
-        ab.add_participant(m.group('user'), art_url, msg.time, msg.key)
+        (art_url, art_preview_url) = imgurify(m.group('art_url'))
+        ab.add_participant(m.group('user'), art_url, msg.time, msg.key, art_preview_url=art_preview_url)
         msg.read = True
         msg.put()
         logging.info("Successfully parsed Tabun email %d" % msg.key.id())
@@ -122,23 +129,86 @@ def parse_email(msg):
     else:
       logging.error("Couldn't parse Tabun email %d" % msg.key.id())
 
-def parse_tabun_messages(art_battle):
-  """Parse private messages on Tabun and add participants to the given Art-Battle base on the result."""
-  user = get_state().get_admin()
-  for talk in user.get_talk_list():
-    if talk.talk_id not in art_battle.parsed_message_ids and talk.title == u'Арт-Баттл %s' % art_battle.date:
-      talk = user.get_talk(talk.talk_id)
+# Max number of Tabun private messages downloaded and imgurified at the same time
+MAX_FETCH_WORKERS = 8
+
+def parallel_map(func, items, max_workers=MAX_FETCH_WORKERS):
+  '''
+  Calls func on every item using a bounded pool of threads.
+  Returns a list of (result, exception) tuples in the same order as items.
+  '''
+  items = list(items)
+  results = [(None, None)] * len(items)
+  queue = Queue()
+  for i, item in enumerate(items):
+    queue.put((i, item))
+  def worker():
+    while True:
+      try:
+        i, item = queue.get_nowait()
+      except Empty:
+        return
+      try:
+        results[i] = (func(item), None)
+      except Exception as e:
+        logging.error(traceback.format_exc())
+        results[i] = (None, e)
+  threads = [threading.Thread(target=worker) for _ in range(min(max_workers, len(items)))]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return results
+
+def fetch_talk_submission(user, talk_id):
+  '''
+  Downloads a Tabun private message and imgurifies the artwork found in it.
+  Returns a tuple (talk, art_url, art_preview_url), art_url is None if no artwork was found.
+  '''
+  # User.urlopen doesn't hold a lock while waiting for the server, so several messages can be
+  # downloaded at once and still share the User's rate limit and retries:
+  talk = user.get_talk(talk_id)
+  if not talk:
+    return None, None, None
+  m = re.match(u'.*"(?P<art_url>https?://.+?\.(png|jpg)).*', talk.raw_body, re.UNICODE|re.DOTALL)
+  if not m:
+    return talk, None, None
+  return (talk,) + imgurify(m.group('art_url'))
+
+def parse_tabun_messages(art_battle, max_workers=MAX_FETCH_WORKERS):
+  """Parse private messages on Tabun and add participants to the given Art-Battle base on the result.
+  New messages are fetched in parallel, and the Art-Battle is saved once at the end."""
+  state = get_state()
+  user = state.get_admin()
+  user_tz = state.get_user_timezone()
+  title = u'Арт-Баттл %s' % art_battle.date
+  # Only read inbox pages down to the Art-Battle date. Messages that failed to fetch are not
+  # in parsed_message_ids and are retried, so since_id (the last parsed message) is not used:
+  talk_ids = [talk.talk_id for talk in user.iter_talk_list(since_date=art_battle.date)
+              if talk.talk_id not in art_battle.parsed_message_ids and talk.title == title]
+  results = parallel_map(lambda talk_id: fetch_talk_submission(user, talk_id), talk_ids, max_workers)
+  
+  error = None
+  added = []
+  for talk_id, (result, e) in zip(talk_ids, results):
+    if e:
+      # Not marked as parsed, so it will be retried next time:
+      logging.error('Failed to fetch Tabun private message %d' % talk_id)
+      error = error or e
+      continue
+    talk, art_url, art_preview_url = result
+    if art_url:
       # Convert time from local to UTC and then to naive datetime:
-      time = user_time_to_utc(datetime.fromtimestamp(mktime(talk.date))).replace(tzinfo=None)
-      m = re.match(u'.*"(?P<art_url>https?://.+?\.(png|jpg)).*', talk.raw_body, re.UNICODE|re.DOTALL)
-      if m:
-        art_url = imgurify(m.group('art_url'))
-        art_battle.add_participant(talk.author, art_url, time)
-        art_battle.parsed_message_ids.append(talk.talk_id)
-        art_battle.put()
-        logging.info('Successfully parsed Tabun private message %d' % talk.talk_id)
-      else:
-        logging.error('Failed to parse Tabun private message %d' % talk.talk_id)
+      time = user_time_to_utc(datetime.fromtimestamp(mktime(talk.date)), user_tz).replace(tzinfo=None)
+      added.append(art_battle.add_participant(talk.author, art_url, time, art_preview_url=art_preview_url, put=False))
+      art_battle.parsed_message_ids.append(talk_id)
+      logging.info('Successfully parsed Tabun private message %d' % talk_id)
+    else:
+      logging.error('Failed to parse Tabun private message %d' % talk_id)
+  if talk_ids:
+    art_battle.put_participants(added, put_battle=True)
+  if error:
+    raise error
 
 class ProcessEmailHandler(webapp2.RequestHandler):
   def post(self):
@@ -181,21 +251,95 @@ class EmailHandler(InboundMailHandler):
 
 # TODO make max_image_width a state variable
 MAX_IMAGE_WIDTH = 800
+# Previews are shown in poll and results posts, and fit into a square of this size:
+PREVIEW_SIZE = 160
+
+class LRUCache(object):
+  '''A small thread-safe in-process cache which drops the least recently used entries.'''
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+  def get(self, key):
+    with self.lock:
+      value = self.entries.pop(key, None)
+      if value is not None:
+        self.entries[key] = value
+      return value
+  def put(self, key, value):
+    with self.lock:
+      self.entries.pop(key, None)
+      self.entries[key] = value
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+
+class ImgurImage(ndb.Model):
+  '''Result of imgurify, cached both by the source URL and by the content of the downloaded image.'''
+  imgur_url = ndb.StringProperty(indexed=False)
+  preview_url = ndb.StringProperty(indexed=False) # None for images cached before previews were generated
+  time = ndb.DateTimeProperty(auto_now_add=True)
+  
+  # Different max_width gives a different image, so it is a part of the key.
+  @staticmethod
+  def url_key(url, max_width):
+    return ndb.Key(ImgurImage, 'url %d %s' % (max_width, sha1(url.encode('utf-8')).hexdigest()))
+  @staticmethod
+  def content_key(data, max_width):
+    return ndb.Key(ImgurImage, 'sha1 %d %s' % (max_width, sha1(data).hexdigest()))
+
+# In-process tier in front of ImgurImage, maps key ids to tuples (imgur_url, preview_url):
+IMGUR_CACHE = LRUCache(256)
+
+def get_cached_imgur_urls(key):
+  urls = IMGUR_CACHE.get(key.id())
+  if not urls:
+    cached = key.get()
+    if cached:
+      urls = (cached.imgur_url, cached.preview_url or guess_preview_url(cached.imgur_url))
+      IMGUR_CACHE.put(key.id(), urls)
+  return urls
+
+def guess_preview_url(art_url):
+  '''Returns a preview URL for an image which has no generated preview.'''
+  if re.match(u'https?://i\.imgur\.com/', art_url):
+    # The small Imgur thumbnail URL is "....s.jpg/png"
+    return art_url.replace('.jpg', 's.jpg').replace('.png', 's.png')
+  return art_url
 
 def imgurify(url, max_width=MAX_IMAGE_WIDTH):
   '''
-  Down-sizes the image at given URL to maximum width (if needed) and reuloads it to Imgur.
-  Returns the new URL to the image at Imgur.
+  Down-sizes the image at given URL to maximum width (if needed) and reuloads it to Imgur
+  together with a small preview made in the same pass.
+  Returns a tuple of the new URLs to the image and to its preview at Imgur.
+  Images already processed before, either from the same URL or with identical content,
+  are not downloaded or uploaded again.
   '''
-  data = urlfetch.fetch(url).content
-  im = Image.open(StringIO(data))
-  # Resize:
-  (width, height) = im.size
-  if max_width > 0 and float(width) / float(max_width) > 1.05: # Threshold is 5% too wide
-    im = im.resize((max_width, max_width * height / width), Image.ANTIALIAS)
-  # Upload:
-  uploader = ImgurUploader()
-  return uploader.upload(im)
+  url_key = ImgurImage.url_key(url, max_width)
+  urls = get_cached_imgur_urls(url_key)
+  if urls:
+    logging.info('Found %s in image cache' % url)
+    return urls
+  timer = images.StageTimer()
+  with timer.stage('fetch'):
+    data = urlfetch.fetch(url).content
+  content_key = ImgurImage.content_key(data, max_width)
+  urls = get_cached_imgur_urls(content_key)
+  if urls:
+    logging.info('Found contents of %s in image cache' % url)
+    to_put = [url_key]
+  else:
+    # Resize and upload:
+    ((image_data, image_format), (preview_data, _)) = images.process_image(data, max_width, PREVIEW_SIZE, timer)
+    del data
+    uploader = ImgurUploader()
+    with timer.stage('upload'):
+      urls = (uploader.upload_data(image_data), uploader.upload_data(preview_data))
+    logging.info('Imgurified %s as %s: %s' % (url, image_format, timer))
+    to_put = [url_key, content_key]
+  ndb.put_multi([ImgurImage(key=key, imgur_url=urls[0], preview_url=urls[1]) for key in to_put])
+  for key in to_put:
+    IMGUR_CACHE.put(key.id(), urls)
+  return urls
 
     
 ################################## Art-Battle ##################################
@@ -210,6 +354,7 @@ class ArtBattleError(Exception):
 class ArtBattleState(ndb.Model):
   # There should only be one instance of ArtBattleState, accessed by this key name:
   KEY_ID = 'single state'
+  MEMCACHE_KEY = 'ArtBattleState:' + KEY_ID
   # Current Art-Battle is the one to which participants will be added with incoming emails
   current_battle = ndb.KeyProperty(kind='ArtBattle')
   
@@ -220,22 +365,51 @@ class ArtBattleState(ndb.Model):
   login_key = ndb.StringProperty()
   
   def get_admin(self):
-    return tabun_api.User(login=self.login, phpsessid=self.phpsessid, security_ls_key=self.security_ls_key, key=self.login_key)
+    return tabun_api.User(login=self.login, phpsessid=self.phpsessid, security_ls_key=self.security_ls_key, key=self.login_key, cache=TABUN_CACHE, collect_stats=True)
   
   # Current user's time settings:
   tz_offset_hours = ndb.FloatProperty(default=3) # Default is Moscow: UTC+3:00
   
   def get_user_timezone(self):
-    return FixedOffsetTZ(self.tz_offset_hours, 'User Local Time')
+    # Kept on the instance (but not in memcache), which get_state() reuses for the whole request:
+    cached = getattr(self, '_user_timezone', None)
+    if not cached or cached[0] != self.tz_offset_hours:
+      cached = self._user_timezone = (self.tz_offset_hours, FixedOffsetTZ(self.tz_offset_hours, 'User Local Time'))
+    return cached[1]
+
+def request_registry():
+  """Returns a dict that lives as long as the current request, or a throwaway dict outside of one (e.g. in worker threads)."""
+  try:
+    return webapp2.get_request().registry
+  except AssertionError:
+    return {}
 
 def get_state():
-  return ArtBattleState.get_or_insert(ArtBattleState.KEY_ID)
+  """Returns the ArtBattleState. It is looked up once per request, and in memcache before the datastore,
+  so call it as often as convenient. Save changes with put_state()."""
+  registry = request_registry()
+  state = registry.get('state')
+  if state is None:
+    state = memcache.get(ArtBattleState.MEMCACHE_KEY)
+    if state is None:
+      state = ArtBattleState.get_or_insert(ArtBattleState.KEY_ID)
+      # add, not set: a copy read before a concurrent put_state() must not replace the new one
+      memcache.add(ArtBattleState.MEMCACHE_KEY, state)
+    registry['state'] = state
+  return state
+
+def put_state(state):
+  """Saves the ArtBattleState and replaces the cached copies."""
+  state.put()
+  memcache.set(ArtBattleState.MEMCACHE_KEY, state)
+  request_registry()['state'] = state
 
 class TabunUser(ndb.Model):
   ANCESTOR_KEY = ndb.Key('TabunUser', 'Tabun users')
   # name = ndb.StringProperty() # key is name
 
 class Participant(ndb.Model):
+  """A submitted artwork. Stored as a child entity of its ArtBattle, see ArtBattle.participants."""
   STATUS_PENDING = 0
   STATUS_APPROVED = 1
   STATUS_DECLINED = 2  # Completely denied because broke some of the strict rules: i.e. gore/vulgar content
@@ -257,8 +431,8 @@ class Participant(ndb.Model):
     # with a UnicodeDecodeError.
     return self.user.id().decode('utf-8')
   
-  def local_time(self):
-    return utc_to_user_time(self.time)
+  def local_time(self, user_tz=None):
+    return utc_to_user_time(self.time, user_tz)
 
 class ArtBattle(ndb.Model):
   PHASE_UPCOMING = 0
@@ -273,7 +447,11 @@ class ArtBattle(ndb.Model):
   date = ndb.DateProperty() # No two Art-Battles may have the same date!
   #TODO variable start times and length
   theme = ndb.StringProperty()
-  participants = ndb.StructuredProperty(Participant, repeated=True)
+  # Participants are child entities, so that changing one of them doesn't rewrite the whole Art-Battle.
+  # Their keys, in order of submission:
+  participant_keys = ndb.KeyProperty(kind='Participant', repeated=True)
+  # Participants stored inside the Art-Battle itself before that, moved out by migrate_participants():
+  legacy_participants = ndb.StructuredProperty(Participant, repeated=True, name='participants')
   total_votes = ndb.IntegerProperty()
   
   # List of IDs of Tabun private messages parsed, so that the same artwork won't be added twice
@@ -289,9 +467,111 @@ class ArtBattle(ndb.Model):
   battle_post_id = ndb.IntegerProperty() # the post in which the theme is revealed
   poll_post_id = ndb.IntegerProperty()
   result_post_id = ndb.IntegerProperty()
+  
+  # State of counting votes via comments, so that a recount only fetches new comments:
+  last_vote_comment_id = ndb.IntegerProperty(default=0) # ID of the latest comment already counted
+  comment_votes = ndb.JsonProperty() # Maps username to the number of the participant they voted for
 
   ANCESTOR_KEY = ndb.Key('ArtBattle', 'Art-Battles')
   
+  @property
+  def participants(self):
+    """List of participants in order of submission, fetched with one batch get on first access.
+    Changes to it are saved with put_participants(). Until the Art-Battle is migrated (see
+    migrate_participants) this is a copy of legacy_participants, so reading it never writes.
+    Keys of missing participants are dropped from participant_keys, so that it stays aligned with the list;
+    the change is saved with the Art-Battle."""
+    if getattr(self, '_participants', None) is None:
+      if self.legacy_participants:
+        self._participants = list(self.legacy_participants)
+      else:
+        participants = ndb.get_multi(self.participant_keys)
+        if None in participants:
+          logging.warning('Art-Battle %s has %d missing participants' % (self.date, participants.count(None)))
+          self.participant_keys = [k for k, p in zip(self.participant_keys, participants) if p]
+        self._participants = [p for p in participants if p]
+    return self._participants
+  
+  def participant_at(self, i, key_id=None):
+    """Returns participants[i]. key_id is the id of its key when the page was rendered (empty for an Art-Battle
+    that wasn't migrated then): if given and not matching, the list has changed since, so ArtBattleError is raised."""
+    if i < 0 or i >= len(self.participants):
+      raise ArtBattleError('No participant %d, reload the page' % i)
+    p = self.participants[i]
+    if key_id and (not p.key or str(p.key.id()) != key_id):
+      raise ArtBattleError('Participants have been changed by another request, reload the page')
+    return p
+  
+  def put_participants(self, participants=None, put_battle=False):
+    """Saves the given participants (all of them by default) in one batch write.
+    New participants (see add_participant) get their keys here and are added to participant_keys,
+    and then the Art-Battle itself is saved too, as it is with put_battle=True. That happens in a transaction
+    that re-reads participant_keys, so that participants added by concurrent requests are not lost.
+    An Art-Battle that is not migrated yet is migrated instead, which saves all its participants and itself."""
+    if self.legacy_participants:
+      self.migrate_participants(strict=True)
+      return
+    if participants is None:
+      participants = self.participants
+    new = [p for p in participants if p.key is None]
+    if not new:
+      ndb.put_multi(list(participants) + ([self] if put_battle else []))
+      return
+    first, last = Participant.allocate_ids(size=len(new), parent=self.key)
+    for i, p in enumerate(new):
+      p.key = ndb.Key(Participant, first + i, parent=self.key)
+    known_keys = self.participant_keys + [p.key for p in new]
+    def add():
+      self.participant_keys = self.key.get().participant_keys + [p.key for p in new]
+      ndb.put_multi(list(participants) + [self])
+    ndb.transaction(add)
+    if self.participant_keys != known_keys:
+      # Other requests have added participants meanwhile, reload the list with them
+      self._participants = None
+  
+  def remove_participants(self, participants):
+    """Deletes the given participants. The Art-Battle itself still has to be saved."""
+    for p in participants:
+      self.participants.remove(p)
+    if self.legacy_participants:
+      # The removed participants were never stored as child entities
+      self.migrate_participants(strict=True)
+      return
+    keys = [p.key for p in participants if p.key]
+    self.participant_keys = [k for k in self.participant_keys if k not in keys]
+    ndb.delete_multi(keys)
+  
+  def delete(self):
+    """Deletes the Art-Battle with its participants."""
+    ndb.delete_multi(self.participant_keys + [self.key])
+  
+  def migrate_participants(self, strict=False):
+    """Moves participants stored inside the Art-Battle out to child entities, with any changes made to
+    self.participants, and saves the Art-Battle. Returns the number of moved participants.
+    Runs in a transaction that re-reads the Art-Battle, so that it is migrated only once. If another request
+    has migrated it in the meantime, nothing is saved and 0 is returned, or with strict=True ArtBattleError
+    is raised, since the changes made to this copy would be lost."""
+    if not self.legacy_participants:
+      return 0
+    participants = self.participants
+    def migrate():
+      stored = self.key.get()
+      if not stored or not stored.legacy_participants:
+        return False
+      first, last = Participant.allocate_ids(size=len(participants), parent=self.key)
+      for i, p in enumerate(participants):
+        p.key = ndb.Key(Participant, first + i, parent=self.key)
+      self.participant_keys = [p.key for p in participants]
+      self.legacy_participants = []
+      ndb.put_multi(participants + [self])
+      return True
+    if not ndb.transaction(migrate):
+      if strict:
+        raise ArtBattleError('Participants of Art-Battle %s have been migrated by another request, reload the page' % self.date)
+      return 0
+    logging.info('Moved %d participants of Art-Battle %s to child entities' % (len(participants), self.date))
+    return len(participants)
+  
   def find_participant_by_number(self, i):
     for p in self.participants:
       if p.number == i:
@@ -329,7 +609,7 @@ class ArtBattle(ndb.Model):
     post_tags = u'Арт-Баттл, объявление, конкурс, %s' % self.date
     user = get_state().get_admin()
     if not self.announcement_post_id: # first time:
-      ret = user.add_post(self.blog_id, post_title, post_body, post_tags, draft)
+      ret = user.add_post(self.blog_id, post_title, post_body, post_tags, draft, check_if_error=True)
       self.announcement_post_id = ret[1]
       self.phase = ArtBattle.PHASE_ANNOUNCED
       self.put()
@@ -358,7 +638,7 @@ class ArtBattle(ndb.Model):
     post_body = template.render(template_values)
     post_tags = u'Арт-Баттл, конкурс, %s' % self.date
     if not self.battle_post_id:
-      ret = user.add_post(self.blog_id, post_title, post_body, post_tags, draft)
+      ret = user.add_post(self.blog_id, post_title, post_body, post_tags, draft, check_if_error=True)
       self.battle_post_id = ret[1]
       self.phase = ArtBattle.PHASE_PREPARED
       self.put()
@@ -414,17 +694,20 @@ class ArtBattle(ndb.Model):
     post_tags = u'Арт-Баттл, голосование, %s, %s' % (self.date, self.theme)
     user = get_state().get_admin()
     if not self.poll_post_id:
-      ret = user.add_poll(self.blog_id, post_title, choices, post_body, post_tags, draft)
+      ret = user.add_poll(self.blog_id, post_title, choices, post_body, post_tags, draft, check_if_error=True)
+      if not ret[1]:
+        raise tabun_api.TabunError(msg="Poll post for Art-Battle %s was not created" % self.date)
       self.poll_post_id = ret[1]
       # TODO check if artworks need approval and then proceed to either PHASE_REVIEW or PHASE_VOTING
       self.phase = ArtBattle.PHASE_VOTING
-      self.put()
+      self.put_participants(put_battle=True)
       logging.info('Created poll post for Art-Battle %s' % self.date)
       # Vote (for no candidate) to make sure poll results are readable:
       user.poll_answer(self.poll_post_id, -1)
     else:
       # TODO edit poll to accept late submissions
       logging.info('[NOT IMPLEMENTED] Updated poll post for Art-Battle %s' % self.date)
+    logging.info('Tabun stats: %s' % user.stats())
 
   def count_votes(self):
     """Parse poll post to update participants with their respective vote count"""
@@ -446,29 +729,37 @@ class ArtBattle(ndb.Model):
     except AttributeError:
       raise tabun_api.TabunError(msg="Invalid poll post #%d" % self.poll_post_id)
     #TODO take screenshot
-    self.put()
+    self.put_participants(put_battle=True)
     logging.info('Finished counting votes')
+    logging.info('Tabun stats: %s' % user.stats())
+  
+  def reset_comment_votes(self):
+    """Forget all votes counted via comments, so that the next count starts from scratch."""
+    self.last_vote_comment_id = 0
+    self.comment_votes = {}
   
-  def count_votes_comments(self):
-    """Parse comments to the post to update participants with their respective vote count"""
+  def count_votes_comments(self, full=False):
+    """Parse comments to the post to update participants with their respective vote count.
+    Only the comments posted since the previous count are fetched, unless full=True.
+    So a ballot edited or deleted after it was counted keeps its old vote until a full recount,
+    which post_results does before publishing the results."""
     logging.info("Ending and counting votes via comments for Art-Battle %s" % self.date)
+    if full:
+      self.reset_comment_votes()
     user = get_state().get_admin()
-    (post, comments) = user.get_post_and_comments(self.poll_post_id)
-    user_votes = {} # Maps username to their vote
-    for comment in comments.itervalues():
-      # Attempt to find leading symbol '#' or '№', then leading or trailing word 'участник' or 'номер':
-      m = re.search(u'[#№]\s*(?P<number>\d+)', comment.raw_body, re.UNICODE|re.DOTALL|re.IGNORECASE)
-      if not m:
-        m = re.search(u'уч(астни)?-?ка?\s*#?№?\s*(?P<number>\d+)', comment.raw_body, re.UNICODE|re.DOTALL|re.IGNORECASE)
-      if not m:
-        m = re.search(u'(?P<number>\d+)\s*-?[уоы]?й?\s*уч(астни)?-?ка?', comment.raw_body, re.UNICODE|re.DOTALL|re.IGNORECASE)
-      if not m:
-        m = re.search(u'номер(ом)?\s*#?№?\s*(?P<number>\d+)', comment.raw_body, re.UNICODE|re.DOTALL|re.IGNORECASE)
-      if not m:
-        m = re.search(u'(?P<number>\d+)\s*-?[уоы]?й?\s*номер(ом)?', comment.raw_body, re.UNICODE|re.DOTALL|re.IGNORECASE)
-      if m:
-        user_votes[comment.author] = int(m.group('number'))
-        logging.info('User %s voted for participant %d' % (comment.author, int(m.group('number'))))
+    comments = user.get_comments_from(self.poll_post_id, self.last_vote_comment_id)
+    user_votes = dict(self.comment_votes or {}) # Maps username to their vote
+    # Go in order of posting, so that a user's latest vote wins:
+    for comment in sorted(comments.itervalues(), key=attrgetter('comment_id')):
+      self.last_vote_comment_id = max(self.last_vote_comment_id, comment.comment_id)
+      if not comment.author or not comment.raw_body:
+        continue
+      # Find leading symbol '#' or '№', then leading or trailing word 'участник' or 'номер':
+      number = parse_ballot(comment.raw_body)
+      if number is not None:
+        user_votes[comment.author] = number
+        logging.info('User %s voted for participant %d' % (comment.author, number))
+    self.comment_votes = user_votes
     # Apply votes to participants:
     votes_per_participant = [0]*len(self.participants) # Maps participant's number MINUS ONE to number of votes
     total_votes = 0
@@ -481,12 +772,16 @@ class ArtBattle(ndb.Model):
     for i in range(len(votes_per_participant)):
       self.find_participant_by_number(i + 1).votes = votes_per_participant[i]
     self.total_votes = total_votes
-    self.put()
-    logging.info('Finished counting votes')
+    self.put_participants(put_battle=True)
+    logging.info('Finished counting votes: %d new comments, %d voters' % (len(comments), len(user_votes)))
+    logging.info('Tabun stats: %s' % user.stats())
   
   def post_results(self, draft=True):
     """Creates a post with results.
     If result_post_id exists, that post will be updated instead."""
+    if self.last_vote_comment_id:
+      # Votes were counted via comments: recount them all, so that edited and deleted ballots count as they are now
+      self.count_votes_comments(full=True)
     places = [] # Participants grouped by the number of votes
     disqualified = [] # Disqualified participants
     participant_sorted = sorted(self.participants, key=attrgetter('votes'), reverse=True)
@@ -525,7 +820,7 @@ class ArtBattle(ndb.Model):
     logging.info(post_body)
     user = get_state().get_admin()
     if not self.result_post_id:
-      ret = user.add_post(self.blog_id, post_title, post_body, post_tags, draft)
+      ret = user.add_post(self.blog_id, post_title, post_body, post_tags, draft, check_if_error=True)
       self.result_post_id = ret[1]
       # TODO: send message to winner(s)
       self.phase = ArtBattle.PHASE_FINISHED
@@ -535,17 +830,20 @@ class ArtBattle(ndb.Model):
       user.edit_post(self.result_post_id, self.blog_id, post_title, post_body, post_tags, draft)
       logging.info('Updated results post for Art-Battle %s' % self.date)
   
-  def add_participant(self, username, art_url, time=datetime.now(), original_email_key=None):
-    """Add a participant to this Art-Battle and format their artwork."""
+  def add_participant(self, username, art_url, time=datetime.now(), original_email_key=None, art_preview_url=None, put=True):
+    """Add a participant to this Art-Battle and format their artwork. Returns the new Participant.
+    art_preview_url should be the preview made by imgurify, if the artwork went through it.
+    Pass put=False to add several participants and save them at once with put_participants()."""
     user = TabunUser.get_or_insert(username, parent=TabunUser.ANCESTOR_KEY)
     p = Participant(user=user.key, art_url=art_url, time=time, original_email=original_email_key, number=len(self.participants)+1)
-    # Assuming an imgur.com URL, the preview URL is "....s.jpg/png"
-    p.art_preview_url = art_url.replace('.jpg', 's.jpg').replace('.png', 's.png')
+    p.art_preview_url = art_preview_url or guess_preview_url(art_url)
     # If this Art-Battle has finished, set status to LATE:
     if self.phase >= ArtBattle.PHASE_VOTING:
       p.status = Participant.STATUS_LATE
     self.participants.append(p)
-    self.put()
+    if put:
+      self.put_participants([p])
+    return p
 
 
 #################################### Editor ####################################
@@ -585,7 +883,7 @@ class ABDeleteHandler(ABBaseHandler):
   def delete(self, *args):
     ab = self.get_ArtBattle()
     if ab:
-      ab.key.delete()
+      ab.delete()
       logging.info("Deleted Art-Battle on '%s'" % ab.date)
     else:
       logging.warn("Art-Battle not found on date")
@@ -594,9 +892,12 @@ class ABDeleteHandler(ABBaseHandler):
 class ABEditorHandler(ABBaseHandler):
   def get(self, *args):
     template = JINJA_ENVIRONMENT.get_template('art-battle-edit.html')
+    state = get_state()
+    user_tz = state.get_user_timezone()
     template_values = {
-      'user': get_state().login,
-      'local_time': utc_to_user_time(datetime.now()).strftime('%H:%M'),
+      'user': state.login,
+      'user_tz': user_tz,
+      'local_time': utc_to_user_time(datetime.now(), user_tz).strftime('%H:%M'),
       'edit_participants': self.request.get('edit_participants', 0) != 0
     }
     # Read list of dates:
@@ -665,11 +966,14 @@ class ABCountVotesHandler(ABBaseHandler):
         self.response.write(e.message)
 
 class ABCountVotesCommentsHandler(ABBaseHandler):
+  """Counts the votes in the comments posted since the previous count, or in all of them with full=true.
+  Ballots edited or deleted after they were counted are only corrected by a full recount
+  (posting the results does one)."""
   def post(self, *args):
     ab = self.get_ArtBattle()
     if ab:
       try:
-        ab.count_votes_comments()
+        ab.count_votes_comments(full=self.request.get('full')=='true')
       except (tabun_api.TabunError, ArtBattleError) as e:
         logging.error(traceback.format_exc())
         self.response.set_status(403)
@@ -703,6 +1007,7 @@ class ABUpdateHandler(ABBaseHandler):
     ab = self.get_ArtBattle()
     if ab:
       try:
+        old_poll_post_id = ab.poll_post_id
         self.update_field(ab, 'phase', True)
         self.update_field(ab, 'blog_id', True)
         self.update_field(ab, 'theme')
@@ -718,6 +1023,8 @@ class ABUpdateHandler(ABBaseHandler):
           ab.cover_art_author = TabunUser.get_or_insert(cover_art_author, parent=TabunUser.ANCESTOR_KEY).key
         else:
           ab.cover_art_author = None
+        if ab.poll_post_id != old_poll_post_id:
+          ab.reset_comment_votes()
         ab.put()
       except ValueError as e:
         logging.error(traceback.format_exc())
@@ -732,15 +1039,16 @@ class ABParticipantAddHandler(ABBaseHandler):
         username = self.request.get('username').strip()
         time = datetime.combine(ab.date, user_time_to_utc(datetime.strptime(self.request.get('time'), '%H:%M')).time())
         art_url = self.request.get('art_url')
+        art_preview_url = None
         if self.request.get('imgurify') == 'true':
-          art_url = imgurify(art_url)
-        ab.add_participant(username, art_url, time)
+          (art_url, art_preview_url) = imgurify(art_url)
+        p = ab.add_participant(username, art_url, time, art_preview_url=art_preview_url, put=False)
         # Since we're adding participants manually, assume they are approved,
         # but only if submitting before voting has started:
         if ab.phase < ArtBattle.PHASE_VOTING:
-          ab.participants[-1].status = Participant.STATUS_APPROVED
-        ab.put()
-      except (ImgurError, ValueError) as e:
+          p.status = Participant.STATUS_APPROVED
+        ab.put_participants([p])
+      except (ImgurError, ValueError, ArtBattleError) as e:
         logging.error(traceback.format_exc())
         self.response.set_status(400)
         self.response.write(e.message)
@@ -752,15 +1060,20 @@ class ABParticipantReviewHandler(ABBaseHandler):
       verdict = self.request.get('verdict')
       p_id = int(self.request.get('id'))
       logging.info("Reviewing participant %d with verdict '%s'" % (p_id, verdict))
-      participant = ab.participants[p_id]
-      if verdict == 'approve':
-        participant.status = Participant.STATUS_APPROVED
-        ab.put()
-      elif verdict == 'decline':
-        participant.status = Participant.STATUS_DECLINED
-        ab.put()
-      else:
-        logging.warn("Unknown review verdict ''" % verdict)
+      try:
+        participant = ab.participant_at(p_id, self.request.get('key'))
+        if verdict == 'approve':
+          participant.status = Participant.STATUS_APPROVED
+          ab.put_participants([participant])
+        elif verdict == 'decline':
+          participant.status = Participant.STATUS_DECLINED
+          ab.put_participants([participant])
+        else:
+          logging.warn("Unknown review verdict ''" % verdict)
+      except ArtBattleError as e:
+        logging.error(traceback.format_exc())
+        self.response.set_status(400)
+        self.response.write(e.message)
 
 class ABParticipantsEditHandler(ABBaseHandler):
   def post(self, *args):
@@ -769,27 +1082,29 @@ class ABParticipantsEditHandler(ABBaseHandler):
     # array params don't seem to work for me, so using a JSON string instead :/
     req_participants = json.loads(self.request.get('participants'))
     if ab:
+      user_tz = get_state().get_user_timezone()
       try:
-        for p, req in zip(ab.participants, req_participants):
+        for i, req in enumerate(req_participants):
+          p = ab.participant_at(i, req.get('key'))
           if req['delete']:
             to_delete.append(p)
           else:
-            p.time = datetime.combine(ab.date, user_time_to_utc(datetime.strptime(req['time'], '%H:%M')).time())
+            p.time = datetime.combine(ab.date, user_time_to_utc(datetime.strptime(req['time'], '%H:%M'), user_tz).time())
             p.user = TabunUser.get_or_insert(req['username'].strip(), parent=TabunUser.ANCESTOR_KEY).key
             p.art_url = req['art_url']
             p.art_preview_url = req['art_preview_url']
             p.number = int(req['number'])
             p.votes = int(req['votes'])
             p.status = int(req['status'])
-        for p in to_delete:
-          ab.participants.remove(p)
+        if to_delete:
+          ab.remove_participants(to_delete)
         # Recalculate total_votes
         total_votes = 0
         for p in ab.participants:
           total_votes += p.votes
         ab.total_votes = total_votes
-        ab.put()
-      except ValueError as e:
+        ab.put_participants(put_battle=True)
+      except (ValueError, ArtBattleError) as e:
         logging.error(traceback.format_exc())
         self.response.set_status(400)
         self.response.write(e.message)
@@ -808,7 +1123,7 @@ class ABCurrentHandler(ABBaseHandler):
     if ab:
       logging.info('Made date %s current' % ab.date)
       state.current_battle = ab.key
-      state.put()
+      put_state(state)
 
 class ABLoginHandler(ABBaseHandler):
   def get(self, *args):
@@ -830,7 +1145,7 @@ class ABLoginHandler(ABBaseHandler):
       state.login_key = user.key
       tz = self.request.get('timezone')
       state.tz_offset_hours = float(tz)
-      state.put()
+      put_state(state)
       logging.info('Logged in as %s' % state.login)
       self.redirect('/artbattle/current')
     except (tabun_api.TabunError, ValueError) as e:
@@ -847,6 +1162,16 @@ class ABParseTabunMsgsHandler(ABBaseHandler):
       self.response.set_status(403)
       self.response.write(e.message)
 
+class ABMigrateParticipantsHandler(ABBaseHandler):
+  """Moves participants of all Art-Battles out to child entities.
+  Until then an Art-Battle is read as before and is migrated the first time its participants are saved."""
+  def post(self, *args):
+    moved = 0
+    for ab in ArtBattle.query(ancestor=ArtBattle.ANCESTOR_KEY):
+      moved += ab.migrate_participants()
+    logging.info('Moved %d participants to child entities' % moved)
+    self.response.write('Moved %d participants' % moved)
+
 
 ##################################### Misc #####################################
   
@@ -875,6 +1200,7 @@ app = webapp2.WSGIApplication([
   ('/artbattle/participant/review', ABParticipantReviewHandler),
   ('/artbattle/participant/edit', ABParticipantsEditHandler),
   ('/artbattle/current', ABCurrentHandler),
+  ('/artbattle/migrate_participants', ABMigrateParticipantsHandler),
   ('/login', ABLoginHandler),
   ('/parse_tabun_messages', ABParseTabunMsgsHandler),
 ], debug=True)
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import unittest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+from ballot import parse_ballot, parse_ballot_form, FORM_HASH, FORM_MEMBER
+
+CORPUS = os.path.join(ROOT, 'bench', 'corpus', 'ballots.txt')
+
+
+class ParseBallotTest(unittest.TestCase):
+  def test_corpus(self):
+    with io.open(CORPUS, encoding='utf-8') as f:
+      for line in f:
+        line = line.rstrip(u'\n')
+        if not line or line.startswith(u'#') and u'\t' not in line:
+          continue
+        expected, comment = line.split(u'\t', 1)
+        self.assertEqual(parse_ballot(comment), None if expected == u'-' else int(expected), comment)
+
+  def test_higher_form_inside_lower_form_match(self):
+    # "номер #3" is also the start of a FORM_NUMBER match, which must not hide the FORM_HASH "#3"
+    self.assertEqual(parse_ballot_form(u'номер #3, участник 4'), (3, FORM_HASH))
+    self.assertEqual(parse_ballot_form(u'3 номер, участник 4'), (4, FORM_MEMBER))
+
+if __name__ == '__main__':
+  unittest.main()
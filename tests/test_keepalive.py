@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import os
+import socket
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'libs'))
+from tabun_api.compat import urequest
+from tabun_api.keepalive import ConnectionPool, KeepAliveHTTPHandler
+
+RESPONSE = b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\nConnection: keep-alive\r\n\r\nok'
+
+
+class ScriptedServer(threading.Thread):
+  '''Serves one keep-alive connection after another. actions[n] is what to do with the n-th request
+  (counting over all connections): "ok" answers it, "drop" reads it and closes the connection without
+  an answer, "ok-close" answers it and closes the connection right after.'''
+
+  def __init__(self, actions):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.actions = list(actions)
+    self.requests = []
+    self.connections = 0
+    self.sock = socket.socket()
+    self.sock.bind(('127.0.0.1', 0))
+    self.sock.listen(5)
+    self.url = 'http://127.0.0.1:%d' % self.sock.getsockname()[1]
+
+  def read_request(self, conn, buf):
+    while b'\r\n\r\n' not in buf:
+      data = conn.recv(65536)
+      if not data:
+        return None, b''
+      buf += data
+    head, buf = buf.split(b'\r\n\r\n', 1)
+    length = 0
+    for line in head.split(b'\r\n')[1:]:
+      name, value = line.split(b':', 1)
+      if name.strip().lower() == b'content-length':
+        length = int(value)
+    while len(buf) < length:
+      buf += conn.recv(65536)
+    return head.split(b' ')[0], buf[length:]
+
+  def run(self):
+    while self.actions:
+      conn = self.sock.accept()[0]
+      self.connections += 1
+      buf = b''
+      while self.actions:
+        method, buf = self.read_request(conn, buf)
+        if method is None:
+          break
+        self.requests.append(method)
+        action = self.actions.pop(0)
+        if action != 'drop':
+          conn.sendall(RESPONSE)
+        if action != 'ok':
+          break
+      conn.close()
+
+
+class KeepAliveTest(unittest.TestCase):
+  def open(self, actions, methods, pause=0):
+    server = ScriptedServer(actions)
+    server.start()
+    pool = ConnectionPool()
+    opener = urequest.build_opener(KeepAliveHTTPHandler(pool))
+    results = []
+    for method in methods:
+      try:
+        results.append(opener.open(server.url + '/', b'x=1' if method == 'POST' else None, timeout=5).read())
+      except Exception as exc:
+        results.append(type(exc))
+      time.sleep(pause)
+    server.join(1)
+    return server, pool, results
+
+  def test_post_is_not_resent_after_drop(self):
+    # a resent POST would get the last answer
+    server, pool, results = self.open(['ok', 'drop', 'ok'], ['POST', 'POST'])
+    self.assertEqual(results[0], b'ok')
+    self.assertNotEqual(results[1], b'ok')
+    self.assertEqual(server.requests, [b'POST', b'POST'])
+
+  def test_get_is_resent_after_drop(self):
+    server, pool, results = self.open(['ok', 'drop', 'ok'], ['GET', 'GET'])
+    self.assertEqual(results, [b'ok', b'ok'])
+    self.assertEqual(server.requests, [b'GET', b'GET', b'GET'])
+
+  def test_closed_idle_connection_is_not_used(self):
+    server, pool, results = self.open(['ok-close', 'ok'], ['POST', 'POST'], pause=0.1)
+    self.assertEqual(results, [b'ok', b'ok'])
+    self.assertEqual(server.connections, 2)
+    self.assertEqual(pool.stats()['discarded'], 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'libs'))
+import tabun_api
+from tabun_api.ratelimit import RetryPolicy, UNSENT_CODES
+
+
+class FakeFormUser(tabun_api.User):
+  '''Fails send_form with the given errors and finds the post after found_after checks.'''
+  username = 'organizer'
+
+  def __init__(self, errors, found_after=None):
+    self.errors = list(errors)
+    self.found_after = found_after
+    self.sent = 0
+    self.checks = 0
+    self.retry = RetryPolicy(base_delay=0, check_delays=(0, 0, 0))
+
+  def send_form(self, url, fields=(), files=(), headers=None, redir=True):
+    self.sent += 1
+    if self.errors:
+      raise self.errors.pop(0)
+    raise AssertionError('the form was sent again')
+
+  def find_created_post(self, title, draft=False):
+    self.checks += 1
+    try:
+      # like the real one, which swallows errors of get_posts
+      raise ValueError('page not loaded')
+    except ValueError:
+      pass
+    if self.found_after is not None and self.checks >= self.found_after:
+      return 'blog', 1
+    return None
+
+
+class SubmitTopicTest(unittest.TestCase):
+  def test_slow_server_creates_post_after_timeout(self):
+    user = FakeFormUser([tabun_api.TabunError('Timeout', -2)], found_after=3)
+    self.assertEqual(user.submit_topic('/topic/add/', {}, 'title', check_if_error=True), ('blog', 1))
+    self.assertEqual((user.sent, user.checks), (1, 3))
+
+  def test_no_resend_after_server_error(self):
+    user = FakeFormUser([tabun_api.TabunError(code=503)])
+    with self.assertRaises(tabun_api.TabunError) as ctx:
+      user.submit_topic('/topic/add/', {}, 'title', check_if_error=True)
+    self.assertEqual(ctx.exception.code, 503)
+    self.assertEqual((user.sent, user.checks), (1, 3))
+
+  def test_resend_if_not_sent(self):
+    refused = tabun_api.TabunError('Connection refused', min(UNSENT_CODES))
+    user = FakeFormUser([refused, refused, refused])
+    with self.assertRaises(tabun_api.TabunError):
+      user.submit_topic('/topic/add/', {}, 'title', check_if_error=True)
+    # the first attempt and retry.retries repeats
+    self.assertEqual((user.sent, user.checks), (3, 0))
+
+if __name__ == '__main__':
+  unittest.main()
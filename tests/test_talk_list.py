@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'libs'))
+import tabun_api
+
+
+def talk(talk_id, date):
+  return tabun_api.TalkItem(talk_id, ['organizer'], False, u'Арт-Баттл', time.strptime(date, '%Y-%m-%d'), author='user')
+
+
+class FakeInboxUser(tabun_api.User):
+  '''Serves get_talk_list from a list of pages instead of Tabun.'''
+  def __init__(self, pages):
+    self.pages = pages
+    self.loaded = []
+
+  def get_talk_list(self, page=1, raw_data=None):
+    self.loaded.append(page)
+    # like Tabun, a page past the end shows the last one again
+    return self.pages[min(page, len(self.pages)) - 1]
+
+
+class IterTalkListTest(unittest.TestCase):
+  def test_old_thread_with_new_reply_above_new_talks(self):
+    user = FakeInboxUser([
+      [talk(10, '2026-05-01'), talk(14, '2026-05-10'), talk(13, '2026-05-10')],
+      [talk(12, '2026-05-10'), talk(11, '2026-05-09'), talk(9, '2026-04-30')],
+      [talk(8, '2026-04-29')],
+    ])
+    ids = [x.talk_id for x in user.iter_talk_list(since_id=11, since_date=time.strptime('2026-05-01', '%Y-%m-%d'))]
+    self.assertEqual(ids, [14, 13, 12])
+    # the third page is all older than since_date
+    self.assertEqual(user.loaded, [1, 2, 3])
+
+  def test_old_thread_with_new_reply_at_bottom_of_page(self):
+    since_date = time.strptime('2026-05-01', '%Y-%m-%d')
+    user = FakeInboxUser([
+      [talk(14, '2026-05-10'), talk(13, '2026-05-10'), talk(9, '2026-04-20')],
+      [talk(12, '2026-05-09'), talk(8, '2026-04-19')],
+      [talk(7, '2026-04-18'), talk(6, '2026-04-17')],
+      [talk(5, '2026-04-16')],
+    ])
+    self.assertEqual([x.talk_id for x in user.iter_talk_list(since_date=since_date)], [14, 13, 12])
+    # the third page is all older than since_date, so the fourth one is not loaded
+    self.assertEqual(user.loaded, [1, 2, 3])
+
+  def test_stops_on_last_page(self):
+    user = FakeInboxUser([[talk(3, '2026-05-10'), talk(2, '2026-05-10')], [talk(1, '2026-05-10')]])
+    self.assertEqual([x.talk_id for x in user.iter_talk_list(since_id=1)], [3, 2])
+    self.assertEqual(user.loaded, [1, 2, 3])
+
+if __name__ == '__main__':
+  unittest.main()